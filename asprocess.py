@@ -24,11 +24,123 @@ There is a very simple 1-of mechanism for notifications back.
 from multiprocessing import Pipe, Process
 import select
 import importlib
-import os, sys, traceback
-import logger
+import os, sys, traceback, fcntl, termios, struct, json
+import cProfile, pstats
+from collections import deque
+import logger, metrics
 import time
 
-def classrunner(wrappedClassName, ticktime, procend, kwacktimeout=None, timeoutfunction=None, monitortime=None, **kwargs):
+def pipebacklog(procend):
+    """
+    returns the number of bytes waiting to be read in the pipe
+    """
+    return struct.unpack('i', fcntl.ioctl(procend.fileno(), termios.FIONREAD, b'\0\0\0\0'))[0]
+
+class tickprofiler():
+    """
+    profiles the wrapped class's ticker with cProfile for a limited time (see the 'p' and 'q' codes in runAsProcess.runOnProc).
+
+    Only 1 tick in every is profiled, and a tick is not profiled if that would take the time spent in profiled ticks over budget
+    (a fraction of the elapsed time), so the overhead is bounded.
+    """
+    maxduration=60
+
+    def __init__(self, duration=5, every=1, budget=.1, top=25):
+        """
+        raises ValueError if any of the args is not a number in range (a TypeError is raised for unknown args)
+        """
+        for aname, aval, ok, okmsg in (('duration', duration, lambda v: v > 0, '> 0'), ('every', every, lambda v: v >= 1, '>= 1'),
+                ('budget', budget, lambda v: 0 < v <= 1, 'in 0 - 1'), ('top', top, lambda v: v >= 1, '>= 1')):
+            if isinstance(aval, bool) or not isinstance(aval, (int, float)) or not ok(aval):
+                raise ValueError('profile %s must be a number %s, not %r' % (aname, okmsg, aval))
+        self.every=max(1, int(every))
+        self.budget=budget
+        self.top=top
+        self.prof=cProfile.Profile()
+        self.started=time.perf_counter()
+        self.duration=min(duration, self.maxduration)
+        self.endat=self.started+self.duration
+        self.ticks=0
+        self.profiled=0
+        self.skipped=0
+        self.proftime=0
+
+    def tick(self, tickfunc):
+        """
+        runs a single tick, profiling it if allowed, returns True once the profile is complete
+        """
+        tstart=time.perf_counter()
+        self.ticks+=1
+        if self.ticks % self.every == 0:
+            if self.proftime <= self.budget*(tstart-self.started):
+                self.prof.enable()
+                tickfunc()
+                self.prof.disable()
+                self.proftime+=time.perf_counter()-tstart
+                self.profiled+=1
+                return tstart >= self.endat
+            self.skipped+=1
+        tickfunc()
+        return tstart >= self.endat
+
+    def results(self):
+        """
+        returns a dict with the profile summary and the top functions by cumulative time
+        """
+        ps=pstats.Stats(self.prof)
+        entries=[]
+        for (fname, line, func), (cc, nc, tt, ct, callers) in sorted(ps.stats.items(), key=lambda x: x[1][3], reverse=True)[:self.top]:
+            entries.append({'function': '%s:%d(%s)' % (fname, line, func), 'calls': nc, 'primcalls': cc, 'tottime': tt, 'cumtime': ct})
+        return {'elapsed'  : time.perf_counter()-self.started,
+                'ticks'    : self.ticks,
+                'profiled' : self.profiled,
+                'skipped'  : self.skipped,
+                'proftime' : self.proftime,
+                'entries'  : entries}
+
+class rpctimes():
+    """
+    per method histograms of rpc timings, created as methods are first seen and added to a metrics registry if one is given
+    """
+    buckets=(.00001, .00002, .00005)+metrics.histogram.defaultbuckets
+
+    def __init__(self, metricname, help, reg=None):
+        self.metricname=metricname
+        self.help=help
+        self.reg=reg
+        self.hists={}
+
+    def observe(self, mname, value):
+        h=self.hists.get(mname, None)
+        if h is None:
+            h=metrics.histogram(self.metricname, self.help, labels={'method': str(mname)}, buckets=self.buckets)
+            if not self.reg is None:
+                self.reg.add(h)
+            self.hists[mname]=h
+        h.observe(value)
+
+    def snapshot(self):
+        return {mname: h.snapshot() for mname, h in self.hists.items()}
+
+    def summary(self, since=None):
+        """
+        since : if not None, a snapshot and only the timings after it are summarised
+        """
+        if since is None:
+            return {mname: h.summary() for mname, h in self.hists.items()}
+        return {mname: h.summary(since.get(mname, None)) for mname, h in self.hists.items()}
+
+def traceeventlist(tracebuf, clockstart):
+    """
+    converts the trace buffer to a list of Chrome trace event format complete ('X') events, with times in microseconds from clockstart
+    """
+    if tracebuf is None:
+        return []
+    pid=os.getpid()
+    return [{'name': str(name), 'cat': cat, 'ph': 'X', 'ts': (tstart-clockstart)*1000000, 'dur': dur*1000000, 'pid': pid, 'tid': 1}
+            for name, cat, tstart, dur in tracebuf]
+
+def classrunner(wrappedClassName, ticktime, procend, kwacktimeout=None, timeoutfunction=None, monitortime=None, metricsport=None, traceevents=None, **kwargs):
     """
     This function is the target for a new process. It runs the wrapped class,calling method ticker every ticktime.
     
@@ -45,6 +157,15 @@ def classrunner(wrappedClassName, ticktime, procend, kwacktimeout=None, timeoutf
     timeoutfunction  : name of the member function to call if inactivity timeout
 
     monitortime      : time in seconds at which we will report process performance stats
+
+    metricsport      : if not None, metrics (see metrics.py) are served in Prometheus text format on http://127.0.0.1:<metricsport>/metrics
+                       (0 for any free port). If the wrapped class has a method addMetrics, it is called with the registry so the
+                       class can add its own. Tick duration and lateness are only measured (and summarised in the 'x' stats) when
+                       metrics are on, so they cost nothing otherwise. The rpc timings are always kept and summarised in the 'x'
+                       stats, and are also served when metrics are on.
+
+    traceevents      : if not None, the start time and duration of the most recent traceevents ticks, messages (by method name) and
+                       waits are kept, and can be fetched with the 't' code (see runAsProcess.exportTrace).
     
     kwargs           : dict with keyword args to instantiate the class
     
@@ -56,6 +177,23 @@ def classrunner(wrappedClassName, ticktime, procend, kwacktimeout=None, timeoutf
     ci=logger.makeClassInstance(wrappedClassName, **kwargs)
     print("classrunner using", type(ci).__name__)
     sendback(('OK',type(ci).__name__, -2))
+    if metricsport is None:
+        mreg=None
+        mserver=None
+    else:
+        mreg=metrics.registry()
+        tickdurations=mreg.histogram('pimotors_tick_duration_seconds', 'time spent in each call of the ticker')
+        ticklateness=mreg.histogram('pimotors_tick_lateness_seconds', 'how long after its due time each tick started')
+        tickcounter=mreg.counter('pimotors_ticks_total', 'ticks run')
+        msgcounter=mreg.counter('pimotors_messages_total', 'messages received from the stub')
+        mreg.gauge('pimotors_pipe_backlog_bytes', 'bytes waiting in the pipe from the stub', func=lambda: pipebacklog(procend))
+    rpcqueue=rpctimes('pimotors_rpc_queue_seconds', 'time from a message being sent by the stub to being read by the process', mreg)
+    rpcexec=rpctimes('pimotors_rpc_exec_seconds', 'time taken to run the method for a message (including failed calls)', mreg)
+    if not mreg is None:
+        if hasattr(ci, 'addMetrics'):
+            ci.addMetrics(mreg)
+        mserver=metrics.metricsserver(mreg, metricsport)
+        print('classrunner metrics on port %d' % mserver.port)
     waittime=0                      # the time spent waiting in select
     msgtime=0                       # the time spent processing messages
     tickertime=0                    # the time spent in the tick handler
@@ -75,6 +213,10 @@ def classrunner(wrappedClassName, ticktime, procend, kwacktimeout=None, timeoutf
         intvltickerticks=[]
     running=True
     tickcount=0
+    profiler=None
+    profresult=None                 # the results of the last completed profile
+    statsmark=None                  # the stats when the stub last asked for a mark (see runAsProcess.getProcessStats)
+    tracebuf=None if traceevents is None else deque(maxlen=traceevents) # entries are (name, category, start, duration)
     print('using timeout %3.1f to call %s, tick is %3.2f' % (0 if kwacktimeout is None else kwacktimeout, str(timeoutfunction), ticktime))
     loopstartat=time.perf_counter()
     trackdelays=[]
@@ -89,19 +231,65 @@ def classrunner(wrappedClassName, ticktime, procend, kwacktimeout=None, timeoutf
             tnow=time.perf_counter()
             sleeptime=tnow-loopstartat
             waittime+=sleeptime
+            if not tracebuf is None:
+                tracebuf.append(('wait', 'wait', loopstartat, sleeptime))
             if r:
                 lastincoming=tnow
-                mname, sync, rid, kwargs = procend.recv()
+                mname, sync, rid, kwargs, sentat = procend.recv()
+                recvat=time.monotonic()
+                if not mreg is None:
+                    msgcounter.inc()
                 if sync=='k':  # trivial no-op used to reset keep awake timer for example
                     pass
-                elif sync=='x': # send stats on total process run time
-                    sendback(('OK',
-                        {   'elapsed' : time.perf_counter()-clockstart,
+                elif sync=='x': # send stats on total process run time, or the run time since the mark
+                    since=statsmark if kwargs.get('sincemark', False) else None
+                    pstats={'elapsed' : time.perf_counter()-clockstart,
                             'cputime' : time.process_time()-cpustart,
                             'idletime': waittime,
                             'ticks'   : tickcount,
-                            'rid'     : rid},
-                        rid))
+                            'rid'     : rid}
+                    if not since is None:
+                        for k in ('elapsed', 'cputime', 'idletime', 'ticks'):
+                            pstats[k]-=since[k]
+                    pstats['rpcqueue']=rpcqueue.summary(None if since is None else since['rpcqueue'])
+                    pstats['rpcexec']=rpcexec.summary(None if since is None else since['rpcexec'])
+                    if not mreg is None:
+                        pstats['tickduration']=tickdurations.summary(None if since is None else since['tickduration'])
+                        pstats['ticklateness']=ticklateness.summary(None if since is None else since['ticklateness'])
+                    if kwargs.get('mark', False):
+                        statsmark={'elapsed': time.perf_counter()-clockstart, 'cputime': time.process_time()-cpustart,
+                                   'idletime': waittime, 'ticks': tickcount,
+                                   'rpcqueue': rpcqueue.snapshot(), 'rpcexec': rpcexec.snapshot()}
+                        if not mreg is None:
+                            statsmark['tickduration']=tickdurations.snapshot()
+                            statsmark['ticklateness']=ticklateness.snapshot()
+                    sendback(('OK', pstats, rid))
+                elif sync=='p': # start a profile of the ticker - fetch the results with 'q' once it completes
+                    if profiler is None:
+                        try:
+                            profiler=tickprofiler(**kwargs)
+                        except (TypeError, ValueError) as e:
+                            sendback(('BadArgs', str(e), rid))
+                        except Exception as e:
+                            sendback(('ProfileFailed', '%s: %s' % (type(e).__name__, e), rid))
+                        else:
+                            sendback(('OK', {'duration': profiler.duration}, rid))
+                    else:
+                        sendback(('ProfileRunning', 'a profile is already running', rid))
+                elif sync=='q': # send the results of the last profile, None if one is still running
+                    if not profiler is None:
+                        sendback(('OK', None, rid))
+                    elif profresult is None:
+                        sendback(('NoProfile', 'no profile has been run', rid))
+                    else:
+                        sendback(('OK', profresult, rid))
+                elif sync=='t': # send the trace events
+                    if kwargs:
+                        sendback(('BadArgs', 'trace events takes no args, got %s' % ', '.join(kwargs), rid))
+                    elif tracebuf is None:
+                        sendback(('NoTrace', 'process was not started with traceevents', rid))
+                    else:
+                        sendback(('OK', traceeventlist(tracebuf, clockstart), rid))
                 elif sync=='e':
                     running=False
                 else:
@@ -113,7 +301,11 @@ def classrunner(wrappedClassName, ticktime, procend, kwacktimeout=None, timeoutf
                     if not f is None:
                         if sync in ('s', 'a'):
                             try:
-                                resp=f(**kwargs)
+                                try:
+                                    resp=f(**kwargs)
+                                finally:    # failed calls are timed too
+                                    rpcqueue.observe(mname, recvat-sentat)
+                                    rpcexec.observe(mname, time.monotonic()-recvat)
                                 if sync=='s':
                                     sendback(('OK', resp, rid))
                             except:
@@ -125,14 +317,26 @@ def classrunner(wrappedClassName, ticktime, procend, kwacktimeout=None, timeoutf
                             sendback(('CommandException', sync, rid))
                 loopstartat=time.perf_counter()
                 msgtime += (loopstartat-tnow)
+                if not tracebuf is None:
+                    tracebuf.append((mname if sync in ('s', 'a') else sync, 'message', tnow, loopstartat-tnow))
             else:
                 loopstartat=time.perf_counter()
         else:
             tracktickercalls+=1
-            ci.ticker()
+            if profiler is None:
+                ci.ticker()
+            elif profiler.tick(ci.ticker):
+                profresult=profiler.results()
+                profiler=None
             tnow=time.perf_counter()
             thistick=tnow-loopstartat
-            tickertime += tnow-loopstartat
+            tickertime += thistick
+            if not mreg is None:
+                ticklateness.observe(-delay)
+                tickdurations.observe(thistick)
+                tickcounter.inc()
+            if not tracebuf is None:
+                tracebuf.append(('tick', 'tick', loopstartat, thistick))
             if not kwacktimeout is None and tnow>(lastincoming+kwacktimeout):
                 tmeth=getattr(ci, timeoutfunction)
                 tmeth()
@@ -166,6 +370,8 @@ def classrunner(wrappedClassName, ticktime, procend, kwacktimeout=None, timeoutf
             tickcount+=1
             nexttime+=ticktime
             loopstartat=time.perf_counter()
+    if not mserver is None:
+        mserver.close()
 
 class runAsProcess(logger.logger):
     """
@@ -192,6 +398,8 @@ class runAsProcess(logger.logger):
                 args=(wrappedClassName, ticktime, procendpipe), kwargs=kwargs)
         self.msgInCount = 0
         self.msgOutCount = 0
+        self.rpcroundtrip=rpctimes('pimotors_rpc_roundtrip_seconds', 'time from sending a synchronous message to getting the response')
+        self.statsmark=None
         self.proc.start()
         self.laststatus, self.startinf, self.lastoutid = self.stubendpipe.recv()
         self.running=self.laststatus=='OK' and self.lastoutid==-2
@@ -220,18 +428,24 @@ class runAsProcess(logger.logger):
                   'e' to shut down the remote process by exiting the control loop and thus the process
                       the closedown method of the class can be run if 'method' not None (plus any kwargs...)
                   'k' no-op used to provide keep awake ticks
-                  'x' return process stats (since process start
+                  'x' return process stats (since process start, or since the mark - see getProcessStats)
+                  't' return the trace events (see classrunner param traceevents)
+                  'p' start a profile of the ticker in the remote process and return at once (see tickprofiler for the kwargs)
+                  'q' return the stats from the last profile, None if it is still running
         """
         if self.running:
-            self.stubendpipe.send((method, sync, self.msgOutCount, kwargs))
+            sentat=time.monotonic()
+            self.stubendpipe.send((method, sync, self.msgOutCount, kwargs, sentat))
             rid=self.msgOutCount
             self.msgOutCount+=1
-            if sync=='s' or sync =='x':
+            if sync in ('s', 'x', 'p', 'q', 't'):
                 instatus, inresponse, outid = self.stubendpipe.recv()
                 while outid==-1:
                     self.handleprocstats(inresponse)
                     instatus, inresponse, outid = self.stubendpipe.recv()
                 if outid==rid:
+                    if sync=='s':
+                        self.rpcroundtrip.observe(method, time.monotonic()-sentat)
                     if instatus=='OK':
                         return inresponse
                     else:
@@ -243,6 +457,7 @@ class runAsProcess(logger.logger):
                 pass
             elif sync=='e':
                 self.stubend()
+                return      # the process has gone, so there is nothing more to read from the pipe
             else:
                 raise ValueError('unknown sync value %s' % sync)
             if self.stubendpipe.poll():
@@ -258,8 +473,57 @@ class runAsProcess(logger.logger):
     def sendkwac(self):
         self.runOnProc(None,'k')
 
-    def getProcessStats(self):
-        return self.runOnProc(None,'x')
+    def getProcessStats(self, mark=False, sincemark=False):
+        """
+        returns the stats from the remote process, with the round trip times of synchronous calls from this stub added as
+        'rpcroundtrip'. The rpc timings are summaries by method name.
+
+        mark      : if True the stats at this point are remembered (in both processes) as the mark
+
+        sincemark : if True the stats only cover the time since the mark (for example to leave out a warm up), otherwise they
+                    cover the whole life of the process
+        """
+        stats=self.runOnProc(None,'x', mark=mark, sincemark=sincemark)
+        if not stats is None:
+            stats['rpcroundtrip']=self.rpcroundtrip.summary(self.statsmark if sincemark else None)
+            if mark:
+                self.statsmark=self.rpcroundtrip.snapshot()
+        return stats
+
+    def exportTrace(self, filename):
+        """
+        fetches the trace events from the remote process (it must have been started with traceevents) and writes them to
+        filename as a Chrome trace event JSON file (which can be loaded into chrome://tracing or Perfetto).
+
+        returns the number of events written
+        """
+        events=self.runOnProc(None, 't')
+        if events is None:
+            return 0
+        with open(filename, 'w') as tf:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, tf)
+        return len(events)
+
+    def profileTicks(self, duration=5, every=1, budget=.1, top=25):
+        """
+        starts a profile of the ticker in the remote process and returns at once - use profileResults to fetch the results
+        once duration has passed. Returns a dict with the actual duration, or None if the profile could not be started.
+
+        duration: how long to profile for in seconds (limited to tickprofiler.maxduration)
+
+        every   : profile 1 tick in every
+
+        budget  : the largest fraction of the elapsed time that can be spent in profiled ticks
+
+        top     : the number of functions (highest cumulative time first) to return
+        """
+        return self.runOnProc(None, 'p', duration=duration, every=every, budget=budget, top=top)
+
+    def profileResults(self):
+        """
+        returns the results of the last profile started by profileTicks, None if it is still running (or none has been run)
+        """
+        return self.runOnProc(None, 'q')
 
     def handleprocstats(self, statsmsg):
         """
@@ -0,0 +1,397 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the motor control hot paths.
+
+These use stand-in motor driver and encoder classes so they run on any machine, without pigpio or motor hardware. The times
+are for the python code only.
+
+The suite (see runsuite) times each hot path on its own, and can save the results as JSON and compare them with a saved
+baseline, flagging the benchmarks that have slowed down by more than a threshold. The other benchmarks here compare
+alternative implementations.
+
+run with: python3 benchmark.py [--save results.json] [--baseline baseline.json] [--threshold .2] [--comparisons]
+"""
+import time, tempfile, os, tracemalloc, types, json, platform, statistics, argparse, sys
+import logger, dcmotorbasic, feedback, quadfastencoder, clocks, asprocess, tracestore
+
+class benchdrive():
+    """
+    a motor driver (mdrive) that just remembers what it was set to
+    """
+    def __init__(self, parent, range=255, invert=False):
+        self.range=range
+        self.isinverted=invert
+        self.lastdc=0
+        self.lastHz=200
+
+    def invert(self, invert):
+        if not invert is None:
+            self.isinverted=invert==True
+        return self.isinverted
+
+    def maxDC(self):
+        return self.range
+
+    def DC(self, dutycycle):
+        self.lastdc=max(-self.range, min(self.range, dutycycle))
+        return self.lastdc
+
+    def frequency(self, frequency):
+        if not frequency is None:
+            self.lastHz=frequency
+        return self.lastHz
+
+    def close(self):
+        pass
+
+    def odef(self):
+        return {'className': type(self).__name__}
+
+class benchencoder():
+    """
+    a rotation sensor for a motor running at a steady speed - each read moves the tally on by tallystep
+    """
+    def __init__(self, parent, ticksperrev=12, tallystep=20):
+        self.ticksperrev=ticksperrev
+        self.tallystep=tallystep
+        self.tally=0
+        self.clock=parent.clock
+        self.lasttallytime=self.clock.time()
+        self.lasttallyread=0
+        self.lastmotorpos=0
+        self.prevmotorpos=0
+        self.lasttallydiff=0
+        self.lasttallyinterval=0
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            self.tally+=self.tallystep
+            tallyr=self.tally
+            tnow=self.clock.time()
+            self.lasttallyinterval=tnow-self.lasttallytime
+            self.lasttallytime=tnow
+            tallydiff=tallyr-self.lasttallyread
+            self.prevmotorpos=self.lastmotorpos
+            self.lastmotorpos+=tallydiff / self.ticksperrev
+            self.lasttallyread=tallyr
+            self.lasttallydiff=tallydiff
+            yield(self.lastmotorpos)
+
+    def odef(self):
+        return {'className': type(self).__name__}
+
+benchspeedmap={'className': 'dcmotorbasic.speedmapper',
+               'fbuilder': {'minSpeed':1500, 'maxSpeed':13000, 'minDC':20, 'maxDC':255},
+               'rbuilder': {'minSpeed':1500, 'maxSpeed':13000, 'minDC':20, 'maxDC':255}}
+
+def makemotor(name='bench', logtypes=None, feedback=True, **kwargs):
+    """
+    returns a motor with the stand-in driver and encoder, running under feedback control if feedback is True
+
+    kwargs are passed on to the motor
+    """
+    m=dcmotorbasic.motor(name=name, logtypes=logtypes, **kwargs,
+            mdrive={'className': 'benchmark.benchdrive'},
+            rotationsense={'className': 'benchmark.benchencoder'},
+            speedmapinfo=benchspeedmap,
+            feedback={'className': 'feedback.PIDfeedback', 'Pfact': -.5, 'Ifact': 0, 'Dfact': -.1} if feedback else None)
+    if feedback:
+        m.targetSpeed(5000)
+    return m
+
+def timeit(func, count):
+    """
+    calls func count times, returns the average time per call in microseconds
+    """
+    tstart=time.perf_counter()
+    for i in range(count):
+        func()
+    return (time.perf_counter()-tstart)/count*1000000
+
+def benchtickerlogging(ticks=20000):
+    """
+    compares the cost of motor.ticker (under feedback control) with logging off and with the phys and feedbacktrace logs
+    written to files.
+
+    returns a dict of microseconds per tick
+    """
+    results={}
+    m=makemotor()
+    results['ticker, logging off']=timeit(m.ticker, ticks)
+    m.close()
+    with tempfile.TemporaryDirectory() as tdir:
+        m=makemotor(logtypes=(('phys', {'filename': os.path.join(tdir, 'phys.log'), 'format': '{setting} is {newval}.'}),
+                              ('feedbacktrace', {'filename': os.path.join(tdir, 'fbtrace.log'), 'asdict': True})))
+        results['ticker, phys and feedbacktrace on']=timeit(m.ticker, ticks)
+        m.close()
+    return results
+
+def unslotted(cls):
+    """
+    returns a copy of a class that uses __slots__, but with an instance dict instead - to compare against
+    """
+    return type(cls.__name__+'_dict', cls.__bases__,
+            {k: v for k, v in cls.__dict__.items() if k != '__slots__' and not k in cls.__slots__})
+
+def allocated(func, count):
+    """
+    calls func count times, keeping the results, returns the memory allocated (as traced by tracemalloc) per call in bytes
+    """
+    tracemalloc.start()
+    try:
+        before=tracemalloc.get_traced_memory()[0]
+        keep=[func() for i in range(count)]
+        return (tracemalloc.get_traced_memory()[0]-before)/count
+    finally:
+        tracemalloc.stop()
+
+def benchslots(count=10000):
+    """
+    compares the slot based feedback trace record (dcmotorbasic.feedbacksample) with the same class using an instance dict:
+    memory per instance (from tracemalloc) and time per update. The tick path's other classes (PIDfeedback and the encoders) were
+    measured the same way and do not use slots - there is one of each per motor, and slots saved under 50 bytes each with no
+    measurable change in speed.
+
+    Also measures the memory left allocated by ticks of a motor under feedback control, which should be close to zero, and the
+    memory used writing the trace record to a sink as it is and as a dict copy.
+
+    returns a dict of results (bytes or microseconds)
+    """
+    results={}
+    for variant, vcls in (('slots', dcmotorbasic.feedbacksample), ('dict', unslotted(dcmotorbasic.feedbacksample))):
+        results['feedbacksample (%s) bytes per instance' % variant]=allocated(lambda: vcls(motor='bench', ltype='feedbacktrace'), count)
+        fs=vcls(motor='bench', ltype='feedbacktrace')
+        def update():
+            fs.tstamp=1
+            fs.targetSpeed=2
+            fs.speed=3
+            fs.error=4
+            fs.adjust=5
+        results['feedbacksample update (%s) us' % variant]=timeit(update, count*10)
+    m=makemotor()
+    m.ticker()
+    tracemalloc.start()
+    before=tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        m.ticker()
+    results['motor ticks with feedback, bytes kept per tick']=(tracemalloc.get_traced_memory()[0]-before)/count
+    tracemalloc.stop()
+    m.close()
+    with tempfile.TemporaryDirectory() as tdir:
+        m=makemotor(logtypes=tracesinklog(os.path.join(tdir, 'fbtrace')))
+        results['motor ticks with feedback trace to sink, peak bytes per tick']=peakallocated(m.ticker, count)
+        m.close()
+        sink=tracestore.tracesink(os.path.join(tdir, 'direct'), fields=tracestore.feedbacktracefields, flushbytes=1<<30)
+        fs=dcmotorbasic.feedbacksample(motor='bench', ltype='feedbacktrace')
+        for variant, rec in (('slots record', lambda: fs), ('dict copy', fs.asdict)):
+            results['tracesink.writerecord (%s) peak bytes' % variant]=peakallocated(lambda: sink.writerecord('bench', rec(), 0), count)
+            results['tracesink.writerecord (%s) us' % variant]=timeit(lambda: sink.writerecord('bench', rec(), 0), count*10)
+        sink.close()
+    return results
+
+def peakallocated(func, count):
+    """
+    calls func count times, returns the average over the calls of the peak memory (as traced by tracemalloc) allocated during
+    the call - this includes memory that is freed again before the call returns, such as a dict made for a log record
+    """
+    func()
+    tracemalloc.start()
+    try:
+        total=0
+        for i in range(count):
+            before=tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func()
+            total+=tracemalloc.get_traced_memory()[1]-before
+        return total/count
+    finally:
+        tracemalloc.stop()
+
+class benchtarget():
+    """
+    a minimal class for runAsProcess to run, for timing the round trip through the pipes
+    """
+    def __init__(self, **kwargs):
+        pass
+
+    def ticker(self):
+        pass
+
+    def echo(self, value):
+        return value
+
+class benchstub(asprocess.runAsProcess):
+    """
+    the stub for benchtarget
+    """
+    def echo(self, value):
+        return self.runOnProc('echo', 's', value=value)
+
+def casespeedmap():
+    sm=logger.makeClassInstance(invert=False, **benchspeedmap)
+    speeds=[s*250 for s in range(-60, 61)]
+    sidx=[0]
+    def run():
+        sidx[0]=(sidx[0]+1) % len(speeds)
+        sm.speedToFDC(speeds[sidx[0]])
+    return run, None
+
+def casepid():
+    pid=feedback.PIDfeedback(timenow=0, Pfact=-.5, Ifact=0, Dfact=-.1)
+    return lambda: pid.ticker(1, .1), None
+
+def tracesinklog(filename):
+    """
+    returns the logtypes for a motor that writes its feedback trace to a tracestore sink
+    """
+    return (('feedbacktrace', {'filename': filename, 'sink': {'className': 'tracestore.tracesink',
+            'fields': tracestore.feedbacktracefields}}),)
+
+def casemotor(trace):
+    tdir=tempfile.TemporaryDirectory()
+    if trace=='asdict':
+        m=makemotor(logtypes=(('feedbacktrace', {'filename': os.path.join(tdir.name, 'fbtrace.log'), 'asdict': True}),))
+    elif trace=='sink':
+        m=makemotor(logtypes=tracesinklog(os.path.join(tdir.name, 'fbtrace')))
+    else:
+        m=makemotor()
+    def cleanup():
+        m.close()
+        tdir.cleanup()
+    return m.ticker, cleanup
+
+logmodes=(
+    ('format',          {'format': '{setting} is {newval}.'}),
+    ('format noheader', {'format': '{setting} is {newval}.', 'noheader': True}),
+    ('asdict',          {'asdict': True}),
+    ('key: value',      {}),
+    ('tracestore sink', {'sink': {'className': 'tracestore.tracesink', 'fields': (('setting', 'S10'), ('newval', 'f8'))}}),
+)
+
+def caselog(settings, asyncwriter=False):
+    tdir=tempfile.TemporaryDirectory()
+    lg=logger.logger(name='bench', createlogmsg=False, logtypes=(('phys', dict(filename=os.path.join(tdir.name, 'bench.log'), **settings)),))
+    if asyncwriter:
+        logger.startAsyncWriter()
+    def cleanup():
+        if asyncwriter:
+            logger.stopAsyncWriter()
+        lg.close()
+        tdir.cleanup()
+    return lambda: lg.log(ltype='phys', setting='speed', newval=1234.5), cleanup
+
+def casefastencoder():
+    tally=[0]
+    def quadpos(mname):
+        tally[0]+=20
+        return tally[0]
+    parent=types.SimpleNamespace(name='bench', clock=clocks.monotonicclock(),
+            parent=types.SimpleNamespace(quadmon=types.SimpleNamespace(quadpos=quadpos)))
+    postick=iter(quadfastencoder.fastencoder(ticksperrev=12, parent=parent, pins=(1, 2)))
+    return lambda: next(postick), None
+
+def caseroundtrip():
+    stub=benchstub(wrappedClassName='benchmark.benchtarget', ticktime=.05, locallogging={'logtypes': ()})
+    def cleanup():
+        stub.runOnProc(None, 'e')
+    return lambda: stub.echo(1), cleanup
+
+suite=(
+    ('speedmapper.speedToFDC',                  casespeedmap,                           100000),
+    ('PIDfeedback.ticker',                      casepid,                                100000),
+    ('motor.ticker, feedback',                  lambda: casemotor(None),                20000),
+    ('motor.ticker, feedback and trace',        lambda: casemotor('asdict'),            20000),
+    ('motor.ticker, feedback and trace to sink',lambda: casemotor('sink'),              20000),
+)+tuple(
+    ('logger.log, %s' % lname,                  lambda lset=lset: caselog(lset),        20000) for lname, lset in logmodes
+)+(
+    ('logger.log, format, asyncwriter',         lambda: caselog(logmodes[0][1], True),  20000),
+    ('fastencoder iteration',                   casefastencoder,                        100000),
+    ('runAsProcess sync round trip',            caseroundtrip,                          2000),
+)
+
+def runsuite(repeat=5, names=None, scale=1):
+    """
+    runs the benchmark suite, returns a dict of benchmark name to microseconds per call (the median of repeat runs)
+
+    names   : None to run all the benchmarks, else a list of names (or parts of names) of the ones to run
+
+    scale   : multiplies the number of calls in each run - use less than 1 for a quick check
+    """
+    results={}
+    for bname, case, count in suite:
+        if not names is None and not any(n in bname for n in names):
+            continue
+        try:
+            func, cleanup=case()
+        except ImportError as ie:
+            print('%s skipped: %s' % (bname, ie))
+            continue
+        try:
+            func()
+            results[bname]=statistics.median(timeit(func, max(1, int(count*scale))) for r in range(repeat))
+        finally:
+            if not cleanup is None:
+                cleanup()
+    return results
+
+def saveresults(results, filename):
+    """
+    saves suite results as JSON, with details of the machine they were run on
+    """
+    with open(filename, 'w') as rf:
+        json.dump({'tstamp': time.time(), 'machine': platform.machine(), 'node': platform.node(), 'python': platform.python_version(),
+                'units': 'microseconds per call', 'results': results}, rf, indent=2)
+
+def loadresults(filename):
+    with open(filename) as rf:
+        return json.load(rf)['results']
+
+def compareresults(results, baseline, threshold=.2):
+    """
+    compares suite results with a baseline, returns a dict of benchmark name to (baseline, result, ratio, flag), where flag is
+    'REGRESSION' if the result is more than threshold (a fraction) slower than the baseline, 'improved' if more than threshold
+    faster, 'new' if it is not in the baseline, and '' otherwise
+    """
+    comp={}
+    for bname, res in results.items():
+        base=baseline.get(bname, None)
+        if base is None:
+            comp[bname]=(None, res, None, 'new')
+        else:
+            ratio=res/base if base > 0 else float('inf')
+            comp[bname]=(base, res, ratio, 'REGRESSION' if ratio > 1+threshold else 'improved' if ratio < 1-threshold else '')
+    return comp
+
+if __name__ == '__main__':
+    clparse=argparse.ArgumentParser(description='benchmarks for the motor control hot paths')
+    clparse.add_argument('--save', help='file to save the suite results to (JSON)')
+    clparse.add_argument('--baseline', help='file of saved suite results to compare with')
+    clparse.add_argument('--threshold', type=float, default=.2, help='fractional slow down that counts as a regression')
+    clparse.add_argument('--repeat', type=int, default=5, help='runs of each benchmark - the median is used')
+    clparse.add_argument('--comparisons', action='store_true', help='also run the implementation comparisons')
+    args=clparse.parse_args()
+    results=runsuite(repeat=args.repeat)
+    regressions=0
+    if args.baseline is None:
+        for k, v in results.items():
+            print('%-45s: %10.2f us' % (k, v))
+    else:
+        for k, (base, res, ratio, flag) in compareresults(results, loadresults(args.baseline), args.threshold).items():
+            if base is None:
+                print('%-45s: %10.2f us %-10s %s' % (k, res, '', flag))
+            else:
+                print('%-45s: %10.2f us %10.2f us %6.2fx %s' % (k, res, base, ratio, flag))
+            if flag=='REGRESSION':
+                regressions+=1
+    if not args.save is None:
+        saveresults(results, args.save)
+    if args.comparisons:
+        for k, v in benchslots().items():
+            print('%-50s: %8.2f' % (k, v))
+        for k, v in benchtickerlogging().items():
+            print('%-45s: %8.2f us' % (k, v))
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+"""
+Calibration scans run on all the motors of a motorset at once.
+
+motoranalyser's mapdcToRPM and mapSpeed scan one motor at a time, and wait a fixed delay after each step before measuring.
+The calibrator here adds a ticker (see motor.addTicker) to each motor in the set, so all the motors scan together on the
+motorset's ticks, and each motor moves on as soon as its own speed has settled (or delay has passed) after each step.
+
+It is started by motorset.calibrate, for example:
+
+    cal=ms.calibrate(test='dc', dcstep=10)
+    ... keep the ticker running until cal.done ...
+    print(cal.results)
+"""
+import time
+
+class calibrator():
+    """
+    runs a calibration scan on a set of motors at once, and collects the results.
+
+    For each motor, direction and repeat the scan:
+        stops the motor and waits until no movement has been seen for settleticks ticks (or gives up after stoptimeout)
+        for each step (a duty cycle for test 'dc', or a target speed for test 'speed'):
+            sets the step and waits until the speed has settled or delay seconds have passed
+            measures the speed over interval seconds and adds a result
+
+    The speed has settled when the speeds measured over the last settleticks ticks are all within settletolerance (a fraction)
+    of their mean, plus 2 encoder counts per tick (so that slow motors, with few counts per tick, can settle).
+
+    A result is a dict with motor, testname, runid, direc ('f' or 'b'), repeat, DC or speed, tps (encoder counts per second),
+    rpm, settled (False if delay ran out), settletime and tstamp. Each result is also logged with the motor's log
+    (ltype logtype), so it can go to the same places as the motoranalyser results.
+
+    done is True once all the motors have finished. status has an entry for each motor - 'running', 'OK' or the reason it
+    failed.
+    """
+    def __init__(self, motors, test='dc', direction='both', repeat=1, minDC=20, maxDC=None, dcstep=5, speedsteps=20, delay=3,
+            interval=1, settleticks=5, settletolerance=.03, stoptimeout=10, logtype='analyser', priority=10, oncomplete=None):
+        """
+        motors          : list of the motors to scan
+
+        test            : 'dc' to scan duty cycles (feedback control is turned off), or 'speed' to scan target speeds (the motors
+                          must have feedback control)
+
+        direction       : 'both', 'forward' or 'backward'
+
+        repeat          : number of times each scan is run
+
+        minDC, maxDC    : range of duty cycles for test 'dc' - maxDC None for the motor's maximum
+
+        dcstep          : duty cycle step for test 'dc'
+
+        speedsteps      : number of steps between the motor's minimum and maximum speeds (see motor.speedLimits) for test 'speed'
+
+        delay           : the longest wait (seconds) for the speed to settle after each step
+
+        interval        : time (seconds) over which the speed is measured
+
+        settleticks     : number of ticks the speed must be steady for (and no movement seen for when stopping)
+
+        settletolerance : fractional spread allowed in the speed for it to be steady
+
+        stoptimeout     : the longest wait (seconds) for the motor to stop before a scan
+
+        logtype         : the ltype for the results in the motor logs
+
+        priority        : priority of the tickers (see motor.addTicker)
+
+        oncomplete      : if not None, called with this calibrator when all the motors have finished
+        """
+        assert test in ('dc', 'speed'), 'test must be "dc" or "speed"'
+        assert direction in ('both', 'forward', 'backward')
+        assert interval > .1
+        self.test=test
+        self.dirs={'both': 'fb', 'forward': 'f', 'backward': 'b'}[direction]
+        self.repeat=repeat
+        self.minDC=minDC
+        self.maxDC=maxDC
+        self.dcstep=dcstep
+        self.speedsteps=speedsteps
+        self.delay=delay
+        self.interval=interval
+        self.settleticks=settleticks
+        self.settletolerance=settletolerance
+        self.stoptimeout=stoptimeout
+        self.logtype=logtype
+        self.oncomplete=oncomplete
+        self.runid=time.time()
+        self.testname='calibrate'+test
+        self.results=[]
+        self.status={}
+        self.motors=motors
+        for m in motors:
+            if m.motorpos is None:
+                raise ValueError('motor %s has no position sensor to calibrate with' % m.name)
+            if test=='speed' and m.feedbackcontrol is None:
+                raise ValueError('motor %s has no feedback control for a speed calibration' % m.name)
+            if 'calibrate' in m.tickentries:
+                raise ValueError('motor %s is already being calibrated' % m.name)
+        added=[]
+        try:
+            for m in motors:
+                self.status[m.name]='running'
+                m.addTicker(tickgen=self.scan(m), tickID='calibrate', ticktick=1, priority=priority)
+                added.append(m)
+        except:
+            for m in added:
+                m.removeTicker('calibrate')
+                self.freerun(m)
+            raise
+
+    @property
+    def done(self):
+        return not 'running' in self.status.values()
+
+    def stop(self):
+        """
+        abandons the scans still running
+        """
+        for m in self.motors:
+            if m.removeTicker('calibrate'):
+                self.freerun(m)
+                self.finished(m, 'stopped')
+
+    def steps(self, m, direc):
+        """
+        returns the list of steps (duty cycles or target speeds) for a motor in a direction
+        """
+        sign=1 if direc=='f' else -1
+        if self.test=='dc':
+            top=m.maxDC() if self.maxDC is None else self.maxDC
+            return [sign*dc for dc in range(self.minDC, top+1, self.dcstep)]
+        speedfb, speedmb, speedmf, speedff=m.speedLimits()
+        low, high=(speedmf, speedff) if direc=='f' else (speedmb, speedfb)
+        return [sign*(low+(high-low)*i/self.speedsteps) for i in range(self.speedsteps+1)]
+
+    def freerun(self, m):
+        """
+        turns off feedback control (if it is on) and stops the motor
+        """
+        m.targSpeed=None
+        m.stop()
+
+    def scan(self, m):
+        """
+        the ticker (a generator) that runs the whole calibration for a motor
+        """
+        mp=m.motorpos
+        for rpt in range(self.repeat):
+            for direc in self.dirs:
+                self.freerun(m)
+                timeout=mp.lasttallytime+self.stoptimeout
+                still=0
+                while still < self.settleticks:
+                    yield
+                    still=still+1 if mp.lasttallydiff==0 else 0
+                    if mp.lasttallytime > timeout:
+                        self.freerun(m)
+                        self.finished(m, 'motor failed to stop')
+                        return
+                for step in self.steps(m, direc):
+                    if self.test=='dc':
+                        m.DC(step)
+                    else:
+                        m.targetSpeed(step)
+                    stepstart=mp.lasttallytime
+                    timeout=stepstart+self.delay
+                    rates=[]
+                    settled=False
+                    while True:
+                        yield
+                        if mp.lasttallyinterval > 0:
+                            rates.append(mp.lasttallydiff/mp.lasttallyinterval)
+                            if len(rates) >= self.settleticks:
+                                recent=rates[-self.settleticks:]
+                                mean=sum(recent)/self.settleticks
+                                if max(recent)-min(recent) <= abs(mean)*self.settletolerance+2/mp.lasttallyinterval:
+                                    settled=True
+                                    break
+                        if mp.lasttallytime > timeout:
+                            break
+                    settletime=mp.lasttallytime-stepstart
+                    measurestart=mp.lasttallytime
+                    posstart=mp.lastmotorpos
+                    while mp.lasttallytime-measurestart < self.interval:
+                        yield
+                    # the change in position rather than a sum of lasttallydiff, so ticks on which this ticker was put off (see
+                    # tickbudget in motor) still count
+                    tps=abs((mp.lastmotorpos-posstart)*mp.ticksperrev/(mp.lasttallytime-measurestart))
+                    res={'motor': m.name, 'testname': self.testname, 'runid': self.runid, 'direc': direc, 'repeat': rpt,
+                         'tps': tps, 'rpm': tps/mp.ticksperrev*60, 'settled': settled, 'settletime': settletime,
+                         'tstamp': mp.lasttallytime}
+                    res['DC' if self.test=='dc' else 'speed']=step
+                    self.results.append(res)
+                    if self.logtype in m.logon:
+                        m.log(ltype=self.logtype, **res)
+        self.freerun(m)
+        self.finished(m, 'OK')
+
+    def finished(self, m, status):
+        self.status[m.name]=status
+        m.log(ltype='life', otype=type(self).__name__, lifemsg='calibration of %s finished: %s' % (m.name, status))
+        if self.done and not self.oncomplete is None:
+            self.oncomplete(self)
+
+    def table(self, field='rpm'):
+        """
+        returns the results as a dict of (motor, direc) to a list of (step, value of field), averaged over the repeats
+        """
+        steppar='DC' if self.test=='dc' else 'speed'
+        acc={}
+        for res in self.results:
+            ent=acc.setdefault((res['motor'], res['direc']), {})
+            ent.setdefault(res[steppar], []).append(res[field])
+        return {k: [(step, sum(vals)/len(vals)) for step, vals in ent.items()] for k, ent in acc.items()}
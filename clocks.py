@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+"""
+Clocks for timing in the motor control code.
+
+All the timing in motorset, the motors, their encoders and motoranalyser uses a clock object rather than calling the time module, so
+that a wall clock step (from NTP for example) cannot upset the measured intervals, and so simulations can run faster than real time.
+
+A clock has a single method, time(), that returns the time in seconds as a float.
+
+motorset makes a monotonicclock unless a clock is given (as the 'clock' service - see motorset.needservice), and the motors and
+encoders use the motorset's clock.
+"""
+import time
+
+class monotonicclock():
+    """
+    a clock that never goes backwards or jumps, based on time.monotonic_ns.
+
+    It is anchored to the wall clock when it is made, so its times look like time.time() values (and the log timestamps are
+    readable), but after that it ignores any changes to the wall clock.
+    """
+    def __init__(self):
+        self.offset=time.time()-time.monotonic_ns()/1000000000
+
+    def time(self):
+        return time.monotonic_ns()/1000000000+self.offset
+
+class virtualclock():
+    """
+    a clock that only moves when it is told to, for simulations and tests
+    """
+    def __init__(self, start=0):
+        self.now=start
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now+=seconds
+
+    def set(self, now):
+        self.now=now
@@ -34,7 +34,14 @@ The motor and motoranalyse classes:
 Standard parameters:
     className: These strings identify a class, typically as <modulename>.<classname>. The class constructor is then called 
     using everything else in the dict as keyword parameters. Other parameters can be supplied by position or keyword. 
+
+quadmonitor is the matching motorset quadmonitor param (see quadfast.quadfastwrapper), for the fastencoder rotationsense used
+below, for example motorset.motorset(motordefs=config_h_bridge.motordef, quadmonitor=config_h_bridge.quadmonitor). With
+watchdogms set, the quad monitor also sets pwm to zero on the motors' pinf and pinb if the motorset ticker stops running for
+that long.
 """
+quadmonitor={'className': 'quadfast.quadfastwrapper', 'filename': '/dev/shm/quadfast', 'loglvl': 0, 'watchdogms': 250}
+
 motordef=(
     {
      'className'    : 'motoranalyser.motoranalyse',
@@ -45,14 +52,18 @@ motordef=(
 #                                               # required for and should only be used when rotationsense is class fastencoder         
 #     'rotationsense': {'className': 'quadencoder.quadencoder', 'pinss': ((17, 27)), 'edges': 'both', 'pulsesperrev':3},
                                                 # note use of 'pinss' rather than 'pins' to stop quadfast being used at motorset level
+#     'rotationsense': {'className': 'quadnotifyencoder.notifyencoder', 'pinss': (17, 27), 'ticksperrev': 12},
      'rotationsense': {'className': 'quadfastencoder.fastencoder', 'ticksperrev': 6, 'pins': (17, 27)},
      'speedmapinfo' : {'className': 'dcmotorbasic.speedmapper', 
                        'fbuilder': {'minSpeed':1500, 'maxSpeed':13000, 'minDC':20, 'maxDC':255},
                        'rbuilder': {'minSpeed':1500, 'maxSpeed':13000, 'minDC':20, 'maxDC':255}},
 #     'feedback'     : {'className': 'feedback.PIDfeedback', 'Pfact': -500, 'Ifact':0, 'Dfact':-100},
+#     'tickbudget'   : .004,                     # put off tickers above priority 0 (such as motoranalyser tests) once a tick takes 4ms
      'logtypes'     : (('phys',{'filename': 'leftlog.log',  'format': '{setting} is {newval}.'}),
                        ('life',{'filename': 'stdout'}),
                        ('logi',{'filename': 'stdout'}), ),
+#                       ('feedbacktrace', {'filename': 'lefttrace', 'sink': {'className': 'tracestore.tracesink',
+#                                'fields': tracestore.feedbacktracefields}}),     # binary trace - needs import tracestore
      },
     {
      'className'    : 'motoranalyser.motoranalyse',
@@ -7,8 +7,8 @@ Originally implemented to control motors through a pimoroni explorer phat (https
 This method using pigpio has a constant cpu load of ~10% on a raspberry pi Zero, as compared to the pimoroni module which has
 a constant cpu load of ~20%.
 """
-import logger
-import time
+import logger, clocks
+import time, heapq, itertools, operator
 
 class motor(logger.logger):
     """
@@ -48,7 +48,8 @@ class motor(logger.logger):
     """
     physlogso=('phys', {'filename': 'stdout', 'format': '{setting} is {newval}.'})
 
-    def __init__(self, mdrive, rotationsense=None, speedmapinfo=None, feedback=None, **kwargs):
+    def __init__(self, mdrive, rotationsense=None, speedmapinfo=None, feedback=None, tickbudget=None, criticalpriority=0, maxdeferrals=10,
+                clock=None, **kwargs):
         """
         Initialises a single motor, low level interfacing is handled by the driver specified in mdrive
 
@@ -61,6 +62,18 @@ class motor(logger.logger):
         feedback        : optional params for feedback control - optional and (for this class) only allowed if rotationsense or quadsenspins
                           also specified
 
+        tickbudget      : if not None, the time in seconds each call of ticker should take. The position read and feedback always run,
+                          but once the budget is used, tickers (see addTicker, including the long action - see startlongact) with a
+                          priority above criticalpriority are put off to the next tick. When the motor is in a motorset the budget
+                          is measured from the start of the motorset's tick, so it covers all the motors (see motorset tickbudget).
+
+        criticalpriority: tickers with this priority or lower are never put off
+
+        maxdeferrals    : a ticker that has been put off this many ticks in a row runs anyway, so low priority tickers are not starved
+
+        clock           : the clock (see clocks.py) for the motor and its sensors to use. If None the parent's 'clock' service is
+                          used, or a new clocks.monotonicclock if there is no parent.
+
         **kwargs    : allows other arbitrary keyword parameters to be ignored / passed to the super class.
         
         self.motorforward is the last direction the motor was driven. It helps the feedback keep track of the motors position.
@@ -68,7 +81,16 @@ class motor(logger.logger):
 
         """
         super().__init__(createlogmsg=False, **kwargs)
-        self.tickacts=[] # a list of all the things that need to happen each tick - see addTicker below
+        if not clock is None:
+            self.clock=clock
+        elif self.parent is None:
+            self.clock=clocks.monotonicclock()
+        else:
+            self.clock=self.needservice(sname='clock', className='clocks.monotonicclock')
+        self.tickacts=[]                # heap of the things that need to happen on future ticks - see addTicker below
+        self.tickentries={}             # the active tickacts entries by tickID
+        self.tickcount=0                # number of calls to ticker so far
+        self.tickseq=itertools.count()  # tie breaker for tickacts entries due on the same tick with the same priority
         self.mdrive=logger.makeClassInstance(parent=self, **mdrive)
         if rotationsense is None:
             self.motorpos=None
@@ -79,9 +101,16 @@ class motor(logger.logger):
         self.motorforward=True
         self.speedmap=None if speedmapinfo is None else logger.makeClassInstance(invert=self.mdrive.invert(None), **speedmapinfo)
         self.currSpeed=0
-        self.feedbackcontrol=None if feedback is None or (self.postick is None and self.fastpos is None) else logger.makeClassInstance(timenow=time.time(), **feedback)
+        self.feedbackcontrol=None if feedback is None or (self.postick is None and self.fastpos is None) else logger.makeClassInstance(timenow=self.clock.time(), **feedback)
         self.targSpeed=None
+        self.lasterror=0                # last feedback error in revs - see ticker
+        self.tickstats={}               # time used in the ticker by each part, see tickerStats
+        self.tickdeferrals={}           # number of times each ticker has been put off because the tickbudget was used up
+        self.tickbudget=tickbudget
+        self.criticalpriority=criticalpriority
+        self.maxdeferrals=maxdeferrals
         self.longactfunc=None
+        self.longactstate=None
         self.logCreate()
         self.stop()
 
@@ -100,10 +129,10 @@ class motor(logger.logger):
             speedmsg='no speed mapping'
         else:
             speedmsg='speed mapping using a' + type(self.speedmap).__name__
-        if len(self.tickacts)==0:
+        if len(self.tickentries)==0:
             tamsg='no tickacts set'
         else:
-            tamsg='%d tickacts set' % len(self.tickacts)
+            tamsg='%d tickacts set' % len(self.tickentries)
         self.log(ltype='life', otype=type(self).__name__, lifemsg='created motor with %s, %s and %s.' % (posmsg, speedmsg, tamsg))
 
     def logClose(self):
@@ -139,6 +168,14 @@ class motor(logger.logger):
                 return 42 # TODO - how do we track speed now?
         return 60*(self.motorpos.lastmotorpos-self.motorpos.prevmotorpos)/self.motorpos.lasttallyinterval
 
+    def lastErrorRPM(self):
+        """
+        returns the feedback error (actual less target speed) at the last tick in rpm, or None if not under feedback control
+        """
+        if self.targSpeed is None or self.motorpos is None or self.motorpos.lasttallyinterval == 0:
+            return None
+        return 60*self.lasterror/self.motorpos.lasttallyinterval
+
     def invert(self, invert):
         """
         returns and optionally sets the flag that controls which way the motor turns for +ve values of dutycycle.
@@ -150,7 +187,8 @@ class motor(logger.logger):
         oldiv = self.mdrive.invert(None)
         newiv=self.mdrive.invert(invert)
         if newiv != oldiv:
-            self.log(ltype='phys', setting='invert', newval=newiv)
+            if 'phys' in self.logon:
+                self.log(ltype='phys', setting='invert', newval=newiv)
             if not self.speedmap is None:
                 self.speedmap.setInvert(newiv)
         return newiv
@@ -177,7 +215,8 @@ class motor(logger.logger):
         appliedval=self.mdrive.DC(dutycycle)
         if appliedval != 0:
             self.motorforward=appliedval > 0
-        self.log(ltype='phys', setting='dutycycle', newval=abs(appliedval))
+        if 'phys' in self.logon:
+            self.log(ltype='phys', setting='dutycycle', newval=abs(appliedval))
         return appliedval
 
     def frequency(self, frequency):
@@ -191,7 +230,7 @@ class motor(logger.logger):
         returns the current frequency
         """
         nf = self.mdrive.frequency(frequency)
-        if not frequency is None:
+        if not frequency is None and 'phys' in self.logon:
             self.log(ltype='phys', setting='frequency', newval=nf)
         return nf
 
@@ -225,7 +264,8 @@ class motor(logger.logger):
         if not speed is None:
             fr, dc, appliedspeed =self.speedmap.speedToFDC(speed)
             self.currSpeed=-appliedspeed if speed < 0 else appliedspeed
-            self.log(ltype='phys', setting='speed', newval=self.currSpeed)
+            if 'phys' in self.logon:
+                self.log(ltype='phys', setting='speed', newval=self.currSpeed)
             self.frequency(fr)
             self.DC(-dc if speed < 0 else dc)
         return self.currSpeed
@@ -254,9 +294,7 @@ class motor(logger.logger):
         if self.targSpeed is None:
             self.feedbackcontrol.reset(self.motorpos.lasttallytime,0)
             facts=self.feedbackcontrol.factors()
-            self.fbtrace={'motor': self.name, 'ltype': 'feedbacktrace', 'runid':time.time(), 'Pf':facts[0], 'If':facts[1], 'Df':facts[2],
-                     'tstamp':0, 'targetSpeed':0, 'speed':0, 'tallyinterval':0, 'motorpos':0, 'error':0, 'adjust':0,
-                     'expectchange':0, 'actualchange':0}
+            self.fbtrace=feedbacksample(motor=self.name, ltype='feedbacktrace', runid=time.time(), Pf=facts[0], If=facts[1], Df=facts[2])
             self.targSpeed=0
         clampedspeed=self.speedmap.speedClamp(speed)
         if self.targSpeed==0:             # just set speed to (hopefully!) something near the right value.
@@ -266,7 +304,8 @@ class motor(logger.logger):
             speedchange=clampedspeed-self.targSpeed
             self.speed(self.currSpeed+speedchange)
             self.targSpeed=clampedspeed
-        self.log(ltype='logi', setting='targetSpeed', newval=self.targSpeed)
+        if 'logi' in self.logon:
+            self.log(ltype='logi', setting='targetSpeed', newval=self.targSpeed)
         return self.targSpeed
 
     def addTicker(self, tickgen, tickID, ticktick, priority):
@@ -277,7 +316,10 @@ class motor(logger.logger):
         the code easier to understand and the invocation much more efficient. Also the generator can gracefully exit
         when complete.
         
-        The list (which is ordered) is processed in sequence each tick.
+        The tickers are held in a heap ordered by the tick they are next due on then priority, so each tick only the tickers that
+        are due are touched. Tickers can be added and removed at any time, including from within a running ticker; a ticker added
+        during a tick is first run on a later tick. A ticker that finishes, or raises an exception (which is passed on to the caller
+        of ticker), is removed.
         
         tickgen  : a generator that will be called each tick (of this ticker) 
         
@@ -285,33 +327,69 @@ class motor(logger.logger):
         
         ticktick : number of top level ticks (i.e. calls of ticker below) between calls of this ticker. prime numbers are good!)
         
-        priority : the lower the number the higher up the list
+        priority : the lower the number the earlier in the tick it runs
         
-        Each entry in the list is a little dict for ease of understanding:
+        Each entry is a little dict for ease of understanding:
             'g'  : the generator we got by calling tickfunc
             'tid': the tickID
             'ttc : the tick count per tick of this ticker
-            'tc' : current countdown
+            'due': the tick count at which it next runs
             'pr' : priority of this ticker
+            'deferred': the number of ticks in a row it has been put off (see tickbudget in __init__)
+            'removed': True once the ticker has finished or been removed (it is then dropped when it reaches the top of the heap)
         """
+        if tickID in self.tickentries:
+            raise ValueError('ticker %s is already running' % str(tickID))
         ta={'g'  : tickgen,
             'tid': tickID,
             'ttc': ticktick,
-            'tc' : ticktick,
-            'pr' : priority}
-        for ti, t in enumerate(self.tickacts):
-            if t['pr'] > priority:
-                self.tickacts.insert[ti+1]
-                break
-        else:
-            #we reached the end
-            self.tickacts.append(ta)
+            'due': self.tickcount+ticktick,
+            'pr' : priority,
+            'deferred': 0,
+            'removed': False}
+        self.tickentries[tickID]=ta
+        heapq.heappush(self.tickacts, (ta['due'], priority, next(self.tickseq), ta))
         self.log(ltype='life', otype=type(self).__name__, lifemsg='added ticker %s at priority %d' % (str(tickgen), priority))
 
-    def ticker(self):
+    def startlongact(self, tickfunc, state, priority=10):
+        """
+        starts a long action - the older form of ticker used by motoranalyser's scans. tickfunc is called with the state each tick,
+        and returns the new state, or None when the action is complete. It is run as a ticker with tickID 'longact' so it is
+        accounted and put off (see tickbudget) like any other ticker. Any long action already running is replaced.
+
+        priority : the ticker priority, by default above criticalpriority so the scan can be put off when the tick is busy
+        """
+        self.removeTicker('longact')
+        self.longactfunc=tickfunc
+        self.longactstate=state
+        self.addTicker(tickgen=self._runlongact(), tickID='longact', ticktick=1, priority=priority)
+
+    def _runlongact(self):
+        while not self.longactfunc is None:
+            newstate=self.longactfunc(self.longactstate)
+            self.longactstate=newstate
+            if newstate is None:
+                self.longactfunc=None
+            else:
+                yield
+
+    def removeTicker(self, tickID):
+        """
+        stops running the ticker with the given tickID, returns True if it was running
+        """
+        ta=self.tickentries.pop(tickID, None)
+        if ta is None:
+            return False
+        ta['removed']=True
+        return True
+
+    def ticker(self, tickbegin=None):
         """
         called as a regular tick (typically 5 - 50 per second) from some higher place, this updates sensor info (if available) and
         invokes any long term (e.g. feedback, testing which run over multiple ticks) operations.
+
+        tickbegin : None, or the time.perf_counter() time the caller's tick started - the tickbudget is measured from then (see
+                    motorset.ticker)
         
         performance notes:
             original version, all motors stopped cpu load (pi zero) 14 - 15%
@@ -319,42 +397,102 @@ class motor(logger.logger):
                             making iter just return makes no noticeable difference!
                             changing tick time to .2 sec (double) makes no difference!
                             turns out it was largely the python code in pigpio supporting tally reads - 
+            benchmark.py has a suite that times this (and the other hot paths) with stand-in hardware, and can flag regressions.
         """
+        tstart=time.perf_counter()
+        if tickbegin is None:
+            tickbegin=tstart
         if not self.postick is None:
             posnow=next(self.postick)
+            tnow=time.perf_counter()
+            self._tickaccount('position', tnow-tstart)
+            tstart=tnow
             if not self.targSpeed is None:
                 mp=self.motorpos
                 expectedposchange=mp.lasttallyinterval*self.targSpeed/60
                 actualposchange  =mp.lastmotorpos-mp.prevmotorpos
                 lasterror=actualposchange-expectedposchange
+                self.lasterror=lasterror
                 adjust=self.feedbackcontrol.ticker(mp.lasttallytime, lasterror)
-                if True:
-                    self.fbtrace['tstamp']         = self.motorpos.lasttallytime
-                    self.fbtrace['targetSpeed']    = self.targSpeed
-                    self.fbtrace['speed']          = self.currSpeed
-                    self.fbtrace['tallyinterval']  = self.motorpos.lasttallyinterval
-                    self.fbtrace['motorpos']       = self.motorpos.lastmotorpos
-                    self.fbtrace['error']          = lasterror/mp.lasttallyinterval*60
-                    self.fbtrace['adjust']         = adjust
-                    self.fbtrace['expectchange']   = expectedposchange
-                    self.fbtrace['actualchange']   = actualposchange
-                    self.log(**self.fbtrace)
+                if 'feedbacktrace' in self.logon:
+                    self.fbtrace.tstamp         = self.motorpos.lasttallytime
+                    self.fbtrace.targetSpeed    = self.targSpeed
+                    self.fbtrace.speed          = self.currSpeed
+                    self.fbtrace.tallyinterval  = self.motorpos.lasttallyinterval
+                    self.fbtrace.motorpos       = self.motorpos.lastmotorpos
+                    self.fbtrace.error          = lasterror/mp.lasttallyinterval*60
+                    self.fbtrace.adjust         = adjust
+                    self.fbtrace.expectchange   = expectedposchange
+                    self.fbtrace.actualchange   = actualposchange
+                    self.logrecord(self.fbtrace if logger.logger.asyncwriter is None else self.fbtrace.asdict())
                 self.speed(self.currSpeed+adjust)
+                tnow=time.perf_counter()
+                self._tickaccount('feedback', tnow-tstart)
+                tstart=tnow
+
+        self.tickcount+=1
+        tickacts=self.tickacts
+        while tickacts and tickacts[0][0] <= self.tickcount:
+            due, pr, seq, t = heapq.heappop(tickacts)
+            if t['removed']:
+                continue
+            if not self.tickbudget is None and pr > self.criticalpriority and tstart-tickbegin > self.tickbudget \
+                    and t['deferred'] < self.maxdeferrals:
+                t['due']=self.tickcount+1
+                t['deferred']+=1
+                heapq.heappush(tickacts, (t['due'], pr, next(self.tickseq), t))
+                self.tickdeferrals[t['tid']]=self.tickdeferrals.get(t['tid'], 0)+1
+                continue
+            t['deferred']=0
+            try:
+                next(t['g'])
+                if not t['removed']:
+                    t['due']=self.tickcount+t['ttc']
+                    heapq.heappush(tickacts, (t['due'], pr, next(self.tickseq), t))
+            except StopIteration:
+                self._tickerdone(t)
+            except:
+                self._tickerdone(t)     # so the tickID can be added again
+                raise
+            tnow=time.perf_counter()
+            self._tickaccount(t['tid'], tnow-tstart)
+            tstart=tnow
+
+    def _tickerdone(self, t):
+        if self.tickentries.get(t['tid'], None) is t:
+            del self.tickentries[t['tid']]
+        t['removed']=True
+
+    def _tickaccount(self, tid, duration):
+        st=self.tickstats.get(tid, None)
+        if st is None:
+            self.tickstats[tid]=[1, duration, duration]
+        else:
+            st[0]+=1
+            st[1]+=duration
+            if duration > st[2]:
+                st[2]=duration
 
-        if not self.longactfunc is None: #this is legacy  and things using it should convert to tickers
-            newstate=self.longactfunc(self.longactstate)
-            if newstate==None:
-                self.longactfunc=None
-            self.longactstate=newstate
-        
-        for ti, t in enumerate(self.tickacts):
-            t['tc'] -=1
-            if t['tc']<=0:
-                try:
-                    next(t['g'])
-                except StopIteration:
-                    self.tickacts.pop(ti)
-                t['tc']=t['ttc']
+    def tickerStats(self, reset=False):
+        """
+        returns the time used in the ticker by each part, as a dict keyed by 'position' (reading the rotation sensor), 'feedback'
+        (the feedback step, including the feedback trace) and the tickID of each ticker added with addTicker ('longact' for the long
+        action, see startlongact).
+
+        Each entry is a dict with calls, total (seconds), max (seconds, longest single call), mean (seconds) and deferred (the number
+        of times the ticker was put off to a later tick because the tickbudget was used up).
+
+        reset : if True the stats are cleared after being returned
+        """
+        res={tid: {'calls': st[0], 'total': st[1], 'max': st[2], 'mean': st[1]/st[0], 'deferred': self.tickdeferrals.get(tid, 0)}
+                for tid, st in self.tickstats.items()}
+        for tid, dcount in self.tickdeferrals.items():
+            if not tid in res:
+                res[tid]={'calls': 0, 'total': 0, 'max': 0, 'mean': 0, 'deferred': dcount}
+        if reset:
+            self.tickstats={}
+            self.tickdeferrals={}
+        return res
 
     def odef(self):
         """
@@ -362,6 +500,10 @@ class motor(logger.logger):
         """
         x=super().odef()
         x.update({'mdrive': self.mdrive.odef(), 'colid': x['name']})
+        if not self.tickbudget is None:
+            x['tickbudget']=self.tickbudget
+            x['criticalpriority']=self.criticalpriority
+            x['maxdeferrals']=self.maxdeferrals
         x['mdrive']['colid']=x['name']
         if not self.motorpos is None:
             x['rotationsense']=self.motorpos.odef()
@@ -374,6 +516,55 @@ class motor(logger.logger):
             x['feedback']['colid']=x['colid']
         return x
 
+class feedbacksample():
+    """
+    The feedback trace record for a motor. It is updated in place each tick.
+
+    It can be read like a dict (params[field], params.get, keys, items and ** all work), so it is logged as it is (see
+    logger.logrecord) and log sinks and formats read the fields straight from the slots, without a dict being made each
+    tick. Only when log records are queued (see logger.startAsyncWriter) is a copy made with asdict, as the record is written
+    after it has been changed by later ticks.
+    """
+    fields=('motor', 'ltype', 'runid', 'Pf', 'If', 'Df', 'tstamp', 'targetSpeed', 'speed', 'tallyinterval', 'motorpos', 'error',
+            'adjust', 'expectchange', 'actualchange')
+    __slots__=fields
+    fieldset=frozenset(fields)
+
+    getall=operator.attrgetter(*fields)
+
+    def __init__(self, **kwargs):
+        for f in self.fields:
+            setattr(self, f, kwargs.get(f, 0))
+
+    def asdict(self):
+        return dict(zip(self.fields, self.getall(self)))
+
+    def __getitem__(self, field):
+        if not field in self.fieldset:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in self.fieldset else default
+
+    def __contains__(self, field):
+        return field in self.fieldset
+
+    def keys(self):
+        return self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def items(self):
+        return zip(self.fields, self.getall(self))
+
+    def __repr__(self):
+        return repr(self.asdict())
+
 class speedmapper():
     """
     A mapper to provide an approximately linear interface for motor speed, using whatever real world measure is appropriate.
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+"""
+A load test for a motorset run in its own process (see asprocess.py), on simulated hardware (see motorsim.py).
+
+It finds how many front end clients, and how many commands per second, the process can handle before the tick timing or the
+command response suffers. For each step of the test a new process is started, a number of client threads send commands
+(picked at random from a command mix) through a shared stub at a set rate each, and then it measures:
+
+    command round trip : from the time each command was due to be sent to the time the response arrived, so a backlog of
+                         commands shows up as longer round trips rather than a lower send rate
+    tick lateness      : how long after its due time each tick started, from the process stats (see asprocess.classrunner)
+
+The steps are run with increasing numbers of clients, and the report shows the throughput at which the SLO (the largest
+acceptable 99th percentile of each) is first broken.
+
+run with: python3 loadtest.py [--clients 1,2,4,8,16] [--rate 20] [--mix mixed] [--duration 5]
+"""
+import time, threading, random, argparse
+import asprocess, motorsim
+
+speedmap={'className': 'dcmotorbasic.speedmapper',
+          'fbuilder': {'minSpeed':1500, 'maxSpeed':13000, 'minDC':20, 'maxDC':255},
+          'rbuilder': {'minSpeed':1500, 'maxSpeed':13000, 'minDC':20, 'maxDC':255}}
+
+defaultmotordefs=(
+    {'className': 'dcmotorbasic.motor', 'name': 'left',
+     'mdrive': {'className': 'dc_h_bridge_pigpio.dc_h_bridge', 'pinf': 26, 'pinb': 21},
+     'rotationsense': {'className': 'quadfastencoder.fastencoder', 'ticksperrev': 12, 'pins': (17, 27)},
+     'speedmapinfo': speedmap,
+     'feedback': {'className': 'feedback.PIDfeedback', 'Pfact': -500, 'Ifact': 0, 'Dfact': -100}},
+    {'className': 'dcmotorbasic.motor', 'name': 'right',
+     'mdrive': {'className': 'dc_h_bridge_pigpio.dc_h_bridge', 'pinf': 20, 'pinb': 19},
+     'rotationsense': {'className': 'quadfastencoder.fastencoder', 'ticksperrev': 12, 'pins': (10, 9)},
+     'speedmapinfo': speedmap,
+     'feedback': {'className': 'feedback.PIDfeedback', 'Pfact': -500, 'Ifact': 0, 'Dfact': -100},
+     'sim': {'load': 500}},
+)
+
+commandmixes={      # method name and relative weight
+    'monitor': (('lastMotorRPM', 6), ('lastMotorPosition', 3), ('motorTickerStats', 1)),
+    'control': (('motorTargetSpeed', 5), ('lastMotorRPM', 5)),
+    'mixed'  : (('lastMotorRPM', 5), ('lastMotorPosition', 2), ('motorTargetSpeed', 2), ('motorTickerStats', 1)),
+}
+
+class loadsimset(motorsim.simmotorset):
+    """
+    a simmotorset for running under asprocess.classrunner - each tick moves the simulated world on by the wall clock time
+    since the last tick, so the simulation keeps pace with real time.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lasttick=time.monotonic()
+
+    def ticker(self):
+        tnow=time.monotonic()
+        self.world.step(tnow-self.lasttick)
+        self.lasttick=tnow
+        super().ticker()
+
+class motorsetstub(asprocess.runAsProcess):
+    """
+    the stub for a motorset in its own process, with the methods used by the load test.
+
+    runOnProc is not thread safe, so calls from several threads are serialised with a lock.
+    """
+    def __init__(self, **kwargs):
+        self.lock=threading.Lock()
+        super().__init__(**kwargs)
+
+    def call(self, method, **kwargs):
+        with self.lock:
+            return self.runOnProc(method, 's', **kwargs)
+
+    def lastMotorRPM(self, mlist=None):
+        return self.call('lastMotorRPM', mlist=mlist)
+
+    def lastMotorPosition(self, mlist=None):
+        return self.call('lastMotorPosition', mlist=mlist)
+
+    def motorTargetSpeed(self, tspeed, mlist=None):
+        return self.call('motorTargetSpeed', tspeed=tspeed, mlist=mlist)
+
+    def motorTickerStats(self, reset=False, mlist=None):
+        return self.call('motorTickerStats', reset=reset, mlist=mlist)
+
+    def stopMotor(self, mlist=None):
+        return self.call('stopMotor', mlist=mlist)
+
+    def getProcessStats(self, **kwargs):
+        with self.lock:
+            return super().getProcessStats(**kwargs)
+
+    def close(self):
+        with self.lock:
+            self.runOnProc(None, 'e')
+
+def commandargs(method, rng, mnames):
+    """
+    returns the keyword args for a command in the mix
+    """
+    if method=='motorTargetSpeed':
+        return {'tspeed': rng.choice((3000, 4000, 5000, 6000)), 'mlist': rng.choice(mnames)}
+    return {}
+
+def client(stub, mix, rate, startat, endat, mnames, seed, rtts):
+    """
+    the body of a client thread: sends commands from the mix at rate per second from startat until endat, appending the
+    round trip times to rtts
+    """
+    rng=random.Random(seed)
+    methods=[m for m, w in mix]
+    weights=[w for m, w in mix]
+    interval=1/rate
+    dueat=startat+rng.random()*interval
+    while dueat < endat:
+        wait=dueat-time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        method=rng.choices(methods, weights)[0]
+        getattr(stub, method)(**commandargs(method, rng, mnames))
+        rtts.append(time.monotonic()-dueat)
+        dueat+=interval
+
+def percentile(values, q):
+    """
+    returns the q (0 - 1) percentile of a sorted list (nearest rank), None if it is empty
+    """
+    if not values:
+        return None
+    return values[min(len(values)-1, max(0, int(round(q*len(values)))-1))]
+
+def runstep(clients, rate, mix='mixed', duration=5, ticktime=.05, motordefs=defaultmotordefs, settle=1):
+    """
+    runs a single step of the load test in a new process, returns a dict of the results:
+        'clients', 'rate'  : the parameters
+        'offered'          : commands per second the clients tried to send
+        'throughput'       : commands per second completed
+        'rtt'              : dict with count and p50, p90, p99 and max round trip (seconds)
+        'ticklateness'     : the process' tick lateness summary (see metrics.histogram.summary)
+        'tickduration'     : the process' tick duration summary
+        'ticks'            : ticks run in the process
+
+    settle is the time the motors are given to get up to speed before the clients start. The process stats only cover the
+    time the clients run, so the process start up and the settle time are left out.
+    """
+    stub=motorsetstub(wrappedClassName='loadtest.loadsimset', ticktime=ticktime, locallogging={'logtypes': ()},
+            motordefs=motordefs, quadmonitor=True, metricsport=0)   # metrics on (any free port) for the tick timings
+    try:
+        mnames=[md['name'] for md in motordefs]
+        stub.motorTargetSpeed(4000)
+        time.sleep(settle)
+        rtts=[]
+        startat=time.monotonic()+.1
+        endat=startat+duration
+        threads=[threading.Thread(target=client, name='loadclient%d' % c,
+                args=(stub, commandmixes[mix], rate, startat, endat, mnames, c, rtts)) for c in range(clients)]
+        for t in threads:
+            t.start()
+        wait=startat-time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        stub.getProcessStats(mark=True)
+        for t in threads:
+            t.join()
+        elapsed=time.monotonic()-startat
+        pstats=stub.getProcessStats(sincemark=True)
+        stub.stopMotor()
+    finally:
+        stub.close()
+    rtts.sort()
+    return {'clients': clients, 'rate': rate, 'offered': clients*rate, 'throughput': len(rtts)/elapsed,
+            'rtt': {'count': len(rtts), 'p50': percentile(rtts, .5), 'p90': percentile(rtts, .9), 'p99': percentile(rtts, .99),
+                    'max': rtts[-1] if rtts else None},
+            'ticklateness': pstats['ticklateness'], 'tickduration': pstats['tickduration'], 'ticks': pstats['ticks']}
+
+def sloresult(step, rttslo, latenessslo):
+    """
+    returns a list of the parts of the SLO broken by a step's results (empty if it was met)
+    """
+    broken=[]
+    if step['rtt']['p99'] is None or step['rtt']['p99'] > rttslo:
+        broken.append('round trip p99')
+    lp99=step['ticklateness']['p99']
+    if not lp99 is None and lp99 > latenessslo:
+        broken.append('tick lateness p99')
+    return broken
+
+def runloadtest(clientcounts=(1, 2, 4, 8, 16), rate=20, mix='mixed', duration=5, ticktime=.05, rttslo=.05, latenessslo=.01,
+        stoponbreak=True, report=print):
+    """
+    runs a step for each number of clients, and returns a dict:
+        'steps'     : the results of each step (see runstep) with 'broken' added - the parts of the SLO it broke
+        'maxgood'   : the throughput (commands per second) of the busiest step that met the SLO, None if none did
+        'breaksat'  : the offered load (commands per second) of the first step that broke the SLO, None if none did
+
+    rttslo      : the largest acceptable 99th percentile round trip (seconds)
+
+    latenessslo : the largest acceptable 99th percentile tick lateness (seconds)
+
+    stoponbreak : if True no more steps are run once the SLO is broken
+
+    report      : if not None, called with a line of text as each step completes
+    """
+    steps=[]
+    maxgood=None
+    breaksat=None
+    if not report is None:
+        report('%7s %8s %10s %9s %9s %9s %9s %9s  %s' % ('clients', 'offered', 'throughput', 'rtt p50', 'rtt p90', 'rtt p99',
+                'late p50', 'late p99', 'SLO'))
+    for clients in clientcounts:
+        step=runstep(clients, rate, mix=mix, duration=duration, ticktime=ticktime)
+        step['broken']=sloresult(step, rttslo, latenessslo)
+        steps.append(step)
+        if not report is None:
+            ms=lambda v: '%7.2fms' % (v*1000) if not v is None else '%9s' % '-'
+            report('%7d %8.1f %10.1f %s %s %s %s %s  %s' % (clients, step['offered'], step['throughput'], ms(step['rtt']['p50']),
+                    ms(step['rtt']['p90']), ms(step['rtt']['p99']), ms(step['ticklateness']['p50']),
+                    ms(step['ticklateness']['p99']), ', '.join(step['broken']) if step['broken'] else 'ok'))
+        if step['broken']:
+            if breaksat is None:
+                breaksat=step['offered']
+            if stoponbreak:
+                break
+        elif breaksat is None:
+            maxgood=step['throughput']
+    return {'steps': steps, 'maxgood': maxgood, 'breaksat': breaksat}
+
+if __name__ == '__main__':
+    clparse=argparse.ArgumentParser(description='load test for a motorset run in its own process on simulated hardware')
+    clparse.add_argument('--clients', default='1,2,4,8,16', help='comma separated numbers of clients for each step')
+    clparse.add_argument('--rate', type=float, default=20, help='commands per second sent by each client')
+    clparse.add_argument('--mix', default='mixed', choices=sorted(commandmixes), help='the command mix')
+    clparse.add_argument('--duration', type=float, default=5, help='seconds each step runs for')
+    clparse.add_argument('--ticktime', type=float, default=.05, help='the motorset tick interval (seconds)')
+    clparse.add_argument('--rttslo', type=float, default=.05, help='largest acceptable round trip p99 (seconds)')
+    clparse.add_argument('--latenessslo', type=float, default=.01, help='largest acceptable tick lateness p99 (seconds)')
+    clparse.add_argument('--all', action='store_true', help='run all the steps, even after the SLO is broken')
+    args=clparse.parse_args()
+    res=runloadtest(clientcounts=[int(c) for c in args.clients.split(',')], rate=args.rate, mix=args.mix, duration=args.duration,
+            ticktime=args.ticktime, rttslo=args.rttslo, latenessslo=args.latenessslo, stoponbreak=not args.all)
+    if res['breaksat'] is None:
+        print('SLO met at all loads tested, up to %.1f commands per second' % res['maxgood'])
+    elif res['maxgood'] is None:
+        print('SLO broken at the lowest load tested (%.1f commands per second offered)' % res['breaksat'])
+    else:
+        print('SLO met up to %.1f commands per second, broken at %.1f offered' % (res['maxgood'], res['breaksat']))
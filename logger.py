@@ -1,13 +1,39 @@
 #!/usr/bin/python3
 
-import time, sys
+import time, sys, threading, atexit, string, os, glob, gzip, shutil
+from collections import deque
+from datetime import datetime
 
 class logger():
     """
     A base class for named objects where state changes can be logged, with easy control over what is and isn't logged
     log files are held as a universal list 
+
+    If an asynclogwriter has been started (see startAsyncWriter below), log entries are queued and formatted / written by the
+    writer's thread, otherwise they are written immediately.
+
+    A log entry's settings can include 'sink' - a dict with className and parameters for a class that takes the records instead
+    of a text file (e.g. tracestore.tracesink). The sink is made when first used, and is passed filename and append as well as
+    the parameters in the dict. It must provide writerecord(name, params, tnow), flush and close methods and a closed attribute.
+
+    self.logon is the set of ltypes that have at least 1 log entry. Where a log call is on a busy path, check the ltype is in
+    self.logon before building the parameters, so a disabled ltype costs no more than a set lookup.
+
+    The formatting for each log entry is prepared once (in addLog), and the time fields (H, M, S) are only worked out for
+    entries that use them.
+
+    A text log entry with 'maxbytes' and / or 'maxage' in its settings is written through a rotatingfile, which starts a new
+    segment when the current one gets too big or too old. 'keep' (default 5) sets how many closed segments are kept, and if
+    'compress' is True closed segments are gzipped in the background.
+
+    logfiles, and the files in it, are shared by all loggers and the asynclogwriter's thread, so they are only used while holding
+    filelock. A file is only truncated the first time it is opened, if it is opened again (say a record for it arrives after it
+    has been closed) it is appended to.
     """
     logfiles={}
+    filelock=threading.RLock()
+    opened=set()            # the names of all the files opened so far
+    asyncwriter=None
     logheader='{M:02d}:{S:05.2f} {name:10s}: '
     lifelogso = ('life', {'filename': 'stdout', 'format': 'instance of {otype} {lifemsg}'})
 
@@ -25,6 +51,7 @@ class logger():
         self.name=name
         self.parent=parent
         self.logentries={}
+        self.logon=set()
         if not logtypes is None:
             for lte in logtypes:
                 self.addLog(lte[0], **lte[1])
@@ -35,16 +62,53 @@ class logger():
         fn=kwargs['filename']
         if fn.casefold()=='stdout' and not fn=='stdout':
             raise ValueError('stdout must be lower case')
-        if not fn in logger.logfiles:
-            if fn=='stdout':
-                logger.logfiles[fn]=sys.stdout
-            elif 'header' in kwargs:
-                logger.logfiles[fn].write(kwargs['header'])
-                logger.logfiles[fn].write('\n')
+        with logger.filelock:
+            if not fn in logger.logfiles:
+                if fn=='stdout':
+                    logger.logfiles[fn]=sys.stdout
+                elif 'header' in kwargs:
+                    logger.logfiles[fn].write(kwargs['header'])
+                    logger.logfiles[fn].write('\n')
+        kwargs['_fmt']=logger.compileentry(kwargs)
         if not ltype in self.logentries:
             self.logentries[ltype]=[kwargs]
         else:
             self.logentries[ltype].append(kwargs)
+        self.logon.add(ltype)
+
+    @staticmethod
+    def compileentry(le):
+        """
+        prepares the formatting for a log entry. Returns None for sinks, otherwise a 2-tuple of a function that formats a record
+        - f(name, params, tnow) - and the string that ends each record.
+        """
+        if 'sink' in le:
+            return None
+        if 'format' in le:
+            template=le['format'] if 'noheader' in le else logger.logheader+le['format']
+        elif 'asdict' in le:
+            template=None
+        else:
+            template=logger.logheader
+        if template is None:
+            fmtrec=lambda name, params, tnow: params.__repr__()
+        else:
+            fmt=template.format
+            needtime=not {'H', 'M', 'S'}.isdisjoint(fld for lit, fld, spec, conv in string.Formatter().parse(template))
+            if needtime:
+                def fmttime(name, params, tnow):
+                    tm,ts=divmod(params.get('tstamp',tnow),60)
+                    th,tm=divmod(tm,60)
+                    return fmt(name=name,H=int(th), M=int(tm),S=ts, **params)
+                fmtbase=fmttime
+            else:
+                fmtbase=lambda name, params, tnow: fmt(name=name, **params)
+            if 'format' in le:
+                fmtrec=fmtbase
+            else:
+                fmtrec=lambda name, params, tnow: fmtbase(name, {}, params.get('tstamp',tnow)) + '\n'.join(
+                        ['%s: %s' % (k,v) for k,v in params.items()])
+        return fmtrec, '\033[K\n' if le['filename']=='stdout' else '\n'
 
     def logCreate(self):
         self.log(ltype='life', otype=type(self).__name__, lifemsg='created') #'instance {otype} {lifemsg}'
@@ -54,12 +118,16 @@ class logger():
 
     def close(self):
         self.logClose()
-        for lt,lv in self.logentries.items():
-            for le in lv:
-                fn=le['filename']
-                if fn!='stdout' and fn in logger.logfiles:
-                    logger.logfiles[fn].close()
-                    del(logger.logfiles[fn])
+        if not logger.asyncwriter is None:
+            logger.asyncwriter.flush()
+        with logger.filelock:
+            for lt,lv in self.logentries.items():
+                for le in lv:
+                    le['_closed']=True      # so records still queued for this object are dropped
+                    fn=le['filename']
+                    if fn!='stdout' and fn in logger.logfiles:
+                        logger.logfiles[fn].close()
+                        del(logger.logfiles[fn])
 
     def log(self, **params):
         """
@@ -67,25 +135,89 @@ class logger():
         """
         ltype=params['ltype']
         if ltype in self.logentries:
-            tm,ts=divmod(params.get('tstamp',time.time()),60)
-            th,tm=divmod(tm,60)
-            for le in self.logentries[ltype]:
-                if not le['filename'] in logger.logfiles:
-                    logf=open(le['filename'],'a' if 'append' in le else 'w')
-                    logger.logfiles[le['filename']]=logf
-                else:
-                    logf=logger.logfiles[le['filename']]
-                if 'format' in le:
-                    logf.write((le['format'] if 'noheader' in le else logger.logheader+le['format']).format(
-                            name=self.name,H=int(th), M=int(tm),S=ts, **params))
-                elif 'asdict' in le:
-                    logf.write(params.__repr__())
+            if logger.asyncwriter is None:
+                logger.writeentries(self.name, self.logentries[ltype], params, time.time())
+            else:
+                logger.asyncwriter.put((self.name, self.logentries[ltype], params, time.time()))
+
+    def logrecord(self, params):
+        """
+        as log, but takes the record as a dict which is used as is (rather than copied), so it must not be changed afterwards.
+
+        When log records are written immediately (no asynclogwriter) the record only has to last until this returns, and it
+        can be any object that can be read like a dict (such as dcmotorbasic.feedbacksample) which can then be reused.
+        """
+        ltype=params['ltype']
+        if ltype in self.logentries:
+            if logger.asyncwriter is None:
+                logger.writeentries(self.name, self.logentries[ltype], params, time.time())
+            else:
+                logger.asyncwriter.put((self.name, self.logentries[ltype], params, time.time()))
+
+    @staticmethod
+    def writeentries(name, entries, params, tnow):
+        """
+        formats and writes a single log record to each of the log entries given
+
+        name    : name of the object logging the record
+
+        entries : list of the log entries (dicts of settings) for the record's ltype
+
+        params  : the record's values
+
+        tnow    : time the record was logged - used if params has no tstamp
+
+        entries of a logger that has been closed are skipped.
+        """
+        with logger.filelock:
+            for le in entries:
+                if '_closed' in le:
+                    continue
+                fn=le['filename']
+                if not fn in logger.logfiles:
+                    append='append' in le or fn in logger.opened
+                    if 'sink' in le:
+                        logf=makeClassInstance(filename=fn, append=append, **le['sink'])
+                    elif 'maxbytes' in le or 'maxage' in le:
+                        logf=rotatingfile(fn, append=append, maxbytes=le.get('maxbytes', None),
+                                maxage=le.get('maxage', None), keep=le.get('keep', 5), compress=le.get('compress', False))
+                    else:
+                        logf=open(fn,'a' if append else 'w')
+                    logger.logfiles[fn]=logf
+                    logger.opened.add(fn)
                 else:
-                    logf.write(logger.logheader.format(name=self.name,H=int(th), M=int(tm),S=ts)+'\n'.join(['%s: %s' % (k,v) for k,v in params.items()]))
-                if le['filename']=='stdout':
-                    logf.write('\033[K\n')
+                    logf=logger.logfiles[fn]
+                if le['_fmt'] is None:
+                    logf.writerecord(name, params, tnow)
                 else:
-                    logf.write('\n')
+                    fmtrec, recend = le['_fmt']
+                    logf.write(fmtrec(name, params, tnow)+recend)
+
+    @staticmethod
+    def diskUsage():
+        """
+        returns a dict with the disk space in bytes used by each open log file (including any closed segments of rotating files)
+        """
+        usage={}
+        with logger.filelock:
+            files=list(logger.logfiles.items())
+        for fn, logf in files:
+            if isinstance(logf, rotatingfile):
+                usage[fn]=logf.diskusage()
+            elif fn!='stdout' and os.path.exists(fn):
+                usage[fn]=os.path.getsize(fn)
+        return usage
+
+    def logDiskUsage(self):
+        """
+        logs (as ltype 'disk') the space used by each of this object's log files
+        """
+        if 'disk' in self.logon:
+            usage=logger.diskUsage()
+            for lv in self.logentries.values():
+                for le in lv:
+                    if le['filename'] in usage:
+                        self.log(ltype='disk', logfile=le['filename'], used=usage[le['filename']])
 
     def odef(self):
         return {'name':self.name, 'className': type(self).__name__}
@@ -93,6 +225,277 @@ class logger():
     def __repr__(self):
         return '%s(**%s)' % (type(self).__name__, str(self.odef()))
 
+class rotatingfile():
+    """
+    A text file for logging that is split into segments. When the active segment (which has the given filename) gets bigger than
+    maxbytes, or older than maxage seconds, it is closed, renamed with a timestamp and a new active segment started.
+
+    Only the newest keep closed segments are kept. Closed segments can be compressed (gzip) by a background thread, the active
+    segment is never compressed, so writing to it stays cheap.
+    """
+    compressq=None      # queue of segments for the background compressor - shared by all rotating files
+    compresslock=threading.Condition()
+
+    def __init__(self, filename, append=False, maxbytes=None, maxage=None, keep=5, compress=False):
+        """
+        filename : name of the active segment
+
+        append   : if True an existing active segment is added to, otherwise it is replaced
+
+        maxbytes : size in bytes at which the active segment is closed, None for no limit
+
+        maxage   : age in seconds at which the active segment is closed, None for no limit
+
+        keep     : number of closed segments to keep
+
+        compress : if True closed segments are gzipped
+        """
+        assert not maxbytes is None or not maxage is None, 'rotatingfile needs maxbytes or maxage'
+        self.filename=filename
+        self.maxbytes=maxbytes
+        self.maxage=maxage
+        self.keep=keep
+        self.compress=compress
+        self.rotations=0
+        self.logf=open(filename, 'a' if append else 'w')
+        self.size=self.logf.tell()
+        self.opened=time.time()
+        if compress:
+            for seg in self.segments():
+                if not seg.endswith('.gz'):
+                    self.queuecompress(seg)
+
+    @property
+    def closed(self):
+        return self.logf.closed
+
+    def write(self, text):
+        self.logf.write(text)
+        self.size+=len(text)
+        if (not self.maxbytes is None and self.size >= self.maxbytes) or (
+                not self.maxage is None and time.time() > self.opened+self.maxage):
+            self.rotate()
+
+    def flush(self):
+        self.logf.flush()
+
+    def close(self):
+        self.logf.close()
+
+    def rotate(self):
+        """
+        closes the active segment and starts a new one
+        """
+        self.logf.close()
+        segname='%s.%s' % (self.filename, datetime.now().strftime('%Y%m%d-%H%M%S.%f'))
+        os.rename(self.filename, segname)
+        self.logf=open(self.filename, 'w')
+        self.size=0
+        self.opened=time.time()
+        self.rotations+=1
+        if self.compress:
+            self.queuecompress(segname)
+        else:
+            self.prune()
+
+    def segments(self):
+        """
+        returns the closed segments, oldest first
+        """
+        return sorted(glob.glob(glob.escape(self.filename)+'.[0-9]*'))
+
+    def prune(self):
+        """
+        deletes the oldest closed segments so only keep are left
+        """
+        segs=self.segments()
+        for seg in segs[:max(0, len(segs)-self.keep)]:
+            try:
+                os.remove(seg)
+            except FileNotFoundError:
+                pass
+
+    def diskusage(self):
+        """
+        returns the bytes used by the active segment and all the closed segments
+        """
+        total=self.size
+        for seg in self.segments():
+            try:
+                total+=os.path.getsize(seg)
+            except FileNotFoundError:
+                pass
+        return total
+
+    def queuecompress(self, segname):
+        with rotatingfile.compresslock:
+            if rotatingfile.compressq is None:
+                rotatingfile.compressq=deque()
+                threading.Thread(target=rotatingfile.compressor, name='logcompressor', daemon=True).start()
+            rotatingfile.compressq.append((self, segname))
+            rotatingfile.compresslock.notify()
+
+    @staticmethod
+    def compressor():
+        """
+        runs in a background thread to gzip closed segments
+        """
+        while True:
+            with rotatingfile.compresslock:
+                while not rotatingfile.compressq:
+                    rotatingfile.compresslock.wait()
+                rfile, segname=rotatingfile.compressq.popleft()
+            try:
+                with open(segname, 'rb') as segin, gzip.open(segname+'.gz', 'wb') as segout:
+                    shutil.copyfileobj(segin, segout)
+                os.remove(segname)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print('rotatingfile: failed to compress %s (%s)' % (segname, str(e)))
+            rfile.prune()
+
+class asynclogwriter():
+    """
+    Takes log records from a bounded queue and writes them from a separate thread, so slow file writes don't hold up the caller.
+
+    The thread writes whatever is in the queue once there are batchsize records waiting, or flushtime seconds after the last
+    write, and flushes the files written to after each batch.
+
+    When the queue is full new records are handled according to the overflow policy:
+        'dropoldest': the oldest queued record is discarded to make room
+        'dropnew'   : the new record is discarded
+        'block'     : the caller waits until there is room
+    """
+    overflowpolicies=('dropoldest', 'dropnew', 'block')
+
+    def __init__(self, maxqueue=1000, batchsize=50, flushtime=.5, overflow='dropoldest'):
+        """
+        maxqueue  : the most records that can be queued
+
+        batchsize : number of queued records that wakes the writer thread
+
+        flushtime : longest time in seconds a record waits in the queue before being written
+
+        overflow  : what to do when the queue is full - see above
+        """
+        assert overflow in self.overflowpolicies, 'invalid overflow policy %s' % str(overflow)
+        assert maxqueue >= batchsize > 0
+        self.maxqueue=maxqueue
+        self.batchsize=batchsize
+        self.flushtime=flushtime
+        self.overflow=overflow
+        self.queue=deque()
+        self.qlock=threading.Condition()
+        self.writing=False
+        self.running=True
+        self.queued=0
+        self.written=0
+        self.dropped=0
+        self.blocked=0
+        self.batches=0
+        self.wthread=threading.Thread(target=self.run, name='asynclogwriter', daemon=True)
+        self.wthread.start()
+
+    def put(self, record):
+        """
+        queues a record - a 4-tuple of the parameters to logger.writeentries
+        """
+        with self.qlock:
+            if len(self.queue) >= self.maxqueue:
+                if self.overflow=='dropnew':
+                    self.dropped+=1
+                    return
+                elif self.overflow=='dropoldest':
+                    self.queue.popleft()
+                    self.dropped+=1
+                else:
+                    self.blocked+=1
+                    while len(self.queue) >= self.maxqueue and self.running:
+                        self.qlock.wait()
+            self.queue.append(record)
+            self.queued+=1
+            if len(self.queue)==self.batchsize:
+                self.qlock.notify_all()
+
+    def run(self):
+        while True:
+            with self.qlock:
+                if self.running and len(self.queue) < self.batchsize:
+                    self.qlock.wait(self.flushtime)
+                if not self.queue:
+                    if not self.running:
+                        break
+                    continue
+                batch=self.queue
+                self.queue=deque()
+                self.writing=True
+                self.qlock.notify_all()
+            written=set()
+            with logger.filelock:
+                for name, entries, params, tnow in batch:
+                    try:
+                        logger.writeentries(name, entries, params, tnow)
+                    except Exception as e:
+                        print('asynclogwriter: failed to write log record for %s (%s)' % (name, str(e)))
+                    for le in entries:
+                        written.add(le['filename'])
+                for fn in written:
+                    logf=logger.logfiles.get(fn, None)
+                    if not logf is None and not logf.closed:
+                        logf.flush()
+            with self.qlock:
+                self.written+=len(batch)
+                self.batches+=1
+                self.writing=False
+                self.qlock.notify_all()
+
+    def flush(self):
+        """
+        waits until all queued records have been written
+        """
+        with self.qlock:
+            while (self.queue or self.writing) and self.wthread.is_alive():
+                self.qlock.notify_all()
+                self.qlock.wait(self.flushtime)
+
+    def close(self):
+        """
+        writes any queued records and stops the writer thread
+        """
+        with self.qlock:
+            self.running=False
+            self.qlock.notify_all()
+        self.wthread.join()
+
+    def stats(self):
+        """
+        returns a dict with counts of records queued, written and dropped, the number of times a caller was blocked and
+        the number of batches written
+        """
+        with self.qlock:
+            return {'queued': self.queued, 'written': self.written, 'dropped': self.dropped, 'blocked': self.blocked,
+                    'batches': self.batches, 'waiting': len(self.queue)}
+
+def startAsyncWriter(**kwargs):
+    """
+    starts an asynclogwriter (if one isn't already running) that all loggers then use. kwargs are passed to the asynclogwriter
+    constructor.
+    """
+    if logger.asyncwriter is None:
+        logger.asyncwriter=asynclogwriter(**kwargs)
+        atexit.register(stopAsyncWriter)
+    return logger.asyncwriter
+
+def stopAsyncWriter():
+    """
+    writes any queued records and stops the asynclogwriter. Log records are then written immediately again.
+    """
+    if not logger.asyncwriter is None:
+        aw=logger.asyncwriter
+        logger.asyncwriter=None
+        aw.close()
+
 from importlib import import_module as modimporter
 
 def makeClassInstance(className, **kwargs):
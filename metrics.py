@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+"""
+A small metrics registry (counters, gauges and fixed bucket histograms) that can be served in Prometheus text format from a
+local http endpoint.
+
+Updating a metric is a few plain attribute / list updates with no locking, so it is safe to do in the tick loop. The http server
+runs in its own thread and only reads the metrics, so it never holds up the tick loop (a scrape that races with an update
+may see the update half done, which is fine for monitoring).
+"""
+import threading, bisect
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def labeltext(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items()) + '}'
+
+class counter():
+    """
+    a value that only goes up. If func is given it is called to get the value each time the metrics are read (for counts kept
+    elsewhere).
+    """
+    mtype='counter'
+
+    def __init__(self, name, help, labels=None, func=None):
+        self.name=name
+        self.help=help
+        self.labels=labels
+        self.func=func
+        self.value=0
+
+    def inc(self, amount=1):
+        self.value+=amount
+
+    def samples(self):
+        if self.func is None:
+            v=self.value
+        else:
+            try:
+                v=self.func()
+            except Exception:
+                v=None
+        return [(self.name, self.labels, float('nan') if v is None else v)]
+
+class gauge(counter):
+    """
+    a value that can go up or down. If func is given it is called to get the value each time the metrics are read.
+    """
+    mtype='gauge'
+
+    def set(self, value):
+        self.value=value
+
+class histogram():
+    """
+    counts observations in fixed buckets, and keeps the count and sum of all observations.
+
+    buckets is a sorted list of upper bounds, an observation goes in the first bucket whose bound is >= the value, or the
+    overflow (+Inf) bucket.
+    """
+    mtype='histogram'
+    defaultbuckets=(.0001, .0002, .0005, .001, .002, .005, .01, .02, .05, .1, .2, .5, 1)
+
+    def __init__(self, name, help, labels=None, buckets=None):
+        self.name=name
+        self.help=help
+        self.labels=labels
+        self.buckets=tuple(self.defaultbuckets if buckets is None else buckets)
+        self.counts=[0]*(len(self.buckets)+1)
+        self.sum=0
+        self.count=0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)]+=1
+        self.sum+=value
+        self.count+=1
+
+    def snapshot(self):
+        """
+        returns a copy of the bucket counts, sum and count, so a later summary can cover only the observations since
+        """
+        return (list(self.counts), self.sum, self.count)
+
+    def quantile(self, q, counts=None):
+        """
+        estimates the q quantile (0 <= q <= 1) from the buckets, interpolating within the bucket. Returns None if there are no
+        observations, and the top bucket bound if the quantile is in the overflow bucket.
+
+        counts : if not None, bucket counts to use instead of this histogram's own
+        """
+        counts=list(self.counts if counts is None else counts)
+        total=sum(counts)
+        if total==0:
+            return None
+        target=q*total
+        cum=0
+        for i, c in enumerate(counts):
+            if c > 0 and cum+c >= target:
+                if i >= len(self.buckets):
+                    return self.buckets[-1]
+                lower=0 if i==0 else self.buckets[i-1]
+                return lower+(self.buckets[i]-lower)*(target-cum)/c
+            cum+=c
+        return self.buckets[-1]
+
+    def summary(self, since=None):
+        """
+        returns a dict with the count, mean and estimated 50th, 90th and 99th percentiles
+
+        since : if not None, a snapshot (see snapshot) and only the observations made after it are summarised
+        """
+        if since is None:
+            counts, total, count=self.counts, self.sum, self.count
+        else:
+            counts=[c-s for c, s in zip(self.counts, since[0])]
+            total=self.sum-since[1]
+            count=self.count-since[2]
+        return {'count': count, 'mean': total/count if count > 0 else None,
+                'p50': self.quantile(.5, counts), 'p90': self.quantile(.9, counts), 'p99': self.quantile(.99, counts)}
+
+    def samples(self):
+        counts=list(self.counts)
+        lbls=OrderedDict() if self.labels is None else OrderedDict(self.labels)
+        res=[]
+        cum=0
+        for bound, c in zip(self.buckets+('+Inf',), counts):
+            cum+=c
+            bl=lbls.copy()
+            bl['le']=bound
+            res.append((self.name+'_bucket', bl, cum))
+        res.append((self.name+'_sum', self.labels, self.sum))
+        res.append((self.name+'_count', self.labels, cum))
+        return res
+
+class registry():
+    """
+    holds a set of metrics, grouped by name (metrics with the same name must be the same type and differ only in their labels)
+    """
+    def __init__(self):
+        self.families=OrderedDict()
+
+    def add(self, metric):
+        fam=self.families.get(metric.name, None)
+        if fam is None:
+            self.families[metric.name]=[metric]
+        else:
+            assert fam[0].mtype==metric.mtype, 'metric %s is already a %s' % (metric.name, fam[0].mtype)
+            fam.append(metric)
+        return metric
+
+    def counter(self, name, help, **kwargs):
+        return self.add(counter(name, help, **kwargs))
+
+    def gauge(self, name, help, **kwargs):
+        return self.add(gauge(name, help, **kwargs))
+
+    def histogram(self, name, help, **kwargs):
+        return self.add(histogram(name, help, **kwargs))
+
+    def exposition(self):
+        """
+        returns all the metrics in Prometheus text format
+        """
+        lines=[]
+        for name, fam in list(self.families.items()):
+            lines.append('# HELP %s %s' % (name, fam[0].help))
+            lines.append('# TYPE %s %s' % (name, fam[0].mtype))
+            for m in fam:
+                for sname, labels, value in m.samples():
+                    lines.append('%s%s %s' % (sname, labeltext(labels), repr(float(value))))
+        return '\n'.join(lines)+'\n'
+
+class metricsserver():
+    """
+    serves a registry's metrics on http://<host>:<port>/metrics from a daemon thread
+    """
+    def __init__(self, reg, port, host='127.0.0.1'):
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body=reg.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server=ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads=True
+        self.port=self.server.server_address[1]
+        self.sthread=threading.Thread(target=self.server.serve_forever, name='metricsserver', daemon=True)
+        self.sthread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
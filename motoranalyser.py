@@ -21,28 +21,28 @@ class motoranalyse(dcmotorbasic.motor):
             while len(dlist) > 0:
                 # wait for stop
                 print('run', rcount, 'is', dlist[0])
-                timeout=time.time()+delay*5
+                timeout=self.clock.time()+delay*5
                 self.DC(0)
                 mp=self.motorpos
                 while mp.lasttallydiff != 0 and mp.lasttallytime < timeout:
                     yield()                
                 if mp.lasttallydiff!= 0:
                     self.analrunends('FAIL','motor failed to stop (%d)' % mp.lasttallydiff)
-                    raise StopIteration()
+                    return
                 dcval = self.maxDC()
                 if dlist[0]=='b':
                     dcval = -dcval
                 if self.invert(None):
                     dcval = -dcval
                 self.DC(dcval)
-                timeout=time.time()+delay
+                timeout=self.clock.time()+delay
                 while mp.lasttallytime < timeout:
                     yield()
                 if mp.lasttallydiff == 0:
                     self.analrunends('FAIL','motor no movement detected')
                 motorstart=mp.lasttallytime
                 tallylist=[]
-                timeout=time.time()+interval
+                timeout=self.clock.time()+interval
                 while mp.lasttallytime < timeout:
                     yield()
                     tallylist.append(mp.lasttallydiff)
@@ -101,7 +101,7 @@ class motoranalyse(dcmotorbasic.motor):
             fmstate['minDCb'] = minDCback
         fmstate['rtemplate']['frequ'] = self.frequency(frequency)
         self.DC(0)
-        fmstate['protime'] = time.time()+kwargs['delay']*10,
+        fmstate['protime'] = self.clock.time()+kwargs['delay']*10,
 
     def mapdrtick(self, fmstate):
         tnow=self.motorpos.lasttallytime
@@ -132,12 +132,15 @@ class motoranalyse(dcmotorbasic.motor):
                 else:
                     fmstate['tallylist']=[]
                     fmstate['tallystart']=tnow
+                    fmstate['posstart']=self.motorpos.lastmotorpos
                     fmstate['protime']=tnow+fmstate['interval']
                     fmstate['phase']='tallyho'
         elif fmstate['phase']=='tallyho':
             fmstate['tallylist'].append(self.motorpos.lasttallydiff)
             if tnow > fmstate['protime']:
-                tps=abs(sum(fmstate['tallylist'])/(self.motorpos.lasttallytime-fmstate['tallystart']))
+                # from the change in position, as the scan is a ticker that can be put off (see tickbudget in dcmotorbasic.motor)
+                tps=abs((self.motorpos.lastmotorpos-fmstate['posstart'])*self.motorpos.ticksperrev
+                        /(self.motorpos.lasttallytime-fmstate['tallystart']))
                 rpm=tps/self.motorpos.ticksperrev*60
                 newres=fmstate['rtemplate'].copy()
                 newres['direc']='f' if fmstate['dcchange']==1 else 'b'
@@ -176,6 +179,7 @@ class motoranalyse(dcmotorbasic.motor):
             if tnow > fmstate['protime']:
                 fmstate['tallylist']=[]
                 fmstate['tallystart']=tnow
+                fmstate['posstart']=self.motorpos.lastmotorpos
                 fmstate['protime']=tnow+fmstate['interval']
                 fmstate['phase']='tallyho'
                 
@@ -208,7 +212,7 @@ class motoranalyse(dcmotorbasic.motor):
         fmstate['phase'] = 'waitstop'
         fmstate['steps'] = speedsteps         
         self.targetSpeed(0)
-        fmstate['protime'] = time.time()+kwargs['delay']*10,
+        fmstate['protime'] = self.clock.time()+kwargs['delay']*10,
 
     def mapSpeedTick(self, fmstate):
         tnow=self.motorpos.lasttallytime
@@ -237,12 +241,15 @@ class motoranalyse(dcmotorbasic.motor):
                 else:
                     fmstate['tallylist']=[]
                     fmstate['tallystart']=tnow
+                    fmstate['posstart']=self.motorpos.lastmotorpos
                     fmstate['protime']=tnow+fmstate['interval']
                     fmstate['phase']='tallyho'
         elif fmstate['phase']=='tallyho':
             fmstate['tallylist'].append(self.motorpos.lasttallydiff)
             if tnow > fmstate['protime']:
-                tps=abs(sum(fmstate['tallylist'])/(self.motorpos.lasttallytime-fmstate['tallystart']))
+                # from the change in position, as the scan is a ticker that can be put off (see tickbudget in dcmotorbasic.motor)
+                tps=abs((self.motorpos.lastmotorpos-fmstate['posstart'])*self.motorpos.ticksperrev
+                        /(self.motorpos.lasttallytime-fmstate['tallystart']))
                 rpm=tps/self.motorpos.ticksperrev*60
                 newres=fmstate['rtemplate'].copy()
                 newres['direc']=fmstate['curdir']
@@ -283,6 +290,7 @@ class motoranalyse(dcmotorbasic.motor):
             if tnow > fmstate['protime']:
                 fmstate['tallylist']=[]
                 fmstate['tallystart']=tnow
+                fmstate['posstart']=self.motorpos.lastmotorpos
                 fmstate['protime']=tnow+fmstate['interval']
                 fmstate['phase']='tallyho'
                 
@@ -301,7 +309,7 @@ class motoranalyse(dcmotorbasic.motor):
         fmstate={
             'rtemplate' : {'motor': self.name, 'testname': testname, 'direc':'f', 'runid':time.time(),
                            'tick': tick, 'tstamp':0},
-            'protime' : time.time()+delay,
+            'protime' : self.clock.time()+delay,
             'delay'   : delay,
             'interval': interval,
             'requdir' : direction,
@@ -315,8 +323,7 @@ class motoranalyse(dcmotorbasic.motor):
             fmstate['curdir']='b'
         elif direction=='both':
             fmstate['nextdir']='b'
-        self.longactfunc=tickfunc
-        self.longactstate=fmstate
+        self.startlongact(tickfunc, fmstate)
         return fmstate
 
     def rundone(self, msg, runok):
@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 
 import time
-import logger
+import logger, clocks, calibrator
 import atexit
 from collections import OrderedDict
 import subprocess, sys
@@ -21,30 +21,63 @@ class motorset():
     string                  : (name of motor) Only the motor identified by the name is used
     tuple, list, array...   : each entry is the name of a motor, all motors named are used
     """
-    def __init__(self, motordefs=None, quadmonitor=None):
+    def __init__(self, motordefs=None, quadmonitor=None, asynclog=None, services=None, clock=None, tickbudget=None):
         """
         Sets up motors from a list of dicts, each dict defines the details of an individual motor.
+
+        asynclog is None to write log entries as they happen, or a dict of settings for logger.asynclogwriter to queue them and
+        write them from a separate thread so logging does not hold up the ticker.
         
-        quadparams is used to start a separate process that monitors 1 or more quad encoders used for feedback control.
+        quadparams is used to start a separate process that monitors 1 or more quad encoders used for feedback control. It is
+        also given the motor driver pins (motorpins) so it can stop the motors if the ticker stops being called.
+
+        services is None or a dict of shared services (see needservice) to use instead of making them - for example a simulated
+        pigpio.pi (see motorsim.py).
+
+        clock is the clock (see clocks.py) used for all timing by the motors and their sensors, None for a clocks.monotonicclock.
+        It is the shared service 'clock'.
+
+        tickbudget is None, or the time in seconds each call of ticker should take, given to each motor that does not set its own
+        (see tickbudget in dcmotorbasic.motor). The motors measure their budget from the start of the motorset's tick, so once the
+        whole tick has used the budget the remaining motors' low priority tickers are put off.
         
         see config_h_bridge.py or config_adafruit_dc_sm_hat.py for details
         """
-        self.sharedServices={}
+        self.sharedServices={} if services is None else dict(services)
+        if not clock is None:
+            self.sharedServices['clock']=clock
+        elif not 'clock' in self.sharedServices:
+            self.sharedServices['clock']=clocks.monotonicclock()
+        self.clock=self.sharedServices['clock']
         self.motors=OrderedDict()
+        self.watchdogtrips=0
+        if not asynclog is None:
+            logger.startAsyncWriter(**asynclog)
         if quadmonitor is None:
             self.quadmon=None
         else:
             qd={}
+            mpins=[]
+            uncovered=[]
             for mdef in motordefs:
                 if 'rotationsense' in mdef and 'pins' in mdef['rotationsense'] and len(mdef['rotationsense']['pins'])==2:
                     qd[mdef['name']]=mdef['rotationsense']['pins']
+                dpins=[mdef['mdrive'][pk] for pk in ('pinf', 'pinb') if pk in mdef['mdrive']]
+                if len(dpins) < 2:
+                    uncovered.append(mdef['name'])
+                mpins.extend(dpins)
             if qd:
                 print('qesetup', qd)
-                self.quadmon=logger.makeClassInstance(motorquads=qd, **quadmonitor)
+                if not quadmonitor.get('watchdogms', None) is None and uncovered:
+                    print('motorset: WARNING the watchdog cannot stop motor(s) %s - their drivers do not use gpio pins pinf and pinb'
+                            % ', '.join(uncovered))
+                self.quadmon=logger.makeClassInstance(motorquads=qd, motorpins=mpins, **quadmonitor)
             else:
                 self.quadmon=None
 
         for mdef in motordefs:
+            if not tickbudget is None and not 'tickbudget' in mdef:
+                mdef=dict(mdef, tickbudget=tickbudget)
             self.motors[mdef['name']] = logger.makeClassInstance(parent=self, **mdef)
         atexit.register(self.close)
 
@@ -127,6 +160,37 @@ class motorset():
         """
         return self._listcall(mlist, 'targetSpeed', tspeed)
 
+    def motorTickerStats(self, reset=False, mlist=None):
+        """
+        returns the time used by each part of the ticker (see motor.tickerStats) for the specified motors (see class help for mlist
+        param), plus an entry 'all' (when mlist is None) with the stats combined across the motors.
+        """
+        res=self._listcall(mlist, 'tickerStats', reset)
+        if mlist is None:
+            allst={}
+            for mstats in list(res.values()):
+                for tid, st in mstats.items():
+                    if tid in allst:
+                        ast=allst[tid]
+                        ast['calls']+=st['calls']
+                        ast['total']+=st['total']
+                        ast['max']=max(ast['max'], st['max'])
+                        ast['mean']=ast['total']/ast['calls'] if ast['calls'] > 0 else 0
+                        ast['deferred']+=st['deferred']
+                    else:
+                        allst[tid]=st.copy()
+            res['all']=allst
+        return res
+
+    def calibrate(self, test='dc', mlist=None, **kwargs):
+        """
+        starts a calibration scan on the specified motors (see class help for mlist param) all at once, and returns the
+        calibrator, which collects the results of all the motors (see calibrator.calibrator for the test and other params).
+
+        The scans run as motor tickers, so the motorset ticker must keep running until the calibrator is done.
+        """
+        return calibrator.calibrator(motors=list(self._delist(mlist)), test=test, **kwargs)
+
     def stopMotor(self, mlist=None):
         """
         stops specified motors (see class help for mlist param)
@@ -143,16 +207,56 @@ class motorset():
         time.sleep(.5)
         self.motors={}
         if not self.quadmon is None:
-            pass
-            # self.quadmon.send_signal()?
+            self.quadmon.close()
+            self.quadmon=None
+        logger.stopAsyncWriter()
 
     def ticker(self):
         """
         called at (hopefully very) regular intervals to provide feedback control for the motors
-        
+
+        It also keeps the quad monitor's watchdog happy, and if the watchdog has stopped the motors since the last tick, stops
+        them here as well so the drivers know what has happened. Feedback control is turned off as well (the target speed is
+        cleared) so the motors stay stopped until a new target speed is set.
+
+        The motors' tick budgets are measured from the start of this tick (see tickbudget in __init__).
         """
+        tickbegin=time.perf_counter()
+        if not self.quadmon is None:
+            trips=self.quadmon.heartbeat()
+            if trips != self.watchdogtrips:
+                self.watchdogtrips=trips
+                print('motorset: watchdog has stopped the motors (%d times so far)' % trips)
+                for m in self.motors.values():
+                    m.targSpeed=None
+                    m.stop()
         for m in self.motors.values():
-            m.ticker()
+            m.ticker(tickbegin)
+
+    def addMetrics(self, reg):
+        """
+        adds metrics for the motors to a metrics.registry - called by asprocess.classrunner when metrics are enabled.
+
+        The values are read from the motors when the metrics are fetched, so this adds nothing to the ticker.
+        """
+        for mname, m in self.motors.items():
+            lbl={'motor': mname}
+            reg.gauge('pimotors_motor_rpm', 'last measured speed of the motor', labels=lbl, func=m.lastRPM)
+            reg.gauge('pimotors_motor_error_rpm', 'feedback error (actual less target speed) at the last tick', labels=lbl,
+                    func=m.lastErrorRPM)
+            if not self.quadmon is None and mname in self.quadmon.nmap:
+                reg.counter('pimotors_encoder_skips_total', 'quad steps that could not be decoded', labels=lbl,
+                        func=lambda mname=mname: self.quadmon.quadskips(mname)[0])
+                reg.counter('pimotors_encoder_recovered_total', 'double quad steps recovered', labels=lbl,
+                        func=lambda mname=mname: self.quadmon.quadskips(mname)[1])
+            elif hasattr(m.motorpos, 'skipcount'):
+                reg.counter('pimotors_encoder_skips_total', 'quad steps that could not be decoded', labels=lbl,
+                        func=lambda mp=m.motorpos: mp.skipcount)
+                reg.counter('pimotors_encoder_recovered_total', 'double quad steps recovered', labels=lbl,
+                        func=lambda mp=m.motorpos: mp.recovered)
+        if not self.quadmon is None:
+            reg.counter('pimotors_watchdog_trips_total', 'times the quad monitor watchdog has stopped the motors',
+                    func=lambda: self.watchdogtrips)
 
     def odef(self):
         """
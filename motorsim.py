@@ -0,0 +1,460 @@
+#!/usr/bin/python3
+"""
+A simulator for dc motors with quadrature encoders, so motor control code can be run and benchmarked without pigpio or motor
+hardware.
+
+The simulated world (simworld) holds a first-order model of each motor (simmotor) and a virtual clock (clocks.virtualclock) that is
+advanced a step at a time, and is used by the motors and sensors, so simulations run as fast as the code allows. The world is connected to the rest of the code through the same interfaces the hardware uses:
+
+    simpi       : stands in for pigpio.pi - pwm on the motor pins drives the models, and callback().tally() on the encoder pins
+                  counts the encoder edges the models produce. Use it with dc_h_bridge_pigpio.dc_h_bridge and quadencoder.quadencoder.
+    simdrive    : a motor driver (mdrive) that drives a model directly
+    simquadfast : stands in for quadfast.quadfastwrapper (the quad encoder monitor) for use with quadfastencoder.fastencoder
+
+simmotorset is a motorset that sets all this up from ordinary motor definitions (such as those in config_h_bridge.py) and can run
+scenarios, for example:
+
+    fb={'className': 'feedback.PIDfeedback', 'Pfact': -500, 'Ifact': 0, 'Dfact': -100}
+    mdefs=[dict(md, feedback=fb, logtypes=()) for md in config_h_bridge.motordef]
+    ms=simmotorset(motordefs=mdefs, quadmonitor=True)
+    ms.motorTargetSpeed(5000)
+    ms.run(10)
+    print(ms.lastMotorRPM())
+
+(config_h_bridge has its feedback entries commented out, and uses quadfastencoder, which needs the quad monitor.)
+"""
+import time, math
+import motorset, quadfast, clocks
+
+# pigpio's edge constants - see http://abyz.me.uk/rpi/pigpio/python.html#callback
+RISING_EDGE  = 0
+FALLING_EDGE = 1
+EITHER_EDGE  = 2
+
+class simmotor():
+    """
+    A first-order model of a dc motor driven by pwm from a battery.
+
+    With duty cycle d (-1 .. 1) and the battery voltage v the motor heads for the speed
+        gain * d * v / nominalvolts  less friction and load (in the opposite direction), or 0 if friction and load are more than that
+    with time constant tau. The battery voltage sags with the current drawn by all the motors (see simworld).
+    """
+    def __init__(self, name, gain=15000, tau=.15, friction=1200, load=0, stallamps=1.5, pulsesperrev=3, encreversed=False):
+        """
+        name        : the motor name
+
+        gain        : speed (rpm) at full duty cycle and nominal voltage with no friction or load
+
+        tau         : time constant (seconds)
+
+        friction    : speed (rpm) lost to friction - the motor does not turn until the drive exceeds this
+
+        load        : speed (rpm) lost to the load on the motor - can be changed while running
+
+        stallamps   : current drawn at full duty cycle with the motor stalled (the current falls as the motor speeds up)
+
+        pulsesperrev: encoder pulses per rev on each pin (the quad position changes by 4 times this per rev)
+
+        encreversed : True if the encoder's 2 pins are wired the other way round, so the quad position counts down as the
+                      motor turns forwards
+        """
+        self.name=name
+        self.gain=gain
+        self.tau=tau
+        self.friction=friction
+        self.load=load
+        self.stallamps=stallamps
+        self.pulsesperrev=pulsesperrev
+        self.encreversed=encreversed
+        self.encsign=-1 if encreversed else 1   # sign of the quad position for positive pos - see simworld.addmotor
+        self.duty=0
+        self.rpm=0
+        self.pos=0          # revs, signed
+        self.travel=0       # revs, total in either direction - drives the single pin tally counters
+
+    def current(self):
+        if self.gain==0:
+            return 0
+        return self.stallamps*abs(self.duty)*max(0, 1-abs(self.rpm)/self.gain)
+
+    def step(self, dt, voltfactor):
+        """
+        advances the model dt seconds with the battery at voltfactor times its nominal voltage
+        """
+        drive=self.gain*self.duty*voltfactor
+        loss=self.friction+self.load
+        if abs(drive) <= loss:
+            target=0
+        else:
+            target=drive-math.copysign(loss, drive)
+        oldrpm=self.rpm
+        self.rpm=target+(oldrpm-target)*math.exp(-dt/self.tau)
+        moved=(oldrpm+self.rpm)/2*dt/60
+        self.pos+=moved
+        self.travel+=abs(moved)
+
+    def odef(self):
+        return {'gain': self.gain, 'tau': self.tau, 'friction': self.friction, 'load': self.load, 'stallamps': self.stallamps,
+                'pulsesperrev': self.pulsesperrev, 'encreversed': self.encreversed}
+
+class simworld():
+    """
+    holds the motor models, the battery and the clock, and maps gpio pins to the models
+    """
+    def __init__(self, battvolts=7.4, nominalvolts=7.4, battohms=.3, clock=None, motors=None):
+        """
+        battvolts   : the battery's voltage with no load
+
+        nominalvolts: the voltage at which the models' gain applies
+
+        battohms    : the battery's internal resistance - the voltage sags by this times the total current
+
+        clock       : the clock to advance - defaults to a new clocks.virtualclock
+
+        motors      : dict of motor name to dict of simmotor params (plus optional pinf, pinb and encpins - see addmotor)
+        """
+        self.battvolts=battvolts
+        self.nominalvolts=nominalvolts
+        self.battohms=battohms
+        self.clock=clocks.virtualclock() if clock is None else clock
+        self.motors={}
+        self.pwmpins={}     # pin -> (model, direction)
+        self.encpins={}     # pin -> (model, index of pin)
+        self.pinrange={}
+        self.pinduty={}
+        self.volts=battvolts
+        if not motors is None:
+            for mname, mparams in motors.items():
+                self.addmotor(mname, **mparams)
+
+    def addmotor(self, name, pinf=None, pinb=None, encpins=(), inverted=False, **modelparams):
+        """
+        adds a motor model (or returns the existing one with this name)
+
+        pinf, pinb : the motor driver's gpio pins - pwm on pinb drives the model forwards and on pinf backwards (see simpi)
+
+        encpins    : gpio pins with the model's encoder outputs (see simpi)
+
+        inverted   : True if the motor's driver is inverted. A driver is inverted because the motor is wired (or mounted) the
+                     other way round, so the motor runs backwards (pos decreases) for a positive duty cycle. The encoder is
+                     wired with the motor, so the quad position still counts up when the motor is driven forwards.
+        """
+        if name in self.motors:
+            return self.motors[name]
+        m=simmotor(name=name, **modelparams)
+        if inverted:
+            m.encsign=-m.encsign
+        self.motors[name]=m
+        # dc_h_bridge_pigpio.dc_h_bridge drives pinb for positive duty cycles (unless inverted)
+        if not pinb is None:
+            self.pwmpins[pinb]=(m, 1)
+        if not pinf is None:
+            self.pwmpins[pinf]=(m, -1)
+        for i, p in enumerate(encpins):
+            self.encpins[p]=(m, i)
+        return m
+
+    def time(self):
+        return self.clock.time()
+
+    def setpwm(self, pin, dutycycle):
+        """
+        called by simpi when a pwm pin's duty cycle is changed
+        """
+        self.pinduty[pin]=dutycycle
+        if pin in self.pwmpins:
+            m, direc=self.pwmpins[pin]
+            duty=0
+            for p, (pm, pd) in self.pwmpins.items():
+                if pm is m:
+                    duty+=pd*self.pinduty.get(p, 0)/self.pinrange.get(p, 255)
+            m.duty=max(-1, min(1, duty))
+
+    def pintally(self, pin, edge):
+        """
+        returns the number of edges of the given kind so far on an encoder pin
+        """
+        m, i=self.encpins[pin]
+        if edge==EITHER_EDGE:
+            return int(m.travel*m.pulsesperrev*2+i*.5)
+        return int(m.travel*m.pulsesperrev+i*.25)
+
+    def pinlevel(self, pin):
+        if pin in self.encpins:
+            m, i=self.encpins[pin]
+            return int(m.travel*m.pulsesperrev*2+i*.5) & 1
+        return 0
+
+    def step(self, dt):
+        """
+        advances the clock and all the models by dt seconds
+        """
+        amps=sum(m.current() for m in self.motors.values())
+        self.volts=max(0, self.battvolts-amps*self.battohms)
+        vf=self.volts/self.nominalvolts
+        for m in self.motors.values():
+            m.step(dt, vf)
+        self.clock.advance(dt)
+
+class simcallback():
+    """
+    stands in for the object returned by pigpio.pi.callback when no function is given - it just counts edges
+    """
+    def __init__(self, world, pin, edge):
+        self.world=world
+        self.pin=pin
+        self.edge=edge
+        self.base=world.pintally(pin, edge) if pin in world.encpins else 0
+
+    def tally(self):
+        if self.pin in self.world.encpins:
+            return self.world.pintally(self.pin, self.edge)-self.base
+        return 0
+
+    def reset_tally(self):
+        self.base+=self.tally()
+
+    def cancel(self):
+        pass
+
+class simpi():
+    """
+    stands in for pigpio.pi, with the methods used by the drivers and encoders in this project
+    """
+    connected=True
+
+    def __init__(self, world):
+        self.world=world
+        self.frequencies={}
+
+    def set_mode(self, pin, mode):
+        return 0
+
+    def set_pull_up_down(self, pin, pud):
+        return 0
+
+    def read(self, pin):
+        return self.world.pinlevel(pin)
+
+    def write(self, pin, level):
+        self.world.setpwm(pin, 255 if level else 0)
+        return 0
+
+    def callback(self, pin, edge=RISING_EDGE, func=None):
+        assert func is None, 'simpi only supports tally callbacks'
+        return simcallback(self.world, pin, edge)
+
+    def set_PWM_range(self, pin, prange):
+        self.world.pinrange[pin]=prange
+        return 0
+
+    def set_PWM_frequency(self, pin, frequency):
+        self.frequencies[pin]=frequency
+        return frequency
+
+    def get_PWM_frequency(self, pin):
+        return self.frequencies.get(pin, 800)
+
+    def set_PWM_dutycycle(self, pin, dutycycle):
+        self.world.setpwm(pin, dutycycle)
+        return 0
+
+    def get_PWM_dutycycle(self, pin):
+        return self.world.pinduty.get(pin, 0)
+
+    def stop(self):
+        pass
+
+class simdrive():
+    """
+    a motor driver (mdrive) that drives a model in the simworld directly, it has the same methods as dc_h_bridge_pigpio.dc_h_bridge
+    """
+    def __init__(self, parent, frequency=200, range=255, invert=False, **modelparams):
+        """
+        parent      : the motor - it must provide needservice, and the model used is the one with the motor's name
+
+        modelparams : params for the model if the world does not already have one for this motor (see simmotor)
+        """
+        self.world=parent.needservice(sname='simworld', className='motorsim.simworld')
+        self.model=self.world.addmotor(parent.name, inverted=invert==True, **modelparams)
+        self.range=range
+        self.isinverted=invert==True
+        self.lastdc=0
+        self.lastHz=frequency
+
+    def invert(self, invert):
+        if not invert is None and (invert==True) != self.isinverted:
+            self.isinverted=invert==True
+            self.lastdc = -self.lastdc
+        return self.isinverted
+
+    def maxDC(self):
+        return self.range
+
+    def DC(self, dutycycle):
+        dutycycle=max(-self.range, min(self.range, dutycycle))
+        self.model.duty=(-dutycycle if self.isinverted else dutycycle)/self.range
+        self.lastdc=dutycycle
+        return dutycycle
+
+    def frequency(self, frequency):
+        if not frequency is None:
+            self.lastHz=frequency
+        return self.lastHz
+
+    def stop(self):
+        self.DC(0)
+
+    def close(self):
+        self.DC(0)
+
+    def odef(self):
+        return {'className': type(self).__name__, 'frequency': self.lastHz, 'range': self.range, 'invert': self.isinverted}
+
+class simquadfast():
+    """
+    stands in for quadfast.quadfastwrapper - the quad positions are read from the models and held in a quadfast.quadshared
+    structure, as the C program would hold them in the memory mapped file.
+    """
+    def __init__(self, world, motorquads, motorpins=None, **kwargs):
+        """
+        world      : the simworld
+
+        motorquads : dict of motor name to encoder pins (as for quadfastwrapper, the pins are not used)
+
+        other quadfastwrapper params are ignored
+        """
+        self.world=world
+        self.quadinfo=quadfast.quadshared()
+        self.nmap={}
+        self.offsets=[]
+        for qent, mname in enumerate(motorquads):
+            self.nmap[mname]=qent
+            self.offsets.append(0)
+        self.quadinfo.qcount=len(self.nmap)
+        self.heartbeats=0
+
+    def _read(self, ent, mname):
+        qs=self.quadinfo.quads[ent]
+        if not qs.paused and mname in self.world.motors:
+            m=self.world.motors[mname]
+            qs.pos=int(math.floor(m.encsign*m.pos*m.pulsesperrev*4))-self.offsets[ent]
+        return qs.pos
+
+    def quadpos(self, mname):
+        ent=self.nmap.get(mname, None)
+        if ent is None:
+            return None
+        return self._read(ent, mname)
+
+    def quadskips(self, mname):
+        ent=self.nmap.get(mname, None)
+        if ent is None:
+            return None
+        qs=self.quadinfo.quads[ent]
+        return qs.skipcount, qs.recovered
+
+    def heartbeat(self):
+        self.heartbeats+=1
+        return self.quadinfo.wdog.trips
+
+    def _ents(self, mname):
+        if mname is None:
+            return [(ent, mn) for mn, ent in self.nmap.items()]
+        if not mname in self.nmap:
+            raise ValueError('%s is not a known motor name' % str(mname))
+        return [(self.nmap[mname], mname)]
+
+    def setPos(self, mname, pos):
+        for ent, mn in self._ents(mname):
+            self.quadinfo.quads[ent].paused=0
+            self.offsets[ent]=0
+            self.offsets[ent]=self._read(ent, mn)-pos
+        return 0
+
+    def resetPos(self, mname=None):
+        return self.setPos(mname, 0)
+
+    def pause(self, mname=None):
+        for ent, mn in self._ents(mname):
+            self._read(ent, mn)
+            self.quadinfo.quads[ent].paused=1
+        return 0
+
+    def resume(self, mname=None):
+        for ent, mn in self._ents(mname):
+            qs=self.quadinfo.quads[ent]
+            if qs.paused:
+                held=qs.pos
+                qs.paused=0
+                self.offsets[ent]=0
+                self.offsets[ent]=self._read(ent, mn)-held
+        return 0
+
+    def commandLatency(self):
+        return {'count': 0, 'fails': 0}
+
+    def close(self):
+        pass
+
+class simmotorset(motorset.motorset):
+    """
+    a motorset running on simulated hardware.
+
+    The motor definitions are used as they are: the simworld gets a model for each motor, wired to the motor's driver pins
+    (mdrive pinf and pinb) and encoder pins (rotationsense pins or pinss), with the params from the optional 'sim' entry of
+    the motor definition (see simmotor). pigpio.pi is replaced by simpi, and if quadmonitor is True, quadfast by simquadfast.
+    The world's clock is the motorset's clock.
+    """
+    def __init__(self, motordefs, world=None, quadmonitor=False, **kwargs):
+        """
+        motordefs  : list of motor definitions as for motorset - 'sim' entries are removed before they are passed on
+
+        world      : None or dict of params for the simworld
+
+        quadmonitor: True to use simquadfast for motors whose rotationsense has 'pins'
+
+        kwargs     : passed on to motorset
+        """
+        self.world=simworld(**({} if world is None else world))
+        mdefs=[]
+        for mdef in motordefs:
+            mdef=dict(mdef)
+            simparams=dict(mdef.pop('sim', {}))
+            drv=mdef['mdrive']
+            rs=mdef.get('rotationsense', {})
+            encpins=rs.get('pins', rs.get('pinss', ()))
+            if 'pulsesperrev' in rs and not 'pulsesperrev' in simparams:
+                simparams['pulsesperrev']=rs['pulsesperrev']
+            elif 'ticksperrev' in rs and not 'pulsesperrev' in simparams:
+                simparams['pulsesperrev']=rs['ticksperrev']/4
+            self.world.addmotor(mdef['name'], pinf=drv.get('pinf', None), pinb=drv.get('pinb', None), encpins=encpins,
+                    inverted=drv.get('invert', False)==True, **simparams)
+            mdefs.append(mdef)
+        qm={'className': 'motorsim.simquadfast', 'world': self.world} if quadmonitor else None
+        super().__init__(motordefs=mdefs, quadmonitor=qm, clock=self.world.clock,
+                services={'simworld': self.world, 'piggy': simpi(self.world)}, **kwargs)
+
+    def run(self, duration, ticktime=.05, realtime=False, ontick=None):
+        """
+        runs the simulation for duration (simulated) seconds, stepping the world by ticktime then calling ticker.
+
+        realtime: if True each tick waits for ticktime to pass on the wall clock, otherwise the simulation runs as fast as it can
+
+        ontick  : if not None, called with this motorset after each tick
+
+        returns the number of ticks run
+        """
+        ticks=int(round(duration/ticktime))
+        nexttick=time.monotonic()
+        for i in range(ticks):
+            if realtime:
+                nexttick+=ticktime
+                wait=nexttick-time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            self.world.step(ticktime)
+            self.ticker()
+            if not ontick is None:
+                ontick(self)
+        return ticks
@@ -0,0 +1,341 @@
+// A benchmark for the quad encoder decoder in quadfeedback.c that runs without pigpio, so it can be run on any linux box.
+//
+// The decoder is fed from an edge source instead of pigpio callbacks. There are 2 sources:
+//     a generator that makes the edges of an encoder turning at a given number of edges per second with some jitter on the
+//         edge timing. The edges are then sampled in the way the pigpio daemon samples the gpio pins (every 5 microseconds by
+//         default), so edges on both pins that fall in the same sample are reported with the same tick.
+//     a trace file with one edge per line: "<tick in microseconds> <pin - 0 for A, 1 for B> <level>". A line "#truepos <n>" sets
+//         the expected final position so decode errors can be reported. A line "#startquad <n>" sets the quad position (pin A
+//         level * 2 + pin B level) before the first edge, otherwise each pin starts at the opposite of the level of its first
+//         edge (and a pin with no edges starts as in quad position 1).
+//
+// For each rate (or the trace file) it reports the edges processed per second of cpu, the cpu load that rate would cause,
+// the skipcount, the number of recovered 2 quad skips and the difference between the decoded and the true position. The cpu figures are for the decoder only, they
+// do not include the cost of pigpio delivering the callbacks.
+//
+// gcc -Wall -O2 -o quadbench quadbench.c -lrt
+//
+// Example: ./quadbench -r1000 -r10000 -r100000 -j20 -s5 -t2
+//
+#define QUADBENCH
+#include "quadfeedback.c"
+
+struct edgeevent {      // a single edge as pigpio would report it
+    uint32_t tick;
+    unsigned pin;
+    unsigned level;
+};
+
+struct edgelist {       // the edges from a source
+    struct edgeevent* events;
+    long count;
+    long size;
+    long truepos;       // where the encoder really ended up, if known
+    int trueposknown;
+    unsigned startquad; // quad position before the first edge
+    double duration;    // time covered by the events in seconds
+};
+
+struct edgesource {     // a pluggable source of edges, fill loads all the edges into an edgelist
+    const char* name;
+    int (*fill)(struct edgesource* src, struct edgelist* edges);
+    double rate;        // for the generator: edges per second
+    double jitter;      // for the generator: jitter as percentage of the interval between edges
+    double samplet;     // for the generator: pigpio sample period in seconds
+    double seconds;     // for the generator: length of run in seconds
+    char* filename;     // for the trace reader
+};
+
+void addedge(struct edgelist* edges, uint32_t tick, unsigned pin, unsigned level) {
+    if (edges->count >= edges->size) {
+        edges->size = edges->size==0 ? 4096 : edges->size * 2;
+        edges->events = realloc(edges->events, sizeof(struct edgeevent) * edges->size);
+        if (edges->events == NULL) {
+            printf("addedge: out of memory\n");
+            exit(EXIT_FAILURE);
+        }
+    }
+    edges->events[edges->count].tick=tick;
+    edges->events[edges->count].pin=pin;
+    edges->events[edges->count].level=level;
+    edges->count++;
+}
+
+int generatorfill(struct edgesource* src, struct edgelist* edges) {
+    // makes the edges of an encoder turning forwards at a steady rate. Each quad step toggles 1 pin, following the sequence 1,3,2,0
+    // Toggles are collected per pigpio sample, and only pins that have changed level by the end of the sample are reported.
+    static const unsigned fwdseq[4] = {1, 3, 2, 0};
+    double interval = 1.0 / src->rate;
+    long nedges = (long)(src->rate * src->seconds);
+    unsigned state = fwdseq[0];
+    unsigned reported = state;
+    long sample = 0;
+    for (long count=1; count <= nedges; count++) {
+        double jit = src->jitter / 100.0 * interval * ((double)rand() / RAND_MAX - 0.5);
+        long esample = (long)((count * interval + jit) / src->samplet) + 1;
+        if (esample < sample) {
+            esample = sample;  // jitter can't move an edge before one already reported
+        }
+        if (esample != sample) {
+            for (unsigned pin=0; pin < 2; pin++) {
+                unsigned mask = pin==0 ? 2 : 1;
+                if (((state ^ reported) & mask) != 0) {
+                    addedge(edges, (uint32_t)(sample * src->samplet * 1000000), pin, (state & mask) != 0);
+                }
+            }
+            reported = state;
+            sample = esample;
+        }
+        state = fwdseq[count & 3];
+    }
+    for (unsigned pin=0; pin < 2; pin++) {
+        unsigned mask = pin==0 ? 2 : 1;
+        if (((state ^ reported) & mask) != 0) {
+            addedge(edges, (uint32_t)(sample * src->samplet * 1000000), pin, (state & mask) != 0);
+        }
+    }
+    edges->truepos = nedges;
+    edges->trueposknown = 1;
+    edges->startquad = fwdseq[0];
+    edges->duration = src->seconds;
+    return 0;
+}
+
+int tracefill(struct edgesource* src, struct edgelist* edges) {
+    // reads edges from a trace file
+    FILE* tf = fopen(src->filename, "r");
+    if (tf == NULL) {
+        printf("Could not open trace file %s\n", src->filename);
+        return -1;
+    }
+    char line[120];
+    unsigned long tick;
+    unsigned pin, level;
+    long truepos;
+    unsigned startquad;
+    int startknown = 0;
+    while (fgets(line, sizeof(line), tf) != NULL) {
+        if (sscanf(line, "#truepos %ld", &truepos) == 1) {
+            edges->truepos = truepos;
+            edges->trueposknown = 1;
+        } else if (sscanf(line, "#startquad %u", &startquad) == 1) {
+            edges->startquad = startquad & 3;
+            startknown = 1;
+        } else if (sscanf(line, "%lu %u %u", &tick, &pin, &level) == 3) {
+            addedge(edges, (uint32_t)tick, pin & 1, level & 1);
+        }
+    }
+    fclose(tf);
+    if (!startknown) {
+        edges->startquad = 1;
+        for (unsigned pin=0; pin < 2; pin++) {
+            unsigned mask = pin==0 ? 2 : 1;
+            for (long count=0; count < edges->count; count++) {
+                if (edges->events[count].pin == pin) {
+                    edges->startquad = edges->events[count].level ? edges->startquad & ~mask : edges->startquad | mask;
+                    break;
+                }
+            }
+        }
+    }
+    if (edges->count > 0) {
+        edges->duration = (uint32_t)(edges->events[edges->count-1].tick - edges->events[0].tick) / 1000000.0;
+        if (edges->duration > 0) {
+            src->rate = edges->count / edges->duration;
+        }
+    }
+    return 0;
+}
+
+double cpuseconds() {
+    struct timespec ts;
+    clock_gettime(CLOCK_PROCESS_CPUTIME_ID, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1000000000.0;
+}
+
+int runbench(struct edgesource* src, int passes) {
+    // loads the edges from the source and runs them through the decoder, passes times to get a usable cpu time
+    struct edgelist edges;
+    memset(&edges, 0, sizeof(edges));
+    if (src->fill(src, &edges) != 0) {
+        return -1;
+    }
+    if (edges.count == 0) {
+        printf("%s: no edges\n", src->name);
+        return -1;
+    }
+    struct encinfo enc;
+    double cpu=0;
+    for (int pass=0; pass < passes; pass++) {
+        memset(&enc, 0, sizeof(enc));
+        enc.pinA=0;
+        enc.pinB=1;
+        enc.lastquad=edges.startquad;
+        enc.pinAup=edges.startquad >> 1;
+        enc.pinBup=edges.startquad & 1;
+        enc.lastpin=NOPIN;
+        memset(qshared, 0, sizeof(struct sharedquads));
+        qshared->qcount=1;
+        double cpustart=cpuseconds();
+        for (long count=0; count < edges.count; count++) {
+            decodeedge(&enc, edges.events[count].pin, edges.events[count].level, edges.events[count].tick);
+        }
+        cpu += cpuseconds() - cpustart;
+    }
+    cpu /= passes;
+    struct quadstate* qs = &qshared->quads[0];
+    printf("%-10s %10.0f %10ld %14.0f %8.3f %10u %10u ", src->name, src->rate, edges.count, cpu > 0 ? edges.count / cpu : 0,
+            edges.duration > 0 ? cpu / edges.duration * 100 : 0, qs->skipcount, qs->recovered);
+    if (edges.trueposknown) {
+        printf("%10ld\n", (long)qs->pos - edges.truepos);
+    } else {
+        printf("%10s\n", "?");
+    }
+    free(edges.events);
+    return 0;
+}
+
+int mailboxtest() {
+    // runs commands through the mailbox code in quadfeedback.c (without the futex wake up), returns 0 if they all behave
+    struct quadcommand* cmd = &qshared->cmd;
+    memset(qshared, 0, sizeof(struct sharedquads));
+    qshared->qcount=2;
+    qshared->quads[0].pos=5;
+    const char* fail=NULL;
+    cmd->cmdcode=CMD_RESET;             // posted before the helper started - must be rejected, not run
+    cmd->quadno=-1;
+    cmd->cmdseq=1;
+    startmailbox(cmd);
+    unsigned lastseq=cmd->ackseq;
+    if ((cmd->ackseq != 1) | (cmd->ackresult != ACK_NOTRUN) | (qshared->quads[0].pos != 5)) {
+        fail="command posted before startup";
+    }
+    if (fail == NULL) {
+        lastseq=servicemailbox(cmd, lastseq);   // nothing new - no ack
+        if ((lastseq != 1) | (cmd->ackseq != 1)) {
+            fail="no command";
+        }
+    }
+    if (fail == NULL) {
+        cmd->cmdcode=CMD_SETPOS;
+        cmd->quadno=1;
+        cmd->value=42;
+        cmd->cmdseq=2;
+        lastseq=servicemailbox(cmd, lastseq);
+        if ((cmd->ackseq != 2) | (cmd->ackresult != 0) | (qshared->quads[1].pos != 42)) {
+            fail="set position";
+        }
+    }
+    if (fail == NULL) {
+        cmd->cmdcode=CMD_RESET;
+        cmd->quadno=-1;
+        cmd->cmdseq=3;
+        lastseq=servicemailbox(cmd, lastseq);
+        if ((cmd->ackseq != 3) | (cmd->ackresult != 0) | (qshared->quads[0].pos != 0) | (qshared->quads[1].pos != 0)) {
+            fail="reset";
+        }
+    }
+    if (fail == NULL) {
+        cmd->cmdcode=CMD_SETPOS;
+        cmd->quadno=7;
+        cmd->cmdseq=4;
+        lastseq=servicemailbox(cmd, lastseq);
+        if ((cmd->ackseq != 4) | (cmd->ackresult != -1)) {
+            fail="invalid quad";
+        }
+    }
+    if (fail == NULL) {
+        printf("mailbox test passed\n");
+        return 0;
+    }
+    printf("mailbox test failed: %s (ackseq %u, ackresult %d)\n", fail, cmd->ackseq, cmd->ackresult);
+    return 1;
+}
+
+void printbenchhelp(char* aname) {
+    printf("help for %s\n\n", aname);
+    printf("-h --help: show this help and exit\n"
+           "-r       : edge rate (edges per second) for the generator, can be given more than once (default sweep 1000..200000)\n"
+           "-j       : generator jitter as percentage of the interval between edges (default 10)\n"
+           "-s       : pigpio sample period in microseconds (default 5)\n"
+           "-t       : generator run length in seconds (default 2)\n"
+           "-p       : number of passes over the edges to time (default 5)\n"
+           "-k       : steps in the same direction needed to recover a 2 quad skip (default 4, 0 to never recover)\n"
+           "-T       : trace file to use instead of the generator (lines \"<tick> <pin> <level>\", \"#truepos <n>\" and\n"
+           "           \"#startquad <n>\" - without #startquad each pin starts at the opposite of its first edge's level)\n"
+           "-l       : log level to report to stdout (via printf)\n"
+           "-M       : test the command mailbox code and exit (status 0 if it passes)\n"
+           "\n"
+           "Example: %s -r1000 -r10000 -j20 -s5\n"
+           "\n",aname);
+}
+
+int main(int argc, char* argv[]) {
+    double rates[argc + 8];
+    int ratecount=0;
+    struct edgesource src;
+    memset(&src, 0, sizeof(src));
+    src.jitter=10;
+    src.samplet=5.0 / 1000000;
+    src.seconds=2;
+    int passes=5;
+    logit=0;
+    for (int count = 1; count < argc; count++) {
+        if ((strncmp(argv[count],"-h", 2) ==0) | (strncmp(argv[count], "--help",6)==0)) {
+            printbenchhelp(argv[0]);
+            exit(0);
+        } else if (strncmp(argv[count],"-r", 2) == 0) {
+            rates[ratecount++]=atof(argv[count]+2);
+        } else if (strncmp(argv[count],"-j", 2) == 0) {
+            src.jitter=atof(argv[count]+2);
+        } else if (strncmp(argv[count],"-s", 2) == 0) {
+            src.samplet=atof(argv[count]+2) / 1000000;
+        } else if (strncmp(argv[count],"-t", 2) == 0) {
+            src.seconds=atof(argv[count]+2);
+        } else if (strncmp(argv[count],"-p", 2) == 0) {
+            passes=strtounsigned(argv[count]+2, 1000);
+        } else if (strncmp(argv[count],"-k", 2) == 0) {
+            recoverrun=strtounsigned(argv[count]+2, 1000);
+        } else if (strncmp(argv[count],"-T", 2) == 0) {
+            src.filename=argv[count]+2;
+        } else if (strncmp(argv[count],"-l", 2) == 0) {
+            logit=strtounsigned(argv[count]+2, 64);
+        } else if (strncmp(argv[count],"-M", 2) == 0) {
+            qshared = malloc(sizeof(struct sharedquads));
+            int res=mailboxtest();
+            free(qshared);
+            exit(res);
+        } else {
+            printf("unknown option %s in parameters\n\n", argv[count]);
+            printbenchhelp(argv[0]);
+            exit(-1);
+        }
+    }
+    if (passes < 1) {
+        passes=1;
+    }
+    qshared = malloc(sizeof(struct sharedquads));
+    printf("%-10s %10s %10s %14s %8s %10s %10s %10s\n", "source", "rate", "edges", "edges/cpu sec", "cpu %", "skipcount", "recovered",
+            "pos error");
+    if (src.filename != NULL) {
+        src.name="trace";
+        src.fill=tracefill;
+        runbench(&src, passes);
+    } else {
+        if (ratecount==0) {
+            double defrates[] = {1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000};
+            for (ratecount=0; ratecount < 8; ratecount++) {
+                rates[ratecount]=defrates[ratecount];
+            }
+        }
+        src.name="generator";
+        src.fill=generatorfill;
+        for (int count=0; count < ratecount; count++) {
+            src.rate=rates[count];
+            srand(1);
+            runbench(&src, passes);
+        }
+    }
+    free(qshared);
+    exit(0);
+}
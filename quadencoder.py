@@ -20,7 +20,7 @@ class quadencoder():
         pinss       : a tuple / list / array of pins from feedback sensors.
         edges       : 'both', 'rising', or 'falling' - specifies which edges to count
         pulseperrev : the number of pulses we expect per rev per pin (= number of rising edges - twice this number counted in 'both' edge mode
-        parent      : object that provides function needservice to get pigpio shared instance 
+        parent      : object that provides function needservice to get pigpio shared instance, and the clock to use
         initialpos  : sets the starting position of the motor
         """
         assert edges in self.edgespecs, 'invalid edge spec in quadencoder constructor'
@@ -38,7 +38,9 @@ class quadencoder():
             self.scb=[self.piggy.callback(pn, self.edgespecs[self.edgedef]) for pn in pinss]
         else:
             self.scb=[]
-        self.lasttallytime=time.time()
+        self.tallies=tuple(s.tally for s in self.scb)
+        self.clock=parent.clock
+        self.lasttallytime=self.clock.time()
         self.mss=pinss
         self.lasttallyread=sum([s.tally() for s in self.scb])
         self.lastmotorpos=initialpos
@@ -72,9 +74,13 @@ class quadencoder():
 
         Using an iterator is more efficient than calling a tick function
         """
+        tallies=self.tallies
+        clocktime=self.clock.time
         while True:
-            tallyr=sum([s.tally() for s in self.scb])
-            tnow=time.time()
+            tallyr=0
+            for tally in tallies:
+                tallyr+=tally()
+            tnow=clocktime()
             self.lasttallyinterval=tnow-self.lasttallytime
             self.lasttallytime=tnow
             tallydiff=tallyr-self.lasttallyread
@@ -1,39 +1,106 @@
 #!/usr/bin/python3
 
 import time
-import subprocess, sys, os, mmap, ctypes, struct
+import subprocess, sys, os, mmap, ctypes, struct, platform
+
+class quadstate(ctypes.Structure):
+    _fields_ = [
+        ("pos",        ctypes.c_int),
+        ("skipcount",  ctypes.c_uint),
+        ("paused",     ctypes.c_int),
+        ("recovered",  ctypes.c_uint),
+    ]
+
+class quadcommand(ctypes.Structure):
+    _fields_ = [
+        ("cmdseq",     ctypes.c_uint),
+        ("cmdcode",    ctypes.c_int),
+        ("quadno",     ctypes.c_int),
+        ("value",      ctypes.c_int),
+        ("ackseq",     ctypes.c_uint),
+        ("ackresult",  ctypes.c_int),
+    ]
+
+class watchdog(ctypes.Structure):
+    _fields_ = [
+        ("heartbeat",  ctypes.c_uint),
+        ("timeoutms",  ctypes.c_uint),
+        ("trips",      ctypes.c_uint),
+        ("tripped",    ctypes.c_int),
+    ]
 
 class quadshared(ctypes.Structure):
-     _fields_ = [
+    """
+    mirrors struct sharedquads in quadfeedback.c - keep the two in step!
+    """
+    _fields_ = [
         ("state",      ctypes.c_int),
         ("qcount",     ctypes.c_int),
-        ("quadsApos",  ctypes.c_int),
-        ("quadsAskip", ctypes.c_uint),
-        ("quadsBpos",  ctypes.c_int),
-        ("quadsBskip", ctypes.c_uint),
+        ("quads",      quadstate * 3),
+        ("cmd",        quadcommand),
+        ("wdog",       watchdog),
     ]
 
+# command codes for the mailbox - see the CMD_ defines in quadfeedback.c
+CMD_STOP   = 1
+CMD_RESET  = 2
+CMD_SETPOS = 3
+CMD_PAUSE  = 4
+CMD_RESUME = 5
+
+ACK_NOTRUN = -2     # ackresult for a command posted before the C program started - it was not run
+
+FUTEX_WAKE = 1
+# the futex syscall number varies with the architecture
+futexsyscalls = {'x86_64': 202, 'aarch64': 98, 'armv6l': 240, 'armv7l': 240, 'i686': 240}
+
 class quadfastwrapper():
     """
     A class that tracks rotary quad encoders using a fast C program in a separate processs which maintains a position in ticks from the quadencoder.
-    
+
     The C program and this class communicate using a memory mapped file.
-    
-    The C program and this class are instantiated once for a set of motors (requires less cpu) 
+
+    The C program and this class are instantiated once for a set of motors (requires less cpu)
+
+    Commands (reset, set position, pause and resume) are passed through a mailbox in the memory mapped file. After posting a
+    command the C program is woken with a futex, and we wait for it to acknowledge the command. The round trip time of each
+    command is recorded - see commandLatency.
+
+    The C program can also act as a watchdog: heartbeat should then be called every tick, and if it is not called for watchdogms
+    milliseconds, the C program sets pwm to zero on all the motor pins.
     """
-    def __init__ (self, filename, motorquads, loglvl):
+    def __init__ (self, filename, motorquads, loglvl, waitms=500, acktimeout=.5, motorpins=None, watchdogms=None):
         """
         filename   : name for the file to use as basis for memory mapped communication.
-        
+
         motorquads : a dict with keys as the names of the motors, the values are 2 entry lists with the 2 pins to use.
-        
+
         loglvl     : the log level to use for the C program.
+
+        waitms     : longest time (in milliseconds) the C program waits between checks if it is not woken by a command.
+
+        acktimeout : time in seconds to wait for the C program to acknowledge a command.
+
+        motorpins  : list of the gpio pins driving motors, these are set to zero pwm if the watchdog trips
+
+        watchdogms : if not None, the longest time in milliseconds allowed between calls to heartbeat before the motors are stopped
         """
         self.mmfiled = os.open(filename, os.O_CREAT | os.O_TRUNC | os.O_RDWR)
         os.write(self.mmfiled, b'\x00' * ctypes.sizeof(quadshared))
         self.sharedbuf = mmap.mmap(self.mmfiled, ctypes.sizeof(quadshared), mmap.MAP_SHARED, mmap.PROT_WRITE)
         self.quadinfo = quadshared.from_buffer(self.sharedbuf)
-        pargs=['./quadfeedback','-f%s'%filename,'-l%d'%loglvl]
+        self.acktimeout=acktimeout
+        self.cmdcount=0
+        self.cmdlatencytotal=0
+        self.cmdlatencymax=0
+        self.cmdlatencylast=None
+        self.cmdfails=0
+        self.futexwake=self._makefutexwake()
+        pargs=['./quadfeedback','-f%s'%filename,'-l%d'%loglvl, '-w%d' % waitms]
+        if not watchdogms is None:
+            pargs.append('-t%d' % watchdogms)
+            for p in (() if motorpins is None else motorpins):
+                pargs.append('-m%d' % p)
         qent=0
         self.nmap={}
         for k,v in motorquads.items():
@@ -48,20 +115,146 @@ class quadfastwrapper():
         ent=self.nmap.get(mname, None)
         if ent is None:
             return None
-        if ent==0:
-            return self.quadinfo.quadsApos
-        else:
-            return self.quadinfo.quadsBpos
+        return self.quadinfo.quads[ent].pos
+
+    def quadskips(self, mname):
+        """
+        returns a 2-tuple for the named motor: the number of 2 quad skips that could not be resolved and the number that were
+        recovered using the recent direction of the motor (or None if the motor is not known).
+        """
+        ent=self.nmap.get(mname, None)
+        if ent is None:
+            return None
+        qs=self.quadinfo.quads[ent]
+        return qs.skipcount, qs.recovered
+
+    def heartbeat(self):
+        """
+        tells the watchdog in the C program we're still alive - call this every tick.
+
+        returns the number of times the watchdog has stopped the motors
+        """
+        wd=self.quadinfo.wdog
+        wd.heartbeat=(wd.heartbeat+1) & 0xffffffff
+        return wd.trips
+
+    def resetPos(self, mname=None):
+        """
+        sets the position (and skip counts) of the named motor - or all motors if mname is None - to zero.
+
+        returns the round trip time of the command in seconds or None if the command was not acknowledged.
+        """
+        return self.command(CMD_RESET, self._quadno(mname))
+
+    def setPos(self, mname, pos):
+        """
+        sets the position of the named motor to pos (in quad counts).
+
+        returns the round trip time of the command in seconds or None if the command was not acknowledged.
+        """
+        return self.command(CMD_SETPOS, self._quadno(mname), int(pos))
+
+    def pause(self, mname=None):
+        """
+        pauses position tracking for the named motor - or all motors if mname is None. The position is left unchanged
+        until resume is called.
+
+        returns the round trip time of the command in seconds or None if the command was not acknowledged.
+        """
+        return self.command(CMD_PAUSE, self._quadno(mname))
+
+    def resume(self, mname=None):
+        """
+        resumes position tracking for the named motor - or all motors if mname is None.
+
+        returns the round trip time of the command in seconds or None if the command was not acknowledged.
+        """
+        return self.command(CMD_RESUME, self._quadno(mname))
+
+    def command(self, cmdcode, quadno=-1, value=0):
+        """
+        posts a command to the mailbox, wakes the C program and waits for the acknowledgement.
+
+        cmdcode : one of the CMD_ values
+
+        quadno  : index of the encoder (-1 for all encoders)
+
+        value   : parameter for the command
+
+        returns the round trip time of the command in seconds or None if the command was not acknowledged (or failed)
+        """
+        cmd=self.quadinfo.cmd
+        cmd.cmdcode=cmdcode
+        cmd.quadno=quadno
+        cmd.value=value
+        seq=(cmd.cmdseq+1) & 0xffffffff
+        tstart=time.perf_counter()
+        cmd.cmdseq=seq
+        if not self.futexwake is None:
+            self.futexwake()
+        timeout=tstart+self.acktimeout
+        while cmd.ackseq != seq:
+            if time.perf_counter() > timeout:
+                self.cmdfails+=1
+                print('quadfastwrapper: command %d not acknowledged' % cmdcode)
+                return None
+            time.sleep(.0001)
+        latency=time.perf_counter()-tstart
+        self.cmdcount+=1
+        self.cmdlatencytotal+=latency
+        self.cmdlatencylast=latency
+        if latency > self.cmdlatencymax:
+            self.cmdlatencymax=latency
+        if cmd.ackresult == ACK_NOTRUN:
+            self.cmdfails+=1
+            print('quadfastwrapper: command %d was sent before quadfeedback started and was not run' % cmdcode)
+            return None
+        if cmd.ackresult != 0:
+            self.cmdfails+=1
+            print('quadfastwrapper: command %d failed (%d)' % (cmdcode, cmd.ackresult))
+            return None
+        return latency
+
+    def commandLatency(self):
+        """
+        returns a dict with the round trip times (in seconds) of commands sent so far
+        """
+        return {'count': self.cmdcount,
+                'fails': self.cmdfails,
+                'last' : self.cmdlatencylast,
+                'max'  : self.cmdlatencymax,
+                'mean' : self.cmdlatencytotal/self.cmdcount if self.cmdcount > 0 else None}
 
     def close(self):
-        self.quadinfo.runstate=1
-        print("closedown requested")
         if not self.encproc is None:
+            self.command(CMD_STOP)
+            print("closedown requested")
             try:
                 self.encproc.wait(1)
             except subprocess.TimeoutExpired:
                 print("failed to stop - forcing termination")
                 self.encproc.terminate()
+            self.encproc=None
             self.quadinfo=None
         self.sharedbuf.close()
         os.close(self.mmfiled)
+
+    def _quadno(self, mname):
+        if mname is None:
+            return -1
+        if not mname in self.nmap:
+            raise ValueError('%s is not a known motor name' % str(mname))
+        return self.nmap[mname]
+
+    def _makefutexwake(self):
+        """
+        returns a function that wakes the C program waiting on the command sequence number, or None if we don't know how to
+        do that on this machine (the C program then picks up commands when its wait times out)
+        """
+        sysno=futexsyscalls.get(platform.machine(), None)
+        if sysno is None:
+            print('quadfastwrapper: futex not available on %s - commands will be slow' % platform.machine())
+            return None
+        libc=ctypes.CDLL(None, use_errno=True)
+        addr=ctypes.c_void_p(ctypes.addressof(self.quadinfo.cmd) + quadcommand.cmdseq.offset)
+        return lambda: libc.syscall(sysno, addr, FUTEX_WAKE, 1, None, None, 0)
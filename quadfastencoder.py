@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 
-import pigpio, time
+import time
 
 class fastencoder():
     """
@@ -13,12 +13,13 @@ class fastencoder():
     def __init__(self, ticksperrev, parent, pins):
         """
         ticksperrev : the number of pulses we expect per rev per pin (= number of rising edges - twice this number counted in 'both' edge mode
-        parent      : object that provides function needservice to get pigpio shared instance
+        parent      : the motor - provides the clock to use, and its parent has the quad monitor
         pins        : pair of gpio pins that monitor the encoder. Note these are ignored here, 'cos they are used by quadfast.py at motorset level
         """
         self.ticksperrev = ticksperrev
         self.pins = pins
-        self.lasttallytime=time.time()
+        self.clock=parent.clock
+        self.lasttallytime=self.clock.time()
         self.gettally=lambda: parent.parent.quadmon.quadpos(parent.name)
         self.lasttallyread=self.gettally()
         self.lastmotorpos=0
@@ -45,9 +46,10 @@ class fastencoder():
 
         Using an iterator is more efficient than calling a tick function?
         """
+        clocktime=self.clock.time
         while True:
             tallyr=self.gettally()
-            tnow=time.time()
+            tnow=clocktime()
             self.lasttallyinterval=tnow-self.lasttallytime
             self.lasttallytime=tnow
             tallydiff=tallyr-self.lasttallyread
@@ -5,19 +5,45 @@
 //
 // if the position goes the *wrong* way just swap the order the pins are declared.
 //
+// It can also act as a watchdog on the controller: if the controller stops bumping the heartbeat in the shared file for longer
+// than the timeout given with -t, pwm on the motor pins given with -m is set to zero. The watchdog is armed by the first heartbeat.
+//
+// The controller talks to this process through a small command mailbox in the shared file (see struct quadcommand). This process
+// waits on the mailbox's sequence number with a futex, so commands are acted on as soon as the controller wakes it rather than
+// on the next poll.
+//
 // gcc -Wall -pthread -o quadfeedback quadfedback.c -lpigpiod_if2 -lrt
 //
+// The parts that use pigpio are left out when QUADBENCH is defined - see quadbench.c which uses the decoder here without pigpio.
+//
+#ifndef QUADBENCH
 #include <pigpiod_if2.h>
+#else
+#include <stdint.h>
+#endif
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
 #include <sys/mman.h>
 #include <sys/stat.h>
+#include <sys/syscall.h>
+#include <linux/futex.h>
 #include <fcntl.h>
 #include <unistd.h>
 
 int logit=9; // 
 int pint=-1; // this is the access key to pigpio used in *nearly* all calls
+unsigned recoverrun=4; // number of recent steps in the same direction needed before a double step is recovered, 0 never recovers
+
+#define NOPIN 99    // used in encinfo.lastpin when the last edge can't be paired with the next
+
+struct stepstate {  // recent movement of an encoder, used to infer the direction of double steps
+    int dir;            // direction of the most recent step(s), 1 or -1
+    unsigned run;       // number of consecutive steps in direction dir
+    uint32_t tick;      // pigpio tick of the most recent step
+    uint32_t avg;       // smoothed interval between steps in microseconds
+};
 
 struct encinfo { // this is the internal structure used to represent each encoder.
     int encOK;
@@ -29,12 +55,46 @@ struct encinfo { // this is the internal structure used to represent each encode
     int pinBcbid;
     int lastquad;
     int quadno;     // index into sharedquads.quads for this encoder.
+    struct stepstate steps;     // recent movement
+    unsigned lastpin;           // pin of the last edge, or NOPIN
+    uint32_t lasttick;          // tick of the last edge
+    int lastapplied;            // change made to pos by the last edge
+    int undoquad;               // quad position before the last edge
+    struct stepstate undosteps; // recent movement before the last edge
 };
 
 struct quadstate {  // and this is the structure we stick into the mmapped file for each encoder so e can pick it up from the python
                     // motor controller
     int pos;            // current motor position
-    unsigned skipcount; // number of dodgy readings we've found - i.e. where we've skipped 2 quadrants.
+    unsigned skipcount; // number of dodgy readings we've found - i.e. where we've skipped 2 quadrants and couldn't tell which way.
+    int paused;         // 1 while position tracking is paused (edges are followed but pos is not changed)
+    unsigned recovered; // number of times we've skipped 2 quadrants and applied +/-2 using the recent direction
+};
+
+// command codes for the mailbox
+#define CMD_STOP    1   // shut this process down
+#define CMD_RESET   2   // set pos and skipcount to zero (quadno -1 for all encoders)
+#define CMD_SETPOS  3   // set pos to value
+#define CMD_PAUSE   4   // pause position tracking (quadno -1 for all encoders)
+#define CMD_RESUME  5   // resume position tracking (quadno -1 for all encoders)
+
+struct quadcommand { // the command mailbox. The controller writes cmdcode, quadno and value, then increments cmdseq and wakes
+                     // any futex waiter on cmdseq. This process runs the command then copies cmdseq to ackseq.
+    unsigned cmdseq;    // sequence number of the latest command - this is the futex word
+    int cmdcode;        // one of the CMD_ values above
+    int quadno;         // index of the encoder the command applies to, -1 for all where allowed
+    int value;          // parameter for CMD_SETPOS
+    unsigned ackseq;    // sequence number of the last command completed
+    int ackresult;      // 0 if the last command succeeded, -1 if it was invalid, ACK_NOTRUN if it was not run
+};
+
+#define ACK_NOTRUN  -2  // ackresult for a command posted before this process started, which is rejected rather than run
+
+struct watchdog {   // dead man's handle - if the controller doesn't bump heartbeat often enough we stop the motors
+    unsigned heartbeat; // incremented by the controller every tick
+    unsigned timeoutms; // longest gap allowed between heartbeats, 0 if the watchdog is off - set by this process
+    unsigned trips;     // number of times the watchdog has stopped the motors
+    int tripped;        // 1 from when the motors are stopped until the heartbeat starts again
 };
 
 struct sharedquads{ // and this is the total structure of the shared data
@@ -42,8 +102,11 @@ struct sharedquads{ // and this is the total structure of the shared data
                     // 1 for stop requested from the controller side, 
                     // 2 to reset the pos to zero requested from controller side (pref with the motor stopped!)
                     // -1 when this process has exited, set in this process.
+                    // (1 and 2 are still supported, but the command mailbox is preferred as it acts immediately)
     int qcount;     // number of quads active
     struct quadstate quads[3]; // 3 should be more than enough for usual uses.
+    struct quadcommand cmd;
+    struct watchdog wdog;
 };
 
 struct sharedquads* qshared=NULL; // this will point to the mmapped file we use to communicate with the motor controller
@@ -52,6 +115,11 @@ struct sharedquads* qshared=NULL; // this will point to the mmapped file we use
 // the current quad position and the last quad position into a change:
 // 0 means no change, 1 means forward 1 quad, and -1 means back 1 quad. 99 means we've moved 2 quads and we can't directly infer direction
 // fwds gives sequence 1,3,2,0... backwards gives sequence 1,0,2,3...
+//
+// pigpio reports each pin separately, so a 2 quad move shows up as edges on both pins with the same tick (both changes were seen in
+// the same sample). The order the 2 edges arrive in tells us nothing, so decodeedge takes back the first and treats the pair as a
+// 2 quad move. If the encoder has recently been moving steadily in one direction at a speed consistent with the 2 quad move,
+// it is assumed to have continued that way and pos is moved by 2. Otherwise skipcount is incremented.
 int quadlookup[16] = {
     0,  1, -1, 99,
    -1,  0, 99,  1,
@@ -59,6 +127,7 @@ int quadlookup[16] = {
    99, -1,  1,  0
 };
 
+#ifndef QUADBENCH
 int setuppin(unsigned gppin, unsigned pullupmode) {
     if ((gppin<0) | (gppin>31)) {
         if ((logit & 1) != 0) {
@@ -79,29 +148,83 @@ int setuppin(unsigned gppin, unsigned pullupmode) {
         return -1;
     }
 }
+#endif
 
-static void changefound(int pi, unsigned pinno, unsigned edgetype, uint32_t tick, void* data) {
-    struct encinfo* enc = data;
-    if (edgetype != PI_TIMEOUT) {
-        if (pinno == enc->pinA) {
-            enc->pinAup = edgetype;
-        } else {
-            enc->pinBup = edgetype;
+void stepdone(struct encinfo* enc, int dir, unsigned nsteps, uint32_t tick) {
+    // updates the recent movement of the encoder after nsteps steps in direction dir
+    uint32_t interval = (tick - enc->steps.tick) / nsteps;
+    if (interval > 1000000) {
+        interval = 1000000;
+    }
+    if ((dir == enc->steps.dir) & (enc->steps.run > 0)) {
+        if (enc->steps.run < 1000) {
+            enc->steps.run += nsteps;
         }
-        int newquad=enc->pinAup << 1 | enc->pinBup;
-        int qchange = quadlookup[enc->lastquad <<2 | newquad];
-        if ((logit & 4) != 0) {
-            printf("changefound reports qchange %d from newquad %d, oldquad %d in #%d.\n", qchange, newquad, enc->lastquad, enc->quadno);
+        enc->steps.avg = (int)enc->steps.avg + ((int)interval - (int)enc->steps.avg) / 8;
+    } else {
+        enc->steps.dir = dir;
+        enc->steps.run = nsteps;
+        enc->steps.avg = interval;
+    }
+    enc->steps.tick = tick;
+}
+
+void decodeedge(struct encinfo* enc, unsigned pinno, unsigned level, uint32_t tick) {
+    // updates the encoder's position for a change in level on one of its pins
+    struct quadstate* qs = &qshared->quads[enc->quadno];
+    if (pinno == enc->pinA) {
+        enc->pinAup = level;
+    } else {
+        enc->pinBup = level;
+    }
+    int newquad=enc->pinAup << 1 | enc->pinBup;
+    int oldquad=enc->lastquad;
+    if ((tick == enc->lasttick) & (enc->lastpin != NOPIN) & (pinno != enc->lastpin)) {
+        // both pins changed in the same sample - take back the last edge and decode the pair as one change
+        if (enc->lastapplied != 0) {
+            __atomic_fetch_add(&qs->pos, -enc->lastapplied, __ATOMIC_RELAXED);
         }
-        if (qchange > 10) {
-            qshared->quads[enc->quadno].skipcount+=1;
+        oldquad=enc->undoquad;
+        enc->steps=enc->undosteps;
+        enc->lastpin=NOPIN;
+    } else {
+        enc->undoquad=oldquad;
+        enc->undosteps=enc->steps;
+        enc->lastpin=pinno;
+    }
+    enc->lasttick=tick;
+    int qchange = quadlookup[oldquad <<2 | newquad];
+    if ((logit & 4) != 0) {
+        printf("changefound reports qchange %d from newquad %d, oldquad %d in #%d.\n", qchange, newquad, oldquad, enc->quadno);
+    }
+    if (qchange > 10) {
+        if ((recoverrun > 0) & (enc->steps.run >= recoverrun) & (tick - enc->steps.tick <= 4 * enc->steps.avg)) {
+            qchange = 2 * enc->steps.dir;
+            stepdone(enc, enc->steps.dir, 2, tick);
+            qs->recovered+=1;
         } else {
-            qshared->quads[enc->quadno].pos+=qchange;
-            if ((logit & 4) != 0) {
-                printf("changefound position now %d\n", qshared->quads[enc->quadno].pos);
-            }
+            qchange = 0;
+            enc->steps.run = 0;
+            qs->skipcount+=1;
+        }
+    } else if (qchange != 0) {
+        stepdone(enc, qchange, 1, tick);
+    }
+    enc->lastapplied=0;
+    if ((qchange != 0) & (qs->paused == 0)) {
+        __atomic_fetch_add(&qs->pos, qchange, __ATOMIC_RELAXED);
+        enc->lastapplied=qchange;
+        if ((logit & 4) != 0) {
+            printf("changefound position now %d\n", qs->pos);
         }
-        enc->lastquad=newquad;
+    }
+    enc->lastquad=newquad;
+}
+
+#ifndef QUADBENCH
+static void changefound(int pi, unsigned pinno, unsigned edgetype, uint32_t tick, void* data) {
+    if (edgetype != PI_TIMEOUT) {
+        decodeedge(data, pinno, edgetype, tick);
     }
 }
 
@@ -116,6 +239,11 @@ int setupenc(struct encinfo* enc, unsigned gppinA, unsigned gppinB, unsigned pud
             enc->quadno=qindex;
             qshared->quads[qindex].skipcount=0;
             qshared->quads[qindex].pos=0;
+            qshared->quads[qindex].paused=0;
+            qshared->quads[qindex].recovered=0;
+            memset(&enc->steps, 0, sizeof(struct stepstate));
+            enc->lastpin=NOPIN;
+            enc->lastapplied=0;
             if ((enc->pinA>=0) | (enc->pinB >=0)) {
                 enc->encOK=0;
                 if (enc->pinA > 0) {
@@ -237,12 +365,114 @@ int shutdown() {
         return -1;
     }
 }
+#endif
+
+#ifndef QUADBENCH
+static int futexwait(unsigned* addr, unsigned val, struct timespec* timeout) {
+    return syscall(SYS_futex, addr, FUTEX_WAIT, val, timeout, NULL, 0);
+}
+#endif
+
+int runcommand(struct quadcommand* cmd) {
+    // runs a single command from the mailbox, returns the result to put in ackresult
+    int qfirst=cmd->quadno;
+    int qlast=cmd->quadno;
+    if (cmd->quadno==-1) {
+        qfirst=0;
+        qlast=qshared->qcount-1;
+    } else if ((cmd->quadno < 0) | (cmd->quadno >= qshared->qcount)) {
+        if ((logit & 1) != 0) {
+            printf("runcommand: invalid quad %d for command %d\n", cmd->quadno, cmd->cmdcode);
+        }
+        return -1;
+    }
+    switch (cmd->cmdcode) {
+        case CMD_STOP:
+            qshared->state=1;
+            break;
+        case CMD_RESET:
+            for (int count=qfirst; count <= qlast; count++) {
+                __atomic_store_n(&qshared->quads[count].pos, 0, __ATOMIC_RELAXED);
+                qshared->quads[count].skipcount=0;
+                qshared->quads[count].recovered=0;
+            }
+            break;
+        case CMD_SETPOS:
+            if (cmd->quadno==-1) {
+                return -1;
+            }
+            __atomic_store_n(&qshared->quads[qfirst].pos, cmd->value, __ATOMIC_RELAXED);
+            break;
+        case CMD_PAUSE:
+        case CMD_RESUME:
+            for (int count=qfirst; count <= qlast; count++) {
+                qshared->quads[count].paused = cmd->cmdcode==CMD_PAUSE ? 1 : 0;
+            }
+            break;
+        default:
+            if ((logit & 1) != 0) {
+                printf("runcommand: unknown command %d\n", cmd->cmdcode);
+            }
+            return -1;
+    }
+    if ((logit & 2) != 0) {
+        printf("runcommand: command %d on quad %d done\n", cmd->cmdcode, cmd->quadno);
+    }
+    return 0;
+}
+
+void startmailbox(struct quadcommand* cmd) {
+    // called once the shared file is mapped. A command posted before this process started is acknowledged with ACK_NOTRUN
+    // rather than run - the encoders are not set up yet, and the controller may already have given up waiting for it.
+    unsigned seq=__atomic_load_n(&cmd->cmdseq, __ATOMIC_ACQUIRE);
+    if (seq != cmd->ackseq) {
+        cmd->ackresult=ACK_NOTRUN;
+        if ((logit & 1) != 0) {
+            printf("startmailbox: command %d was posted before startup - not run\n", cmd->cmdcode);
+        }
+    }
+    __atomic_store_n(&cmd->ackseq, seq, __ATOMIC_RELEASE);
+}
+
+unsigned servicemailbox(struct quadcommand* cmd, unsigned lastseq) {
+    // runs the latest command if cmdseq has moved on from lastseq, then acknowledges it. Returns the sequence number acknowledged.
+    unsigned newseq=__atomic_load_n(&cmd->cmdseq, __ATOMIC_ACQUIRE);
+    if (newseq != lastseq) {
+        cmd->ackresult=runcommand(cmd);
+        __atomic_store_n(&cmd->ackseq, newseq, __ATOMIC_RELEASE);
+    }
+    return newseq;
+}
+
+#ifndef QUADBENCH
+long msecsince(struct timespec* then, struct timespec* now) {
+    return (now->tv_sec - then->tv_sec) * 1000 + (now->tv_nsec - then->tv_nsec) / 1000000;
+}
+
+void watchdogtrip(unsigned* motorpins, unsigned motorpincount) {
+    // the controller has gone quiet - stop all the motors
+    for (int count=0; count < motorpincount; count++) {
+        int res=set_PWM_dutycycle(pint, motorpins[count], 0);
+        if (((logit & 1) != 0) & (res != 0)) {
+            printf("watchdog failed to stop pin %d because %d\n", motorpins[count], res);
+        }
+    }
+    qshared->wdog.trips+=1;
+    qshared->wdog.tripped=1;
+    if ((logit & 1) != 0) {
+        printf("watchdog: no heartbeat for %dms - motors stopped\n", qshared->wdog.timeoutms);
+    }
+}
 
 void printhelp(char* aname) {
     printf("help for %s\n\n", aname);
     printf("-h --help: show this help and exit\n"
            "-f --filename: name of the file to share data\n"
            "-l           : log level to report to stdout (via printf)\n"
+           "-k           : steps in the same direction needed to recover a 2 quad skip (default 4, 0 to never recover)\n"
+           "-m           : gpio pin driving a motor, set to zero pwm if the watchdog trips\n"
+           "-t           : watchdog timeout in milliseconds (default 0 - no watchdog)\n"
+           "-w           : longest wait in milliseconds between checks of the state field (default 500)\n"
            "-n           : gpio pin with no pullup or pulldown set\n"
            "-u           : gpio pin with pullup set\n"
            "-d           : gpio pin with puldown set\n"
@@ -252,6 +482,7 @@ void printhelp(char* aname) {
            "Example: %s -f/tmp/quads -n7 -n11, -u17, -u27\n"
            "\n",aname);
 }
+#endif
 
 unsigned strtounsigned(char* sstr, unsigned max) {
     char *ptr;
@@ -264,10 +495,15 @@ unsigned strtounsigned(char* sstr, unsigned max) {
     }
 }
 
+#ifndef QUADBENCH
 int main(int argc, char* argv[]) {
     unsigned pins[argc];
     unsigned puds[argc];
     unsigned pincount=0;
+    unsigned motorpins[argc];
+    unsigned motorpincount=0;
+    unsigned wdms=0;
+    unsigned waitms=500;
     char* filename=NULL;
     for (int count = 1; count < argc; count++) {
         printf("arg %d:%s\n", count, argv[count]);
@@ -297,6 +533,19 @@ int main(int argc, char* argv[]) {
     	    pincount += 1;
     	} else if (strncmp(argv[count],"-l", 2) == 0) {
     	    logit=strtounsigned(argv[count]+2, 64);
+    	} else if (strncmp(argv[count],"-k", 2) == 0) {
+    	    recoverrun=strtounsigned(argv[count]+2, 1000);
+    	} else if (strncmp(argv[count],"-w", 2) == 0) {
+    	    waitms=strtounsigned(argv[count]+2, 10000);
+    	} else if (strncmp(argv[count],"-t", 2) == 0) {
+    	    wdms=strtounsigned(argv[count]+2, 10000);
+    	} else if (strncmp(argv[count],"-m", 2) == 0) {
+    	    motorpins[motorpincount]=strtounsigned(argv[count]+2, 32);
+	        if (motorpins[motorpincount]==32) {
+	            printf("argument %s is not in range 0..31", argv[count]);
+	            exit(-1);
+	        }
+	        motorpincount += 1;
 	    } else {
 	        printf("unknown option %s in parameters\n\n", argv[count]);
 	        printhelp(argv[0]);
@@ -327,6 +576,10 @@ int main(int argc, char* argv[]) {
     }
     qshared = mmap(NULL, mmsize, PROT_READ | PROT_WRITE, MAP_SHARED, mfiled, 0);
     printf("mmap setup\n");
+    startmailbox(&qshared->cmd);
+    qshared->wdog.timeoutms = wdms;
+    qshared->wdog.trips = 0;
+    qshared->wdog.tripped = 0;
     qshared->state = 0;
     printf("state set to 0\n");
 
@@ -358,11 +611,22 @@ int main(int argc, char* argv[]) {
             exit(-1);
         }
     }
-    struct timespec sleept;
-    sleept.tv_sec=0;
-    sleept.tv_nsec=500000000; // run this on .5 second ticker.
+    if ((wdms > 0) & (waitms > wdms / 4)) {  // wake often enough to check the heartbeat
+        waitms = wdms / 4 > 0 ? wdms / 4 : 1;
+    }
+    struct timespec waitt;
+    waitt.tv_sec=waitms / 1000;
+    waitt.tv_nsec=(waitms % 1000) * 1000000;
+    unsigned lastseq=qshared->cmd.ackseq;
+    struct timespec lastreport;
+    clock_gettime(CLOCK_MONOTONIC, &lastreport);
+    unsigned lastbeat=qshared->wdog.heartbeat;
+    int wdarmed=0;
+    struct timespec lastbeattime=lastreport;
     while (qshared->state >= 0) {
-        nanosleep(&sleept, NULL);
+        // sleep until the controller bumps cmdseq (and wakes us) or the wait times out
+        futexwait(&qshared->cmd.cmdseq, lastseq, &waitt);
+        lastseq=servicemailbox(&qshared->cmd, lastseq);
         if (qshared->state==1) {
             qshared->state=-1;
         } else if (qshared->state==2) {
@@ -372,11 +636,33 @@ int main(int argc, char* argv[]) {
             }
             qshared->state=0;
         }
+        struct timespec tnow;
+        clock_gettime(CLOCK_MONOTONIC, &tnow);
+        if (wdms > 0) {
+            unsigned beat=__atomic_load_n(&qshared->wdog.heartbeat, __ATOMIC_RELAXED);
+            if (beat != lastbeat) {
+                lastbeat=beat;
+                lastbeattime=tnow;
+                wdarmed=1;
+                if (qshared->wdog.tripped != 0) {
+                    qshared->wdog.tripped=0;
+                    if ((logit & 1) != 0) {
+                        printf("watchdog: heartbeat restarted\n");
+                    }
+                }
+            } else if ((wdarmed != 0) & (qshared->wdog.tripped == 0) & (msecsince(&lastbeattime, &tnow) > wdms)) {
+                watchdogtrip(motorpins, motorpincount);
+            }
+        }
         if ((logit & 8) != 0) {
-            for (int count=0; count < qshared->qcount; count++) {
-                printf("quad(%d) now at %4d. skipcount is %2d    ", count, qshared->quads[count].pos, qshared->quads[count].skipcount);
+            if (msecsince(&lastreport, &tnow) >= waitms) {
+                for (int count=0; count < qshared->qcount; count++) {
+                    printf("quad(%d) now at %4d. skipcount is %2d, recovered %2d    ", count, qshared->quads[count].pos,
+                            qshared->quads[count].skipcount, qshared->quads[count].recovered);
+                }
+                printf("\n");
+                lastreport=tnow;
             }
-            printf("\n");
         }
     }
     shutdown();
@@ -385,4 +671,5 @@ int main(int argc, char* argv[]) {
         printf("completed\n");
     }
     exit(0);    
-}
\ No newline at end of file
+}
+#endif
\ No newline at end of file
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+import pigpio, time, os
+import numpy as np
+
+# translates the last quad position and the new quad position into a change, see quadlookup in quadfeedback.c
+quadlookup = np.array((
+     0,  1, -1, 99,
+    -1,  0, 99,  1,
+     1, 99,  0, -1,
+    99, -1,  1,  0), dtype=np.int8)
+
+# layout of each report in the notification pipe (see http://abyz.me.uk/rpi/pigpio/python.html#notify_open)
+reportdtype = np.dtype([('seqno', '<u2'), ('flags', '<u2'), ('tick', '<u4'), ('level', '<u4')])
+
+NTFY_FLAGS_MASK = pigpio.NTFY_FLAGS_WDOG | pigpio.NTFY_FLAGS_ALIVE | pigpio.NTFY_FLAGS_EVENT
+
+class notifyencoder():
+    """
+    A class to process quadrature encoder info on a motor. It maintains a position and also details of the last measurement interval.
+
+    This version opens a pigpio notification handle for the encoder's 2 pins and reads the reports from the notification pipe in
+    bulk each time the iterator is advanced. The reports are decoded with numpy, so the cost per edge is far lower than using pigpio
+    callbacks from python, and unlike quadencoder it follows the direction of rotation.
+
+    The notification pipe is only available when pigpiod is running on the same machine.
+
+    2 quad moves (both pins change between 2 reports) are applied in the direction of the other moves in the same batch if they
+    all agree, or in the direction of the last move seen (lastdir) if the batch has no other moves (like recoverrun in
+    quadfeedback.c, so a fast motor whose batches are all 2 quad moves keeps counting), otherwise they are counted in skipcount.
+    """
+    def __init__(self, ticksperrev, parent, pinss, readsize=12000):
+        """
+        ticksperrev : the number of quad steps we expect per rev (4 times the number of pulses per rev on each pin)
+        parent      : object that provides function needservice to get pigpio shared instance, and the clock to use
+        pinss       : pair of gpio pins that monitor the encoder. (note use of 'pinss' rather than 'pins' to stop quadfast being used
+                      at motorset level)
+        readsize    : number of bytes to read from the pipe in one go (a multiple of the report size)
+        """
+        assert len(pinss)==2, 'notifyencoder needs exactly 2 pins'
+        self.piggy=parent.needservice(sname='piggy', className='pigpio.pi')
+        self.ticksperrev = ticksperrev
+        self.mss = pinss
+        self.readsize = readsize - readsize % reportdtype.itemsize
+        for sp in pinss:
+            assert isinstance(sp, int) and sp>=0
+            self.piggy.set_mode(sp, pigpio.INPUT)
+        self.pinA, self.pinB = pinss
+        self.lastquad = self.piggy.read(self.pinA) << 1 | self.piggy.read(self.pinB)
+        self.lastdir = 0        # direction of the last single quad move, 0 until one is seen
+        self.nhandle = self.piggy.notify_open()
+        if self.nhandle < 0:
+            raise RuntimeError('notifyencoder: pigpio notify_open failed (%d)' % self.nhandle)
+        self.pipefd = os.open('/dev/pigpio%d' % self.nhandle, os.O_RDONLY | os.O_NONBLOCK)
+        self.piggy.notify_begin(self.nhandle, 1 << self.pinA | 1 << self.pinB)
+        self.leftover = b''
+        self.tally = 0
+        self.skipcount = 0
+        self.recovered = 0
+        self.clock=parent.clock
+        self.lasttallytime=self.clock.time()
+        self.lasttallyread=0
+        self.lastmotorpos=0
+        self.prevmotorpos=0
+        self.lasttallydiff=0
+        self.lasttallyinterval=0
+
+    def close(self):
+        if not self.nhandle is None:
+            self.piggy.notify_close(self.nhandle)
+            os.close(self.pipefd)
+            for pn in self.mss:
+                self.piggy.set_pull_up_down(pn, pigpio.PUD_OFF)
+            self.nhandle = None
+
+    def stopped(self):
+        """
+        return True if we think the motor is stationary
+        """
+        return self.lasttallydiff==0
+
+    def readreports(self):
+        """
+        reads all the complete reports currently waiting in the notification pipe, returns them as a numpy structured array
+        """
+        chunks = [self.leftover]
+        while True:
+            try:
+                chunk = os.read(self.pipefd, self.readsize)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if len(chunk) < self.readsize:
+                break
+        data = b''.join(chunks)
+        usable = len(data) - len(data) % reportdtype.itemsize
+        self.leftover = data[usable:]
+        return np.frombuffer(data, dtype=reportdtype, count=usable // reportdtype.itemsize)
+
+    def updatetally(self):
+        """
+        decodes the waiting reports and updates the tally (in quad steps)
+        """
+        reports = self.readreports()
+        if len(reports) == 0:
+            return self.tally
+        levels = reports['level'][(reports['flags'] & NTFY_FLAGS_MASK) == 0]
+        if len(levels) == 0:
+            return self.tally
+        quads = np.empty(len(levels)+1, dtype=np.uint8)
+        quads[0] = self.lastquad
+        quads[1:] = ((levels >> self.pinA) & 1) << 1 | ((levels >> self.pinB) & 1)
+        changes = quadlookup[quads[:-1] << 2 | quads[1:]]
+        doubles = np.count_nonzero(changes == 99)
+        if doubles == 0:
+            self.tally += int(changes.sum())
+        else:
+            singles = changes[changes != 99]
+            fwd = np.count_nonzero(singles == 1)
+            back = np.count_nonzero(singles == -1)
+            net = fwd - back
+            if net != 0 and (fwd == 0 or back == 0):
+                self.tally += net + (2 * doubles if net > 0 else -2 * doubles)
+                self.recovered += doubles
+            elif fwd == 0 and back == 0 and self.lastdir != 0:
+                self.tally += 2 * doubles * self.lastdir
+                self.recovered += doubles
+            else:
+                self.tally += net
+                self.skipcount += doubles
+        moves = changes[(changes == 1) | (changes == -1)]
+        if len(moves) > 0:
+            self.lastdir = int(moves[-1])
+        self.lastquad = int(quads[-1])
+        return self.tally
+
+    def __iter__(self):
+        """
+        The iterator updates the motor position by decoding the reports from the notification pipe and adjusting the motor
+        position appropriately.
+
+        It returns the latest known motor position.
+
+        The motorpos is recorded in revolutions.
+        """
+        clocktime=self.clock.time
+        while True:
+            tallyr=self.updatetally()
+            tnow=clocktime()
+            self.lasttallyinterval=tnow-self.lasttallytime
+            self.lasttallytime=tnow
+            tallydiff=tallyr-self.lasttallyread
+            self.prevmotorpos=self.lastmotorpos
+            self.lastmotorpos+=tallydiff / self.ticksperrev
+            self.lasttallyread=tallyr
+            self.lasttallydiff=tallydiff
+            yield(self.lastmotorpos)
+
+    def odef(self):
+        return {'className': type(self).__name__, 'ticksperrev': self.ticksperrev, 'pinss': self.mss}
@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+"""
+Records what a motorset sees and is told, and replays it later, so problems found in the field (oscillation, stalls...) can be
+run again on any machine, as fast as the code allows, as often as needed.
+
+A recording holds, for every tick, the motorset clock's time and each motor's position sensor output (the position in revs and
+the time it was read), and every command given through the motorset (the methods that use _listcall, and stopMotor), in the
+order they happened. For example, to record a motorset:
+
+    rec=replay.recorder(ms, 'field.rec', motordefs=config_h_bridge.motordef)
+    ... run as normal ...
+    rec.close()
+
+replay then builds a new motorset from the recorded motor definitions (or changed ones), with replaydrive in place of each
+motor's driver and replayencoder in place of its position sensor, and a clocks.virtualclock set from the recorded tick times.
+It feeds the recording through motorset.ticker and returns what the motors did at each tick:
+
+    base=replay.replay('field.rec')
+    mdefs=replay.recordedmotordefs('field.rec')
+    mdefs[0]['feedback']['Pfact']=-300
+    trial=replay.replay('field.rec', motordefs=mdefs)
+    print(replay.compare(base, trial))
+
+Note the replay is open loop: the motors get the recorded positions whatever the drivers are told, so a changed controller
+shows how its outputs differ on identical inputs, not how the motor would have responded.
+
+Commands issued by code inside the motors (such as motoranalyser tests) are not recorded - they are run again by the replay
+if the command that started them was recorded.
+
+File format: a header line, then a 4 byte length and the json of the motor definitions and the motors with position sensors,
+then the records. A tick record is 'T', the tick time and the position and read time for each of those motors (all doubles,
+little endian), a command record is 'C', a 4 byte length and the json of [mlist, method, args].
+"""
+import struct, json, time
+import cProfile, pstats
+import clocks, motorset
+
+fileheader=b'pimotors recording 1\n'
+lenstruct=struct.Struct('<I')
+querymethods={'lastPosition', 'lastRPM', 'lastErrorRPM', 'speedLimits', 'tickerStats'}   # not recorded - they change nothing
+
+class recorder():
+    """
+    records a motorset's ticks and commands to a file (see above) until close is called.
+
+    The motorset's ticker, _listcall and stopMotor are replaced (on the instance) by versions that record and then call the
+    originals. Each tick adds 9 bytes plus 16 bytes per motor with a position sensor to the file.
+    """
+    def __init__(self, mset, filename, motordefs):
+        """
+        mset      : the motorset to record
+
+        filename  : the file to write - it is replaced if it exists
+
+        motordefs : the motor definitions the motorset was made from, so the replay can make the same motors. 'sim' entries
+                    (see motorsim.simmotorset) are kept but ignored by replay.
+        """
+        self.mset=mset
+        self.sensed=[m for m in mset.motors.values() if not m.motorpos is None]
+        self.tickstruct=struct.Struct('<cd'+'dd'*len(self.sensed))
+        self.ticks=0
+        self.commands=0
+        self.file=open(filename, 'wb')
+        head=json.dumps({'motordefs': list(motordefs), 'sensed': [m.name for m in self.sensed],
+                'initial': [(m.motorpos.lastmotorpos, m.motorpos.lasttallytime) for m in self.sensed]}).encode()
+        self.file.write(fileheader)
+        self.file.write(lenstruct.pack(len(head)))
+        self.file.write(head)
+        self.origticker=mset.ticker
+        self.origlistcall=mset._listcall
+        self.origstop=mset.stopMotor
+        mset.ticker=self.ticker
+        mset._listcall=self._listcall
+        mset.stopMotor=self.stopMotor
+
+    def ticker(self):
+        tnow=self.mset.clock.time()
+        self.origticker()
+        vals=[]
+        for m in self.sensed:
+            mp=m.motorpos
+            vals.append(mp.lastmotorpos)
+            vals.append(mp.lasttallytime)
+        self.file.write(self.tickstruct.pack(b'T', tnow, *vals))
+        self.ticks+=1
+
+    def _listcall(self, units, method, *args, **kwargs):
+        if not method in querymethods:
+            self._command(units, method, args, kwargs)
+        return self.origlistcall(units, method, *args, **kwargs)
+
+    def stopMotor(self, mlist=None):
+        self._command(mlist, 'stopMotor', (), {})
+        return self.origstop(mlist)
+
+    def _command(self, units, method, args, kwargs):
+        assert not kwargs, 'recorder cannot record keyword arguments in a call to %s' % method
+        cmd=json.dumps([units, method, args]).encode()
+        self.file.write(b'C'+lenstruct.pack(len(cmd))+cmd)
+        self.commands+=1
+
+    def close(self):
+        """
+        stops recording and puts the motorset back as it was
+        """
+        if not self.file is None:
+            self.mset.ticker=self.origticker
+            self.mset._listcall=self.origlistcall
+            self.mset.stopMotor=self.origstop
+            self.file.close()
+            self.file=None
+
+def readrecording(filename):
+    """
+    reads a recording, returns a tuple:
+        the header as a dict (see recorder)
+        a list of the records, each ('T', ticktime, ((pos, readtime), ...)) or ('C', mlist, method, args)
+    """
+    with open(filename, 'rb') as rf:
+        data=rf.read()
+    if not data.startswith(fileheader):
+        raise ValueError('%s is not a pimotors recording' % filename)
+    offset=len(fileheader)
+    hlen,=lenstruct.unpack_from(data, offset)
+    offset+=lenstruct.size
+    head=json.loads(data[offset:offset+hlen].decode())
+    offset+=hlen
+    tickstruct=struct.Struct('<cd'+'dd'*len(head['sensed']))
+    records=[]
+    dlen=len(data)
+    while offset < dlen:
+        kind=data[offset:offset+1]
+        if kind==b'T':
+            if offset+tickstruct.size > dlen:
+                print('replay: recording %s ends with an incomplete tick' % filename)
+                break
+            vals=tickstruct.unpack_from(data, offset)
+            offset+=tickstruct.size
+            records.append(('T', vals[1], tuple(zip(vals[2::2], vals[3::2]))))
+        elif kind==b'C':
+            clen,=lenstruct.unpack_from(data, offset+1)
+            offset+=1+lenstruct.size
+            units, method, args=json.loads(data[offset:offset+clen].decode())
+            offset+=clen
+            records.append(('C', units, method, args))
+        else:
+            raise ValueError('bad record type %s at offset %d in %s' % (kind, offset, filename))
+    return head, records
+
+def recordedmotordefs(filename):
+    """
+    returns the motor definitions from a recording, ready to be changed and passed to replay
+    """
+    return readrecording(filename)[0]['motordefs']
+
+class replaydrive():
+    """
+    a motor driver (mdrive) for replays - it just remembers the last duty cycle and frequency it was given
+    """
+    def __init__(self, parent, frequency=200, range=255, invert=False, **kwargs):
+        self.range=range
+        self.isinverted=invert==True
+        self.lastdc=0
+        self.lastHz=frequency
+
+    def invert(self, invert):
+        if not invert is None and (invert==True) != self.isinverted:
+            self.isinverted=invert==True
+            self.lastdc = -self.lastdc
+        return self.isinverted
+
+    def maxDC(self):
+        return self.range
+
+    def DC(self, dutycycle):
+        self.lastdc=max(-self.range, min(self.range, dutycycle))
+        return self.lastdc
+
+    def frequency(self, frequency):
+        if not frequency is None:
+            self.lastHz=frequency
+        return self.lastHz
+
+    def stop(self):
+        self.DC(0)
+
+    def close(self):
+        pass
+
+    def odef(self):
+        return {'className': type(self).__name__, 'frequency': self.lastHz, 'range': self.range, 'invert': self.isinverted}
+
+class replayencoder():
+    """
+    a position sensor (rotationsense) for replays - each step gives the next recorded position and read time for its motor
+    """
+    __slots__=('source', 'name', 'lasttallytime', 'lastmotorpos', 'prevmotorpos', 'lasttallydiff', 'lasttallyinterval')
+
+    def __init__(self, parent, **kwargs):
+        """
+        parent  : the motor - the recorded values come from the 'replaysource' service (a replayer)
+        """
+        self.source=parent.needservice(sname='replaysource', className='replay.replayer')
+        self.name=parent.name
+        self.lastmotorpos, self.lasttallytime=self.source.initial[self.name]
+        self.prevmotorpos=self.lastmotorpos
+        self.lasttallydiff=0
+        self.lasttallyinterval=0
+
+    def close(self):
+        pass
+
+    def stopped(self):
+        return self.lasttallydiff==0
+
+    def __iter__(self):
+        samples=self.source.samples
+        name=self.name
+        while True:
+            pos, tread=samples[name]
+            self.lasttallyinterval=tread-self.lasttallytime
+            self.lasttallytime=tread
+            self.prevmotorpos=self.lastmotorpos
+            self.lasttallydiff=pos-self.lastmotorpos
+            self.lastmotorpos=pos
+            yield pos
+
+    def odef(self):
+        return {'className': type(self).__name__}
+
+class replayer():
+    """
+    replays a recording through a motorset made from the recorded (or given) motor definitions - see replay below
+    """
+    def __init__(self, filename, motordefs=None, keeplogs=False):
+        self.head, self.records=readrecording(filename)
+        self.initial={mname: tuple(init) for mname, init in zip(self.head['sensed'], self.head['initial'])}
+        self.samples={}
+        self.clock=clocks.virtualclock(start=self.records[0][1] if self.records and self.records[0][0]=='T' else 0)
+        mdefs=[]
+        for mdef in self.head['motordefs'] if motordefs is None else motordefs:
+            mdef=dict(mdef)
+            mdef.pop('sim', None)
+            drv=mdef['mdrive']
+            mdef['mdrive']={'className': 'replay.replaydrive', 'frequency': drv.get('frequency', 200),
+                    'range': drv.get('range', 255), 'invert': drv.get('invert', False)}
+            if mdef['name'] in self.initial:
+                mdef['rotationsense']={'className': 'replay.replayencoder'}
+            else:
+                mdef.pop('rotationsense', None)
+            if not keeplogs:
+                mdef.pop('logtypes', None)
+            mdefs.append(mdef)
+        self.mset=motorset.motorset(motordefs=mdefs, clock=self.clock, services={'replaysource': self})
+
+    def run(self, profile=False, top=25):
+        """
+        runs the whole recording, returns a dict:
+            'ticks'   : number of ticks
+            'elapsed' : wall clock time for the replay (seconds)
+            'tickrate': ticks replayed per second
+            'tstamp'  : list of the tick times
+            'motors'  : dict of motor name to dict of lists (one entry per tick) of the motor's 'dc' (the driver's duty cycle),
+                        'speed' (the requested speed), 'error' (feedback error in rpm) and 'rpm' after the tick
+            'tickerstats': the motorset's motorTickerStats
+            'profile' : if profile is True, the top functions by cumulative time (as asprocess.tickprofiler)
+        """
+        ms=self.mset
+        sensed=self.head['sensed']
+        samples=self.samples
+        motors={mname: {'dc': [], 'speed': [], 'error': [], 'rpm': []} for mname in ms.motors}
+        tstamp=[]
+        prof=cProfile.Profile() if profile else None
+        tstart=time.perf_counter()
+        if profile:
+            prof.enable()
+        for rec in self.records:
+            if rec[0]=='T':
+                self.clock.set(rec[1])
+                for mname, sample in zip(sensed, rec[2]):
+                    samples[mname]=sample
+                ms.ticker()
+                tstamp.append(rec[1])
+                for mname, m in ms.motors.items():
+                    mout=motors[mname]
+                    mout['dc'].append(m.mdrive.lastdc)
+                    mout['speed'].append(m.currSpeed)
+                    mout['error'].append(m.lastErrorRPM())
+                    mout['rpm'].append(m.lastRPM())
+            elif rec[2]=='stopMotor':
+                ms.stopMotor(rec[1])
+            else:
+                ms._listcall(rec[1], rec[2], *rec[3])
+        if profile:
+            prof.disable()
+        elapsed=time.perf_counter()-tstart
+        res={'ticks': len(tstamp), 'elapsed': elapsed, 'tickrate': len(tstamp)/elapsed if elapsed > 0 else 0, 'tstamp': tstamp,
+                'motors': motors, 'tickerstats': ms.motorTickerStats()}
+        if profile:
+            ps=pstats.Stats(prof)
+            res['profile']=[{'function': '%s:%d(%s)' % (fname, line, func), 'calls': nc, 'tottime': tt, 'cumtime': ct}
+                    for (fname, line, func), (cc, nc, tt, ct, callers)
+                        in sorted(ps.stats.items(), key=lambda x: x[1][3], reverse=True)[:top]]
+        return res
+
+    def close(self):
+        self.mset.close()
+
+def replay(filename, motordefs=None, profile=False, keeplogs=False):
+    """
+    replays a recording and returns the results (see replayer.run)
+
+    filename  : the recording
+
+    motordefs : None to use the recorded motor definitions, or changed definitions (see recordedmotordefs) to try out a change
+                to the controller on the same inputs. The motor names must be the same.
+
+    profile   : if True the replay is run with cProfile and the results include the top functions
+
+    keeplogs  : if False the motors' logtypes are removed so the replay does not write to the logs
+    """
+    rp=replayer(filename, motordefs=motordefs, keeplogs=keeplogs)
+    try:
+        return rp.run(profile=profile)
+    finally:
+        rp.close()
+
+def compare(resa, resb, fields=('dc', 'speed', 'error')):
+    """
+    compares the results of 2 replays of the same recording (such as before and after a change to the controller).
+
+    returns a dict of motor name to dict of field to:
+        'firstdiff': the index of the first tick where the values differ (None if they never do)
+        'maxdiff'  : the largest absolute difference
+        'rmsdiff'  : the root mean square difference
+        'rmsa', 'rmsb': root mean square of each set of values (for feedback error this is a measure of how well the
+                     controller tracked the target)
+    """
+    assert resa['ticks']==resb['ticks'], 'the replays have different numbers of ticks'
+    res={}
+    for mname, mres in resa['motors'].items():
+        mcomp={}
+        for fld in fields:
+            va=[0 if v is None else v for v in mres[fld]]
+            vb=[0 if v is None else v for v in resb['motors'][mname][fld]]
+            diffs=[abs(a-b) for a, b in zip(va, vb)]
+            firstdiff=None
+            for i, d in enumerate(diffs):
+                if d != 0:
+                    firstdiff=i
+                    break
+            count=max(1, len(diffs))
+            mcomp[fld]={'firstdiff': firstdiff, 'maxdiff': max(diffs) if diffs else 0,
+                        'rmsdiff': (sum(d*d for d in diffs)/count)**.5,
+                        'rmsa': (sum(a*a for a in va)/count)**.5,
+                        'rmsb': (sum(b*b for b in vb)/count)**.5}
+        res[mname]=mcomp
+    return res
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+"""
+A local SQLite store for the results of motoranalyser runs, so runs can be found without scanning log files.
+
+The store is a log sink (see logger.logger), add it to the motor's logtypes for the analyser records, for example:
+    ('analyser', {'filename': 'results.db', 'sink': {'className': 'resultstore.sqlitesink'}})
+
+Each record becomes a row in the samples table, and each new (runid, motor) pair a row in the runs table. Rows are inserted in
+batches, each batch in a single transaction, so logging from the ticker stays cheap.
+
+queryresults fetches samples back as numpy arrays.
+"""
+import sqlite3, time, json
+
+schema=(
+    """CREATE TABLE IF NOT EXISTS runs (
+        runid     REAL,
+        motor     TEXT,
+        testname  TEXT,
+        frequ     INTEGER,
+        logged    REAL,
+        PRIMARY KEY (runid, motor))""",
+    """CREATE TABLE IF NOT EXISTS samples (
+        id        INTEGER PRIMARY KEY,
+        runid     REAL,
+        motor     TEXT,
+        testname  TEXT,
+        frequ     INTEGER,
+        direc     TEXT,
+        DC        REAL,
+        speed     REAL,
+        tps       REAL,
+        rpm       REAL,
+        tstamp    REAL,
+        logged    REAL,
+        tallylist TEXT)""",
+    "CREATE INDEX IF NOT EXISTS samples_motor ON samples (motor)",
+    "CREATE INDEX IF NOT EXISTS samples_testname ON samples (testname)",
+    "CREATE INDEX IF NOT EXISTS samples_runid ON samples (runid)",
+    "CREATE INDEX IF NOT EXISTS samples_frequ ON samples (frequ)",
+    "CREATE INDEX IF NOT EXISTS runs_motor_testname ON runs (motor, testname)",
+)
+
+samplefields=('runid', 'motor', 'testname', 'frequ', 'direc', 'DC', 'speed', 'tps', 'rpm', 'tstamp')
+
+class sqlitesink():
+    """
+    A log sink that writes analyser records to a SQLite database. The database is always added to (append is accepted to match
+    the other sinks, but existing results are never removed).
+    """
+    def __init__(self, filename, append=True, batchsize=100, flushtime=5):
+        """
+        filename  : the database file - created if necessary
+
+        batchsize : number of records that triggers a write to the database
+
+        flushtime : longest time in seconds records are held before being written (checked as records arrive)
+        """
+        self.filename=filename
+        self.batchsize=batchsize
+        self.flushtime=flushtime
+        self.db=sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            for stmt in schema:
+                self.db.execute(stmt)
+        self.pending=[]
+        self.pendingruns={}
+        self.knownruns=set()
+        self.lastflush=time.time()
+        self.closed=False
+
+    def writerecord(self, name, params, tnow):
+        row=tuple(params.get(f, None) for f in samplefields)
+        tl=params.get('tallylist', None)
+        self.pending.append(row + (tnow, None if tl is None else json.dumps(tl)))
+        runkey=(row[0], row[1])
+        if not runkey in self.knownruns:
+            self.knownruns.add(runkey)
+            self.pendingruns[runkey]=(row[0], row[1], row[2], row[3], tnow)
+        if len(self.pending) >= self.batchsize or tnow > self.lastflush+self.flushtime:
+            self.flush()
+
+    def flush(self):
+        if self.pending or self.pendingruns:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO runs VALUES (?,?,?,?,?)', self.pendingruns.values())
+                self.db.executemany('INSERT INTO samples (%s, logged, tallylist) VALUES (%s)' % (
+                        ', '.join(samplefields), ','.join('?'*(len(samplefields)+2))), self.pending)
+            self.pending=[]
+            self.pendingruns={}
+        self.lastflush=time.time()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.db.close()
+            self.closed=True
+
+def queryresults(dbfile, fields=('DC', 'rpm'), motor=None, testname=None, runid=None, frequ=None, since=None, until=None):
+    """
+    fetches samples from a results database, returns a dict of numpy arrays, one per field (in order of logging).
+
+    fields   : the sample fields wanted - any of the samples table columns except tallylist
+
+    motor, testname, runid, frequ: if not None only samples with this value are returned
+
+    since, until : if not None only samples logged at or after / before this time (as from time.time()) are returned
+
+    e.g. all mapDCtoRPM samples for motor left at 200Hz in the last week:
+        queryresults('results.db', motor='left', testname='mapDCtoRPM', frequ=200, since=time.time()-7*24*3600)
+    """
+    import numpy as np
+    conds=[]
+    args=[]
+    for col, val in (('motor', motor), ('testname', testname), ('runid', runid), ('frequ', frequ)):
+        if not val is None:
+            conds.append('%s = ?' % col)
+            args.append(val)
+    if not since is None:
+        conds.append('logged >= ?')
+        args.append(since)
+    if not until is None:
+        conds.append('logged < ?')
+        args.append(until)
+    for f in fields:
+        if not f in samplefields+('id', 'logged'):
+            raise ValueError('%s is not a sample field' % str(f))
+    sql='SELECT %s FROM samples%s ORDER BY id' % (', '.join(fields), (' WHERE ' + ' AND '.join(conds)) if conds else '')
+    db=sqlite3.connect(dbfile)
+    try:
+        rows=db.execute(sql, args).fetchall()
+    finally:
+        db.close()
+    cols=list(zip(*rows)) if rows else [()]*len(fields)
+    return {f: np.array(c) for f, c in zip(fields, cols)}
+
+def listruns(dbfile, motor=None, testname=None):
+    """
+    returns a list of (runid, motor, testname, frequ, logged) tuples for the runs in a results database
+    """
+    conds=[]
+    args=[]
+    for col, val in (('motor', motor), ('testname', testname)):
+        if not val is None:
+            conds.append('%s = ?' % col)
+            args.append(val)
+    db=sqlite3.connect(dbfile)
+    try:
+        return db.execute('SELECT * FROM runs%s ORDER BY runid' % ((' WHERE ' + ' AND '.join(conds)) if conds else ''), args).fetchall()
+    finally:
+        db.close()
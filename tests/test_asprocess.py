@@ -0,0 +1,67 @@
+import time, json
+import benchmark
+
+def makestub(**kwargs):
+    return benchmark.benchstub(wrappedClassName='benchmark.benchtarget', ticktime=.05, locallogging={'logtypes': ()}, **kwargs)
+
+def test_rpc_timings_without_metrics():
+    stub=makestub()
+    try:
+        for i in range(5):
+            assert stub.echo(i)==i
+        assert stub.runOnProc('echo', 's', bogus=1) is None      # fails in the process
+        stats=stub.getProcessStats()
+    finally:
+        stub.runOnProc(None, 'e')
+    assert stats['rpcexec']['echo']['count']==6
+    assert stats['rpcqueue']['echo']['count']==6
+    assert stats['rpcroundtrip']['echo']['count']==6
+    assert not 'tickduration' in stats
+
+def test_profile_does_not_block():
+    stub=makestub()
+    try:
+        assert stub.profileResults() is None                     # no profile run yet
+        assert stub.profileTicks(duration=-1) is None            # BadArgs
+        tstart=time.monotonic()
+        started=stub.profileTicks(duration=.5)
+        assert time.monotonic()-tstart < .4
+        assert started=={'duration': .5}
+        assert stub.profileResults() is None                     # still running
+        results=None
+        while results is None and time.monotonic()-tstart < 10:
+            time.sleep(.1)
+            results=stub.profileResults()
+    finally:
+        stub.runOnProc(None, 'e')
+    assert results['ticks'] >= 1 and results['profiled'] >= 1
+    assert isinstance(results['entries'], list)
+
+def test_trace_events(tmp_path):
+    stub=makestub(traceevents=1000)
+    try:
+        for i in range(3):
+            assert stub.echo(i)==i
+        time.sleep(.2)
+        count=stub.exportTrace(str(tmp_path / 'trace.json'))
+    finally:
+        stub.runOnProc(None, 'e')
+    with open(tmp_path / 'trace.json') as tf:
+        trace=json.load(tf)
+    events=trace['traceEvents']
+    assert count==len(events) and count > 0
+    for ev in events:
+        assert set(ev)=={'name', 'cat', 'ph', 'ts', 'dur', 'pid', 'tid'}
+        assert ev['ph']=='X' and ev['dur'] >= 0 and ev['ts'] >= 0
+    assert {'wait', 'message', 'tick'} <= {ev['cat'] for ev in events}
+    assert [ev['name'] for ev in events if ev['cat']=='message'][-3:]==['echo']*3
+    starts=[ev['ts'] for ev in events]
+    assert starts==sorted(starts)
+
+def test_no_trace_without_traceevents(tmp_path):
+    stub=makestub()
+    try:
+        assert stub.exportTrace(str(tmp_path / 'trace.json'))==0
+    finally:
+        stub.runOnProc(None, 'e')
+    assert not (tmp_path / 'trace.json').exists()
@@ -0,0 +1,34 @@
+import pytest
+import motorsim
+
+speedmap={'className': 'dcmotorbasic.speedmapper',
+          'fbuilder': {'minSpeed':1500, 'maxSpeed':13000, 'minDC':20, 'maxDC':255},
+          'rbuilder': {'minSpeed':1500, 'maxSpeed':13000, 'minDC':20, 'maxDC':255}}
+
+def makeset(**motorparams):
+    mdefs=[{'className': 'dcmotorbasic.motor', 'name': mname, 'mdrive': {'className': 'motorsim.simdrive'},
+            'rotationsense': {'className': 'quadfastencoder.fastencoder', 'ticksperrev': 12, 'pins': pins},
+            'speedmapinfo': speedmap, **motorparams} for mname, pins in (('left', (17, 27)), ('right', (10, 9)))]
+    return motorsim.simmotorset(motordefs=mdefs, quadmonitor=True)
+
+def calibrate(ms, **kwargs):
+    cal=ms.calibrate(test='dc', direction='forward', minDC=100, maxDC=200, dcstep=50, **kwargs)
+    while not cal.done:
+        ms.run(1)
+    return cal
+
+def test_deferred_ticks_still_measured():
+    steady=calibrate(makeset()).table()
+    # a tick budget that is always used up, so the calibrate ticker is put off on most ticks
+    deferred=calibrate(makeset(tickbudget=-1, maxdeferrals=3)).table()
+    for key, results in steady.items():
+        for (dc, rpm), (ddc, drpm) in zip(results, deferred[key]):
+            assert dc==ddc
+            assert abs(drpm-rpm) < rpm*.03
+
+def test_failed_start_leaves_no_tickers():
+    ms=makeset()
+    ms.motors['right'].addTicker(tickgen=iter(()), tickID='calibrate', ticktick=1, priority=10)
+    with pytest.raises(ValueError):
+        ms.calibrate(test='dc')
+    assert not 'calibrate' in ms.motors['left'].tickentries
@@ -0,0 +1,133 @@
+import time, threading, os, gzip, ast
+import pytest
+import logger
+
+def makelogger(path, name='t'):
+    return logger.logger(name=name, logtypes=(('x', {'filename': str(path), 'format': '{n}', 'noheader': True}),))
+
+def lines(path):
+    return [int(l) for l in path.read_text().split()]
+
+def waitfor(cond, timeout=5):
+    tend=time.monotonic()+timeout
+    while not cond():
+        assert time.monotonic() < tend, 'timed out'
+        time.sleep(.001)
+
+def fillbehindwriter(lg, aw, count):
+    """
+    with the writer thread held up writing records 0 and 1, puts records 2 to count-1
+    """
+    rec=lambda n: (lg.name, lg.logentries['x'], {'ltype': 'x', 'n': n}, 0)
+    aw.put(rec(0))
+    aw.put(rec(1))
+    waitfor(lambda: aw.writing)
+    for n in range(2, count):
+        aw.put(rec(n))
+    return rec
+
+@pytest.mark.parametrize('overflow, expected, dropped', (('dropoldest', [0, 1, 4, 5, 6, 7], 2), ('dropnew', [0, 1, 2, 3, 4, 5], 2)))
+def test_overflow_drops(tmp_path, overflow, expected, dropped):
+    fn=tmp_path / 'log.txt'
+    lg=makelogger(fn)
+    aw=logger.asynclogwriter(maxqueue=4, batchsize=2, flushtime=10, overflow=overflow)
+    with logger.logger.filelock:       # holds up the writer thread once it has taken records 0 and 1
+        fillbehindwriter(lg, aw, 8)
+    aw.close()
+    lg.close()
+    assert lines(fn)==expected
+    st=aw.stats()
+    assert st['dropped']==dropped and st['queued']==8-(dropped if overflow=='dropnew' else 0)
+    assert st['written']==6 and st['blocked']==0
+
+def test_overflow_blocks(tmp_path):
+    fn=tmp_path / 'log.txt'
+    lg=makelogger(fn)
+    aw=logger.asynclogwriter(maxqueue=4, batchsize=2, flushtime=10, overflow='block')
+    with logger.logger.filelock:
+        rec=fillbehindwriter(lg, aw, 6)
+        blocked=threading.Thread(target=aw.put, args=(rec(6),))
+        blocked.start()
+        waitfor(lambda: aw.stats()['blocked']==1)
+        assert blocked.is_alive()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    aw.close()
+    lg.close()
+    assert lines(fn)==list(range(7))
+    st=aw.stats()
+    assert st['dropped']==0 and st['blocked']==1 and st['written']==7
+
+def test_close_drops_late_records_and_does_not_truncate(tmp_path):
+    fn=tmp_path / 'log.txt'
+    aw=logger.startAsyncWriter(flushtime=.01)
+    try:
+        lg=makelogger(fn)
+        for n in range(3):
+            lg.log(ltype='x', n=n)
+        entries=lg.logentries['x']
+        lg.close()
+        aw.put((lg.name, entries, {'ltype': 'x', 'n': 99}, 0))     # a record queued after the close
+        aw.flush()
+        assert lines(fn)==[0, 1, 2]
+        lg2=makelogger(fn, name='t2')       # a later logger to the same file appends
+        lg2.log(ltype='x', n=3)
+        lg2.close()
+    finally:
+        logger.stopAsyncWriter()
+    assert lines(fn)==[0, 1, 2, 3]
+
+def writelines(rf, first, count):
+    for n in range(first, first+count):
+        rf.write('%09d\n' % n)      # 10 bytes per line
+
+def segmentlines(rf):
+    text=''
+    for seg in rf.segments():
+        opener=gzip.open if seg.endswith('.gz') else open
+        with opener(seg, 'rt') as sf:
+            text+=sf.read()
+    with open(rf.filename) as af:
+        text+=af.read()
+    return [int(l) for l in text.split()]
+
+def test_rotate_on_size_and_prune(tmp_path):
+    rf=logger.rotatingfile(str(tmp_path / 'log.txt'), maxbytes=40, keep=2)
+    writelines(rf, 0, 22)
+    rf.flush()
+    assert rf.rotations==5 and len(rf.segments())==2
+    assert segmentlines(rf)==list(range(12, 22))     # the 2 newest segments of 4 lines plus the 2 lines in the active segment
+    assert rf.diskusage()==100==sum(os.path.getsize(f) for f in tmp_path.iterdir())
+    rf.close()
+
+def test_rotate_on_age(tmp_path):
+    rf=logger.rotatingfile(str(tmp_path / 'log.txt'), maxage=.05, keep=5)
+    writelines(rf, 0, 2)
+    assert rf.rotations==0
+    time.sleep(.1)
+    writelines(rf, 2, 1)        # the segment is only checked for age when written to
+    rf.flush()
+    assert rf.rotations==1 and len(rf.segments())==1
+    assert segmentlines(rf)==[0, 1, 2]
+    rf.close()
+
+def test_compress_segments(tmp_path):
+    rf=logger.rotatingfile(str(tmp_path / 'log.txt'), maxbytes=40, keep=3, compress=True)
+    writelines(rf, 0, 30)
+    rf.flush()
+    waitfor(lambda: len(rf.segments())==3 and all(seg.endswith('.gz') for seg in rf.segments()))
+    assert rf.rotations==7
+    assert segmentlines(rf)==list(range(16, 30))
+    rf.close()
+
+def test_log_disk_usage(tmp_path):
+    fn=tmp_path / 'log.txt'
+    diskfn=tmp_path / 'disk.txt'
+    lg=logger.logger(name='t', logtypes=(('x', {'filename': str(fn), 'format': '{n:09d}', 'noheader': True, 'maxbytes': 40, 'keep': 2}),
+                                         ('disk', {'filename': str(diskfn), 'asdict': True})))
+    for n in range(22):
+        lg.log(ltype='x', n=n)
+    lg.logDiskUsage()
+    lg.close()
+    recs=[ast.literal_eval(l) for l in diskfn.read_text().splitlines()]
+    assert [(r['logfile'], r['used']) for r in recs]==[(str(fn), 100)]      # disk.txt was not open yet
@@ -0,0 +1,63 @@
+import urllib.request, urllib.error
+import pytest
+import metrics
+
+def makereg():
+    reg=metrics.registry()
+    reg.counter('msgs_total', 'messages received').inc(3)
+    reg.gauge('queue_depth', 'queued records', labels={'queue': 'log'}).set(7)
+    reg.gauge('queue_depth', 'queued records', labels={'queue': 'a"b'}, func=lambda: 1/0)
+    hist=reg.histogram('tick_seconds', 'tick duration', labels={'motor': 'left'}, buckets=(.01, .1, 1))
+    for v in (.005, .01, .05, .5, .5, 2):
+        hist.observe(v)
+    return reg, hist
+
+def test_histogram_buckets():
+    reg, hist=makereg()
+    assert hist.counts==[2, 1, 2, 1]         # an observation on a bound goes in that bucket
+    assert hist.count==6 and hist.sum==pytest.approx(3.065)
+    snap=hist.snapshot()
+    hist.observe(.02)
+    assert hist.summary(since=snap)['count']==1
+    assert hist.summary(since=snap)['p50']==pytest.approx(.055)
+    assert hist.quantile(.99)==1
+
+def test_exposition_format():
+    reg, hist=makereg()
+    assert reg.exposition().splitlines()==[
+        '# HELP msgs_total messages received',
+        '# TYPE msgs_total counter',
+        'msgs_total 3.0',
+        '# HELP queue_depth queued records',
+        '# TYPE queue_depth gauge',
+        'queue_depth{queue="log"} 7.0',
+        'queue_depth{queue="a\\"b"} nan',
+        '# HELP tick_seconds tick duration',
+        '# TYPE tick_seconds histogram',
+        'tick_seconds_bucket{motor="left",le="0.01"} 2.0',
+        'tick_seconds_bucket{motor="left",le="0.1"} 3.0',
+        'tick_seconds_bucket{motor="left",le="1"} 5.0',
+        'tick_seconds_bucket{motor="left",le="+Inf"} 6.0',
+        'tick_seconds_sum{motor="left"} %r' % hist.sum,
+        'tick_seconds_count{motor="left"} 6.0']
+
+def test_mixed_types_rejected():
+    reg=metrics.registry()
+    reg.counter('x', 'a counter')
+    with pytest.raises(AssertionError):
+        reg.gauge('x', 'a gauge')
+
+def test_http_endpoint():
+    reg, hist=makereg()
+    server=metrics.metricsserver(reg, port=0)
+    try:
+        assert server.port > 0
+        with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % server.port, timeout=5) as resp:
+            assert resp.status==200
+            assert resp.headers['Content-Type'].startswith('text/plain')
+            assert resp.read().decode()==reg.exposition()
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen('http://127.0.0.1:%d/other' % server.port, timeout=5)
+        assert e.value.code==404
+    finally:
+        server.close()
@@ -0,0 +1,51 @@
+import config_h_bridge
+import motorsim
+
+pidfeedback={'className': 'feedback.PIDfeedback', 'Pfact': -500, 'Ifact': 0, 'Dfact': -100}
+
+def makeset(invert):
+    mdefs=[]
+    for md in config_h_bridge.motordef:
+        md=dict(md, className='dcmotorbasic.motor', feedback=pidfeedback, logtypes=())
+        md['mdrive']=dict(md['mdrive'], invert=invert)
+        mdefs.append(md)
+    return motorsim.simmotorset(motordefs=mdefs, quadmonitor=True)
+
+def holdspeed(invert):
+    ms=makeset(invert)
+    try:
+        ms.motorTargetSpeed(5000)
+        ms.run(20)
+        return ms.lastMotorRPM()
+    finally:
+        ms.close()
+
+def test_feedback_holds_speed():
+    for rpm in holdspeed(False).values():
+        assert abs(rpm-5000) < 250
+
+def test_feedback_holds_speed_inverted():
+    for rpm in holdspeed(True).values():
+        assert abs(rpm-5000) < 250
+
+def test_reversed_encoder_counts_down():
+    world=motorsim.simworld()
+    fwd=world.addmotor('fwd', pinb=1)
+    rev=world.addmotor('rev', pinb=2, encreversed=True)
+    quads=motorsim.simquadfast(world, motorquads={'fwd': (3, 4), 'rev': (5, 6)})
+    fwd.duty=rev.duty=1
+    world.step(1)
+    assert quads.quadpos('fwd') > 0
+    assert abs(quads.quadpos('rev')+quads.quadpos('fwd')) <= 1
+
+def test_watchdog_trip_stays_stopped():
+    ms=makeset(False)
+    try:
+        ms.motorTargetSpeed(5000)
+        ms.run(5)
+        ms.quadmon.quadinfo.wdog.trips+=1
+        ms.run(3)
+        for rpm in ms.lastMotorRPM().values():
+            assert abs(rpm) < 100
+    finally:
+        ms.close()
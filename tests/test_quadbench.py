@@ -0,0 +1,17 @@
+import os, shutil, subprocess
+import pytest
+
+srcdir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope='module')
+def quadbench(tmp_path_factory):
+    if shutil.which('gcc') is None:
+        pytest.skip('needs gcc')
+    exe=str(tmp_path_factory.mktemp('quadbench') / 'quadbench')
+    subprocess.run(['gcc', '-Wall', '-O2', '-o', exe, os.path.join(srcdir, 'quadbench.c'), '-lrt'], check=True)
+    return exe
+
+def test_mailbox_round_trip(quadbench):
+    res=subprocess.run([quadbench, '-M'], capture_output=True, text=True)
+    assert res.returncode==0, res.stdout
+    assert 'mailbox test passed' in res.stdout
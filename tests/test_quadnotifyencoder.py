@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import quadnotifyencoder
+
+pinA, pinB = 17, 27
+fwdseq = (0, 1, 3, 2)       # quad positions in the forward direction (see quadlookup)
+
+def makeencoder():
+    """
+    a notifyencoder reading from a plain pipe, without pigpio
+    """
+    enc = quadnotifyencoder.notifyencoder.__new__(quadnotifyencoder.notifyencoder)
+    rfd, wfd = os.pipe()
+    os.set_blocking(rfd, False)
+    enc.pinA, enc.pinB = pinA, pinB
+    enc.pipefd = rfd
+    enc.readsize = 12000 - 12000 % quadnotifyencoder.reportdtype.itemsize
+    enc.leftover = b''
+    enc.lastquad = 0
+    enc.lastdir = 0
+    enc.tally = 0
+    enc.skipcount = 0
+    enc.recovered = 0
+    return enc, wfd
+
+def sendquads(wfd, quads):
+    reps = np.zeros(len(quads), dtype=quadnotifyencoder.reportdtype)
+    reps['level'] = [((q >> 1) & 1) << pinA | (q & 1) << pinB for q in quads]
+    os.write(wfd, reps.tobytes())
+
+def steps(start, count, stride):
+    return [fwdseq[(start + i * stride) % 4] for i in range(1, count+1)]
+
+def test_doubles_use_direction_from_earlier_batch():
+    for stride in (1, -1):
+        enc, wfd = makeencoder()
+        sendquads(wfd, steps(0, 8, stride))         # single steps set the direction
+        assert enc.updatetally() == 8 * stride
+        sendquads(wfd, steps(0, 6, 2 * stride))     # a batch of only double steps
+        assert enc.updatetally() == 20 * stride
+        assert enc.recovered == 6 and enc.skipcount == 0
+        os.close(wfd)
+
+def test_doubles_skipped_with_no_direction():
+    enc, wfd = makeencoder()
+    sendquads(wfd, steps(0, 4, 2))
+    assert enc.updatetally() == 0
+    assert enc.skipcount == 4 and enc.recovered == 0
+    os.close(wfd)
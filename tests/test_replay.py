@@ -0,0 +1,47 @@
+import config_h_bridge
+import motorsim
+import replay
+
+pidfeedback={'className': 'feedback.PIDfeedback', 'Pfact': -500, 'Ifact': 0, 'Dfact': -100}
+
+def record(filename):
+    mdefs=[dict(md, className='dcmotorbasic.motor', feedback=pidfeedback, logtypes=()) for md in config_h_bridge.motordef]
+    ms=motorsim.simmotorset(motordefs=mdefs, quadmonitor=True)
+    rec=replay.recorder(ms, filename, motordefs=mdefs)
+    try:
+        ms.motorTargetSpeed(3000)
+        ms.run(2)
+        ms.motorTargetSpeed(5000)
+        ms.run(2)
+        ms.stopMotor()
+        ms.run(.5)
+    finally:
+        rec.close()
+        ms.close()
+    return rec
+
+def test_replays_match(tmp_path):
+    fn=str(tmp_path / 'sim.rec')
+    rec=record(fn)
+    assert rec.ticks==90 and rec.commands==3
+    base=replay.replay(fn)
+    again=replay.replay(fn)
+    assert base['ticks']==again['ticks']==90
+    assert base['tstamp']==again['tstamp']
+    comp=replay.compare(base, again)
+    assert set(comp)=={md['name'] for md in config_h_bridge.motordef}
+    for mcomp in comp.values():
+        for fcomp in mcomp.values():
+            assert fcomp['firstdiff'] is None and fcomp['maxdiff']==0 and fcomp['rmsdiff']==0
+        assert mcomp['dc']['rmsa'] > 0           # the motors were driven
+
+def test_changed_controller_differs(tmp_path):
+    fn=str(tmp_path / 'sim.rec')
+    record(fn)
+    base=replay.replay(fn)
+    mdefs=replay.recordedmotordefs(fn)
+    mdefs[0]['feedback']=dict(mdefs[0]['feedback'], Pfact=-300)
+    trial=replay.replay(fn, motordefs=mdefs)
+    comp=replay.compare(base, trial)
+    assert not comp[mdefs[0]['name']]['dc']['firstdiff'] is None
+    assert comp[mdefs[1]['name']]['dc']['firstdiff'] is None
@@ -0,0 +1,37 @@
+import numpy as np
+import logger
+import resultstore
+
+def test_log_and_query(tmp_path):
+    dbfile=str(tmp_path / 'results.db')
+    sinkdef={'filename': dbfile, 'sink': {'className': 'resultstore.sqlitesink', 'batchsize': 4}}
+    loggers={mn: logger.logger(name=mn, logtypes=(('analyser', sinkdef),), createlogmsg=False) for mn in ('left', 'right')}
+    expected=[]
+    for runid, testname in ((1.0, 'mapDCtoRPM'), (2.0, 'stepresponse')):
+        for mn, lg in loggers.items():
+            for dc in (20, 40, 60):
+                rec={'ltype': 'analyser', 'motor': mn, 'testname': testname, 'runid': runid, 'direc': 'f', 'tstamp': runid*100+dc,
+                     'frequ': 200, 'DC': dc, 'speed': dc/20, 'tps': dc*3.0, 'rpm': dc*1.5, 'tallylist': [dc, dc+1]}
+                lg.log(**rec)
+                expected.append(rec)
+    for lg in loggers.values():
+        lg.close()
+
+    def check(res, **match):
+        recs=[r for r in expected if all(r[k]==v for k, v in match.items())]
+        assert list(res['DC'])==[r['DC'] for r in recs]
+        assert list(res['rpm'])==[r['rpm'] for r in recs]
+        return recs
+
+    assert len(check(resultstore.queryresults(dbfile)))==12
+    assert len(check(resultstore.queryresults(dbfile, motor='left'), motor='left'))==6
+    assert len(check(resultstore.queryresults(dbfile, testname='stepresponse'), testname='stepresponse'))==6
+    recs=check(resultstore.queryresults(dbfile, motor='right', runid=1.0), motor='right', runid=1.0)
+    assert len(recs)==3
+    res=resultstore.queryresults(dbfile, fields=('motor', 'testname', 'tps'), motor='right', testname='mapDCtoRPM', runid=1.0)
+    assert list(res['motor'])==['right']*3 and list(res['testname'])==['mapDCtoRPM']*3
+    assert np.array_equal(res['tps'], [60.0, 120.0, 180.0])
+    assert len(resultstore.queryresults(dbfile, motor='nobody')['DC'])==0
+    runs=resultstore.listruns(dbfile)
+    assert sorted(r[:4] for r in runs)==[(1.0, 'left', 'mapDCtoRPM', 200), (1.0, 'right', 'mapDCtoRPM', 200),
+                                   (2.0, 'left', 'stepresponse', 200), (2.0, 'right', 'stepresponse', 200)]
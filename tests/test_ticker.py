@@ -0,0 +1,111 @@
+import time
+import motorsim
+
+def makeset(**kwargs):
+    mdefs=[{'className': 'dcmotorbasic.motor', 'name': mname, 'mdrive': {'className': 'motorsim.simdrive'},
+            'rotationsense': {'className': 'quadfastencoder.fastencoder', 'ticksperrev': 12, 'pins': pins}}
+            for mname, pins in (('left', (17, 27)), ('right', (10, 9)))]
+    return motorsim.simmotorset(motordefs=mdefs, quadmonitor=True, **kwargs)
+
+def counting(calls, limit=None):
+    def tickfunc(state):
+        calls.append(state)
+        return None if not limit is None and state+1 >= limit else state+1
+    return tickfunc
+
+def test_longact_put_off_by_budget():
+    ms=makeset(tickbudget=-1)       # a budget that is always used up
+    m=ms.motors['left']
+    m.maxdeferrals=3
+    calls=[]
+    m.startlongact(counting(calls), 0)
+    ms.run(2)
+    stats=m.tickerStats()['longact']
+    assert stats['deferred'] > 0
+    assert stats['calls']==len(calls)
+    assert len(calls) < 40*.3       # 40 ticks, each run is put off 3 times
+
+def test_longact_completes():
+    ms=makeset()
+    m=ms.motors['left']
+    calls=[]
+    m.startlongact(counting(calls, limit=5), 0)
+    ms.run(1)
+    assert calls==[0, 1, 2, 3, 4]
+    assert m.longactfunc is None and not 'longact' in m.tickentries
+
+def busy(seconds):
+    while True:
+        tend=time.perf_counter()+seconds
+        while time.perf_counter() < tend:
+            pass
+        yield
+
+def idle():
+    while True:
+        yield
+
+def test_budget_covers_whole_motorset_tick():
+    ms=makeset(tickbudget=.001)
+    ms.motors['left'].addTicker(tickgen=busy(.002), tickID='busy', ticktick=1, priority=0)
+    ms.motors['right'].addTicker(tickgen=idle(), tickID='idle', ticktick=1, priority=10)
+    ms.run(1)
+    # the right motor's own tick is short, but the left motor has used the budget for the whole tick
+    assert ms.motors['right'].tickerStats()['idle']['deferred'] > 0
+
+def recorder(name, order, count=None):
+    n=0
+    while count is None or n < count:
+        order.append(name)
+        n+=1
+        yield
+
+def test_tickers_run_in_priority_order():
+    ms=makeset()
+    m=ms.motors['left']
+    order=[]
+    for name, pr in (('c', 30), ('a', 10), ('b', 20)):
+        m.addTicker(tickgen=recorder(name, order), tickID=name, ticktick=1, priority=pr)
+    m.addTicker(tickgen=recorder('slow', order), tickID='slow', ticktick=3, priority=0)
+    for i in range(6):
+        m.ticker()
+    assert order==['a', 'b', 'c', 'a', 'b', 'c', 'slow', 'a', 'b', 'c'] + ['a', 'b', 'c']*2 + ['slow', 'a', 'b', 'c']
+
+def test_remove_from_inside_a_ticker():
+    ms=makeset()
+    m=ms.motors['left']
+    order=[]
+    def remover():
+        order.append('remover')
+        m.removeTicker('later')
+        m.removeTicker('remover')
+        yield
+        order.append('remover ran again')
+        yield
+    m.addTicker(tickgen=remover(), tickID='remover', ticktick=1, priority=0)
+    m.addTicker(tickgen=recorder('later', order), tickID='later', ticktick=1, priority=5)
+    m.addTicker(tickgen=recorder('other', order), tickID='other', ticktick=1, priority=10)
+    for i in range(3):
+        m.ticker()
+    assert order==['remover', 'other', 'other', 'other']
+    assert list(m.tickentries)==['other']
+
+def test_readd_after_exception():
+    ms=makeset()
+    m=ms.motors['left']
+    def failing():
+        yield
+        raise RuntimeError('ticker failed')
+    m.addTicker(tickgen=failing(), tickID='flaky', ticktick=1, priority=10)
+    m.ticker()
+    try:
+        m.ticker()
+        assert False, 'exception not passed on'
+    except RuntimeError:
+        pass
+    assert not 'flaky' in m.tickentries
+    order=[]
+    m.addTicker(tickgen=recorder('flaky', order), tickID='flaky', ticktick=1, priority=10)
+    m.ticker()
+    m.ticker()
+    assert order==['flaky', 'flaky']
@@ -0,0 +1,58 @@
+import numpy as np
+import tracestore
+
+def makerecs(count):
+    return [{'motor': 'left', 'runid': 7.0, 'Pf': i*.5, 'If': i*.01, 'Df': 0.0, 'tstamp': 100+i*.05, 'targetSpeed': 2.0,
+             'speed': 1.9+i*.001, 'tallyinterval': 12.0+i, 'motorpos': i*12.0, 'error': .1, 'adjust': -i, 'expectchange': 12.5,
+             'actualchange': 12.0, 'ignored': 'x'} for i in range(count)]
+
+def test_round_trip(tmp_path):
+    tdir=str(tmp_path/'trace')
+    recs=makerecs(50)
+    sink=tracestore.tracesink(filename=tdir, fields=tracestore.feedbacktracefields, flushbytes=1000)
+    for rec in recs[:30]:
+        sink.writerecord('left', rec, 0)
+    sink.close()
+    sink=tracestore.tracesink(filename=tdir, fields=tracestore.feedbacktracefields, append=True)
+    for rec in recs[30:]:
+        sink.writerecord('left', rec, 0)
+    sink.writerecord('left', {'motor': 'right'}, 0)              # missing fields are written as zero
+    sink.close()
+    cols=tracestore.readcolumns(tdir)
+    assert isinstance(cols['speed'], np.memmap)
+    assert list(cols)==[fn for fn, ft in tracestore.feedbacktracefields]
+    trace=tracestore.readtrace(tdir)
+    assert len(trace)==51
+    for fn, ft in tracestore.feedbacktracefields:
+        expect=[rec[fn] for rec in recs]
+        if ft.startswith('S'):
+            assert [v.decode() for v in trace[fn][:50]]==expect
+        else:
+            assert np.array_equal(trace[fn][:50], np.array(expect, dtype=ft))
+    assert trace['motor'][50]==b'right' and trace['speed'][50]==0
+
+def test_convertlog(tmp_path):
+    logfile=tmp_path/'old.log'
+    lines=["{'ltype': 'analyse', 'motor': 'left', 'testname': 'fast', 'runid': 3.0, 'direc': 'f', 'tstamp': 12.5, 'frequ': 500,"
+               " 'DC': 80, 'speed': 2.5, 'tps': 300.0, 'rpm': 120.0}",
+           "{'ltype': 'other', 'motor': 'right'}",
+           "00:12.75 left      : ",
+           "ltype: analyse",
+           "motor: left",
+           "testname: fast",
+           "runid: 3.0",
+           "direc: r",
+           "tstamp: 12.75",
+           "frequ: 500",
+           "DC: 60",
+           "speed: 1.5",
+           "tps: 180.0",
+           "rpm: 72.0"]
+    logfile.write_text('\n'.join(lines)+'\n')
+    tdir=str(tmp_path/'trace')
+    assert tracestore.convertlog(str(logfile), tdir, tracestore.analyserfields, ltype='analyse')==2
+    trace=tracestore.readtrace(tdir)
+    assert list(trace['direc'])==[b'f', b'r']
+    assert list(trace['DC'])==[80, 60]
+    assert list(trace['tps'])==[300.0, 180.0]
+    assert list(trace['testname'])==[b'fast', b'fast']
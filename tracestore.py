@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+"""
+A compact binary store for trace records (such as the feedback trace from dcmotorbasic.motor and the analyser records from
+motoranalyser.motoranalyse) that can be loaded straight into numpy.
+
+Each trace is a directory holding a schema file and one append-only file per field (column). Every record has the same fixed set of
+fields, declared once for the ltype. Field types use numpy's notation: 'f8', 'f4', 'i8', 'i4', 'i2', 'u8', 'u4', 'u2', 'u1' for
+numbers (always little endian) and 'S<n>' for byte strings of up to n bytes.
+
+To write a trace, add a log entry with a sink to the motor's logtypes, for example:
+    ('feedbacktrace', {'filename': 'lefttrace', 'sink': {'className': 'tracestore.tracesink', 'fields': tracestore.feedbacktracefields}})
+
+numpy is only needed to read traces.
+"""
+import os, json, struct, ast, re
+
+# field lists for the records logged in this project
+feedbacktracefields=(('motor', 'S10'), ('runid', 'f8'), ('Pf', 'f8'), ('If', 'f8'), ('Df', 'f8'), ('tstamp', 'f8'),
+        ('targetSpeed', 'f8'), ('speed', 'f8'), ('tallyinterval', 'f8'), ('motorpos', 'f8'), ('error', 'f8'), ('adjust', 'f8'),
+        ('expectchange', 'f8'), ('actualchange', 'f8'))
+
+analyserfields=(('motor', 'S10'), ('testname', 'S16'), ('runid', 'f8'), ('direc', 'S1'), ('tstamp', 'f8'), ('frequ', 'i4'),
+        ('DC', 'i4'), ('speed', 'f8'), ('tps', 'f8'), ('rpm', 'f8'))
+
+schemafile='schema.json'
+
+def fieldformat(ftype):
+    """
+    returns the struct format for a field type
+    """
+    if ftype.startswith('S'):
+        return '<%ds' % int(ftype[1:])
+    return '<' + {'f8': 'd', 'f4': 'f', 'i8': 'q', 'i4': 'i', 'i2': 'h', 'u8': 'Q', 'u4': 'I', 'u2': 'H', 'u1': 'B'}[ftype]
+
+def asbytes(v):
+    return v if isinstance(v, bytes) else str(v).encode()
+
+class tracesink():
+    """
+    A log sink (see logger.logger) that writes each record's fields to the column files of a trace directory.
+
+    Values are buffered and written to the column files when flushbytes have been buffered, or when flush or close is called.
+    Fields missing from a record are written as zero / empty, and anything in the record that isn't a declared field is ignored.
+    """
+    def __init__(self, filename, fields, append=False, flushbytes=65536):
+        """
+        filename  : the directory for the trace - created if necessary
+
+        fields    : list of 2-tuples of field name and field type
+
+        append    : if True and the directory already holds a trace with the same fields, records are added to it, otherwise
+                    any existing trace is replaced
+
+        flushbytes: number of bytes buffered before they are written out
+        """
+        self.filename=filename
+        self.fields=tuple((str(fn), str(ft)) for fn, ft in fields)
+        self.flushbytes=flushbytes
+        self.packers=[]
+        for fn, ft in self.fields:
+            pk=struct.Struct(fieldformat(ft))
+            if ft.startswith('S'):
+                self.packers.append((fn, pk, asbytes, b''))
+            else:
+                self.packers.append((fn, pk, float if ft.startswith('f') else int, 0))
+        os.makedirs(filename, exist_ok=True)
+        schemapath=os.path.join(filename, schemafile)
+        if append and os.path.isfile(schemapath):
+            with open(schemapath) as sf:
+                oldfields=tuple(tuple(f) for f in json.load(sf)['fields'])
+            if oldfields != self.fields:
+                raise ValueError('tracesink: fields for %s do not match the existing trace' % filename)
+            mode='ab'
+        else:
+            with open(schemapath, 'w') as sf:
+                json.dump({'fields': self.fields}, sf)
+            mode='wb'
+        self.colfiles=[open(os.path.join(filename, fn+'.col'), mode) for fn, ft in self.fields]
+        self.buffers=[bytearray() for f in self.fields]
+        self.buffered=0
+        self.recsize=sum(pk[1].size for pk in self.packers)
+        self.closed=False
+
+    def writerecord(self, name, params, tnow):
+        """
+        adds a single record
+        """
+        for (fn, pk, conv, empty), buf in zip(self.packers, self.buffers):
+            v=params.get(fn, None)
+            buf += pk.pack(empty if v is None else conv(v))
+        self.buffered += self.recsize
+        if self.buffered >= self.flushbytes:
+            self.flush()
+
+    def flush(self):
+        for buf, cf in zip(self.buffers, self.colfiles):
+            cf.write(buf)
+            cf.flush()
+            del buf[:]
+        self.buffered=0
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            for cf in self.colfiles:
+                cf.close()
+            self.closed=True
+
+def readschema(dirname):
+    with open(os.path.join(dirname, schemafile)) as sf:
+        return [tuple(f) for f in json.load(sf)['fields']]
+
+def readcolumns(dirname):
+    """
+    memory maps the columns of a trace, returns an ordered dict of field name to numpy array. Only complete records are included.
+    """
+    import numpy as np
+    from collections import OrderedDict
+    fields=readschema(dirname)
+    dtypes=[(fn, np.dtype(ft if ft.startswith('S') else '<'+ft)) for fn, ft in fields]
+    colpaths=[os.path.join(dirname, fn+'.col') for fn, ft in fields]
+    count=min(os.path.getsize(cp) // dt.itemsize for cp, (fn, dt) in zip(colpaths, dtypes))
+    cols=OrderedDict()
+    for cp, (fn, dt) in zip(colpaths, dtypes):
+        cols[fn]=np.memmap(cp, dtype=dt, mode='r', shape=(count,)) if count > 0 else np.empty(0, dtype=dt)
+    return cols
+
+def readtrace(dirname):
+    """
+    returns a trace as a numpy structured array (one entry per record)
+    """
+    import numpy as np
+    cols=readcolumns(dirname)
+    rec=np.empty(len(next(iter(cols.values()))) if cols else 0, dtype=[(fn, c.dtype) for fn, c in cols.items()])
+    for fn, c in cols.items():
+        rec[fn]=c
+    return rec
+
+legacyheader=re.compile(r'^\d\d:\d\d\.\d\d .{10}: ')
+
+def readlegacy(textfile):
+    """
+    generator that reads a text log written by logger.logger and yields each record as a dict. It handles entries written with
+    'asdict' (one python dict per line) and entries with neither 'format' nor 'asdict' (a header then 1 line per value), which
+    are the only text formats that keep the field names.
+    """
+    def asvalue(vs):
+        try:
+            return ast.literal_eval(vs)
+        except (ValueError, SyntaxError):
+            return vs
+
+    current=None
+    with open(textfile) as tf:
+        for line in tf:
+            line=line.rstrip('\n')
+            if line.startswith('{'):
+                if not current is None:
+                    yield current
+                    current=None
+                try:
+                    rec=ast.literal_eval(line)
+                except (ValueError, SyntaxError):
+                    continue
+                if isinstance(rec, dict):
+                    yield rec
+                continue
+            hm=legacyheader.match(line)
+            if hm:
+                if not current is None:
+                    yield current
+                current={}
+                line=line[hm.end():]
+            if not current is None and ': ' in line:
+                k, v = line.split(': ', 1)
+                current[k]=asvalue(v)
+    if not current is None:
+        yield current
+
+def convertlog(textfile, dirname, fields, ltype=None):
+    """
+    converts a legacy text log into a binary trace.
+
+    textfile: the text log to read
+
+    dirname : directory for the new trace (any existing trace there is replaced)
+
+    fields  : the fields for the trace - see tracesink
+
+    ltype   : if not None, only records with this ltype are converted
+
+    returns the number of records converted
+    """
+    sink=tracesink(filename=dirname, fields=fields)
+    count=0
+    try:
+        for rec in readlegacy(textfile):
+            if ltype is None or rec.get('ltype', None)==ltype:
+                sink.writerecord(None, rec, 0)
+                count+=1
+    finally:
+        sink.close()
+    return count